@@ -0,0 +1,137 @@
+__author__ = 'ivo'
+
+"""
+Benchmark of the hash database backends of build_whitelist: LevelDB (binary records) and SQLite.
+Ingests synthetic file records through build_whitelist.batch_write, then measures lookup latency of single digests
+and the throughput of batched lookups, for a mix of known and unknown digests.
+
+Example:
+    python -m android.bench_hashdb --files 200000 --lookups 20000 --json results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import plyvel
+
+from android import build_whitelist
+from android import records
+from android import sqldb
+
+_log = logging.getLogger()
+
+BACKENDS = ("ldb", "sql")
+
+def synthetic_items(count, seed, dirs=1000):
+    """
+    :return: list of ((md5, sha1, sha256), value) for count files with random digests, spread over dirs directories
+    """
+    rnd = random.Random(seed)
+    items = []
+    for i in range(count):
+        hashes = (rnd.randbytes(16), rnd.randbytes(20), rnd.randbytes(32))
+        items.append((hashes, {"source_id": "bench",
+                               "threat": records.THREAT_LEVELS["good"],
+                               "trust": records.TRUST_LEVELS["high"],
+                               "filepath": "/system/dir{}/file{}".format(rnd.randrange(dirs), i)}))
+    return items
+
+def _open(backend, path):
+    if backend == "ldb":
+        dbif = plyvel.DB(path, create_if_missing=True)
+        return dbif, records.RecordStore(dbif).get_many
+    dbif = sqldb.SqlHashDb(path)
+    return dbif, dbif.get_many
+
+def _dbsize(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run_backend(backend, path, items, lookups, batch_size, seed):
+    result = {"backend": backend}
+    dbif, get_many = _open(backend, path)
+    build_whitelist.configure(dbif=dbif, dbpath=path, bloom=True)
+    start = time.perf_counter()
+    for i in range(0, len(items), batch_size):
+        build_whitelist.batch_write(items[i:i + batch_size])
+    seconds = time.perf_counter() - start
+    result.update({"ingest_seconds": seconds, "ingest_files_s": len(items) / seconds})
+    dbif.close()
+    result["db_size"] = _dbsize(path)
+
+    # Half known, half unknown digests, of all three types
+    rnd = random.Random(seed + 1)
+    digests = []
+    for _ in range(lookups):
+        if rnd.random() < 0.5:
+            digests.append(rnd.choice(rnd.choice(items)[0]))
+        else:
+            digests.append(rnd.randbytes(rnd.choice(records.HASH_KEY_SIZES)))
+    dbif, get_many = _open(backend, path)
+    latencies = []
+    found = 0
+    for digest in digests:
+        start = time.perf_counter()
+        found += digest in get_many([digest])
+        latencies.append(time.perf_counter() - start)
+    result.update({"lookup_found": found,
+                   "lookup_mean_us": sum(latencies) / len(latencies) * 1e6,
+                   "lookup_p50_us": _percentile(latencies, 0.5) * 1e6,
+                   "lookup_p99_us": _percentile(latencies, 0.99) * 1e6})
+    start = time.perf_counter()
+    for i in range(0, len(digests), batch_size):
+        get_many(digests[i:i + batch_size])
+    seconds = time.perf_counter() - start
+    result["batch_lookups_s"] = len(digests) / seconds
+    dbif.close()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the LevelDB and SQLite hash database backends")
+    parser.add_argument("-n", "--files", type=int, default=100000, help="Number of files to ingest. Default: 100000")
+    parser.add_argument("-l", "--lookups", type=int, default=10000, help="Number of lookups. Default: 10000")
+    parser.add_argument("-b", "--batch-size", type=int, default=1024, help="Files per batch write and digests per batch lookup. Default: 1024")
+    parser.add_argument("--backend", action="append", choices=BACKENDS, help="Backend to run, can be repeated. Default: all")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Default: 0")
+    parser.add_argument("-w", "--workdir", default=tempfile.gettempdir(), help="Directory for the databases. Default: system temp dir")
+    parser.add_argument("--json", help="Also write the results to this json file")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    items = synthetic_items(args.files, args.seed)
+    results = {"files": args.files, "lookups": args.lookups, "batch_size": args.batch_size, "seed": args.seed,
+               "cases": []}
+    print("{:<5} {:>10} {:>12} {:>10} {:>10} {:>10} {:>14}".format(
+        "db", "files/s", "size", "mean us", "p50 us", "p99 us", "batch lookup/s"))
+    for backend in args.backend or BACKENDS:
+        path = os.path.join(args.workdir, "bench_hashdb.{}.{}".format(os.getpid(), backend))
+        try:
+            result = run_backend(backend, path, items, args.lookups, args.batch_size, args.seed)
+        finally:
+            for leftover in (path, path + "-wal", path + "-shm"):
+                if os.path.isdir(leftover):
+                    shutil.rmtree(leftover)
+                elif os.path.exists(leftover):
+                    os.remove(leftover)
+        results["cases"].append(result)
+        print("{:<5} {:>10.0f} {:>12d} {:>10.1f} {:>10.1f} {:>10.1f} {:>14.0f}".format(
+            backend, result["ingest_files_s"], result["db_size"], result["lookup_mean_us"], result["lookup_p50_us"],
+            result["lookup_p99_us"], result["batch_lookups_s"]))
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+__author__ = 'ivo'
+
+"""
+End to end ingest benchmark of build_whitelist: explore_filesystem over a synthetic file tree, into a LevelDB hash
+database. Sweeps the batch size, hash buffer size and number of hashing processes, for three database states:
+    fresh: a new database
+    populated: a database with --populate unrelated records (synthetic, see bench_hashdb)
+    reingest: a database that already has the files of the tree, so every digest is a duplicate
+Every case runs in a new process, for its peak RSS. Reported per case: files/s, MB/s, the stage times of
+android.metrics, the write amplification (bytes the process wrote to disk, divided by the bytes put in the database,
+the bloom filter file left out), the database size and the peak RSS. Disk writes are the write_bytes of /proc/self/io,
+counted in pages, so pipe traffic to the hashing processes is left out; with few keys per batch the page rounding
+of the LevelDB log shows in the write amplification. Populated databases are compacted before the
+measured ingest. The tree is hashed from the page cache after the first case, for all cases alike. The digest cache is
+off, so every case hashes every file.
+
+Example:
+    python -m android.bench_ingest -n 20000 --dist android --dup-ratio 0.3 -B 256 -B 1024 -B 4096 --json ingest.json
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import plyvel
+
+from android import bench_hashdb
+from android import build_whitelist
+from android import metrics
+
+_log = logging.getLogger()
+
+MODES = ("fresh", "populated", "reingest")
+# Size distributions of the synthetic files: (weight, min size, max size), sizes are log uniform within a bucket
+SIZE_DISTRIBUTIONS = {"small": ((1.0, 256, 16 * 1024),),
+                      "android": ((0.70, 256, 16 * 1024), (0.25, 16 * 1024, 1024 * 1024),
+                                  (0.05, 1024 * 1024, 16 * 1024 * 1024)),
+                      "large": ((0.5, 1024 * 1024, 16 * 1024 * 1024), (0.5, 16 * 1024 * 1024, 64 * 1024 * 1024))}
+FILES_PER_DIR = 100
+
+def make_tree(rootpath, files, dist="android", dup_ratio=0.0, seed=0):
+    """
+    Write a tree of files with random content. A dup_ratio fraction of the files is a copy of an earlier file.
+    :return: (number of files, total bytes)
+    """
+    rnd = random.Random(seed)
+    buckets = SIZE_DISTRIBUTIONS[dist]
+    weights = [weight for (weight, low, high) in buckets]
+    originals = []
+    total = 0
+    for i in range(files):
+        dirpath = os.path.join(rootpath, "dir{}".format(i // FILES_PER_DIR))
+        if i % FILES_PER_DIR == 0:
+            os.makedirs(dirpath, exist_ok=True)
+        fp = os.path.join(dirpath, "file{}".format(i))
+        if originals and rnd.random() < dup_ratio:
+            original = rnd.choice(originals)
+            shutil.copyfile(original, fp)
+            total += os.path.getsize(original)
+            continue
+        (weight, low, high) = rnd.choices(buckets, weights)[0]
+        size = int(math.exp(rnd.uniform(math.log(low), math.log(high))))
+        with open(fp, "wb") as fh:
+            fh.write(rnd.randbytes(size))
+        originals.append(fp)
+        total += size
+    return files, total
+
+def _written_bytes():
+    """
+    :return: bytes this process caused to be written to disk, all threads included, or None without /proc
+    """
+    try:
+        with open("/proc/self/io") as fh:
+            for line in fh:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+class _CountingWriteBatch():
+    def __init__(self, db, wb):
+        self._db = db
+        self._wb = wb
+
+    def put(self, key, value):
+        self._db.user_bytes += len(key) + len(value)
+        self._wb.put(key, value)
+
+    def delete(self, key):
+        self._wb.delete(key)
+
+    def write(self):
+        self._wb.write()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self._wb.write()
+
+class _CountingDB():
+    """
+    plyvel.DB that counts the bytes of the keys and values put in it, for the write amplification.
+    """
+    def __init__(self, dbif):
+        self._dbif = dbif
+        self.user_bytes = 0
+
+    def put(self, key, value):
+        self.user_bytes += len(key) + len(value)
+        self._dbif.put(key, value)
+
+    def write_batch(self):
+        return _CountingWriteBatch(self, self._dbif.write_batch())
+
+    def __getattr__(self, name):
+        return getattr(self._dbif, name)
+
+def _ingest(treepath, dbpath, sourceid):
+    dbif = _CountingDB(plyvel.DB(dbpath, create_if_missing=True))
+    build_whitelist.configure(dbif=dbif, dbpath=dbpath)
+    build_whitelist.explore_filesystem(treepath, sourceid=sourceid, threat=0, trust=2)
+    return dbif.user_bytes
+
+def run_case(case, treepath, dbpath, tree_files, tree_bytes, populate, seed):
+    """
+    One benchmark case, run in a process of its own.
+    :param case: dict with mode, batch_size, hash_buf_size and workers
+    :return: result dict
+    """
+    logging.getLogger().setLevel(logging.WARNING)
+    build_whitelist.configure(batch_size=case["batch_size"], hash_buf_size=case["hash_buf_size"],
+                              workers=case["workers"], digest_cache=False, bloom=True)
+    if case["mode"] == "populated":
+        dbif = plyvel.DB(dbpath, create_if_missing=True)
+        build_whitelist.configure(dbif=dbif, dbpath=dbpath)
+        items = bench_hashdb.synthetic_items(populate, seed)
+        for i in range(0, len(items), case["batch_size"]):
+            build_whitelist.batch_write(items[i:i + case["batch_size"]])
+        build_whitelist.close()
+    elif case["mode"] == "reingest":
+        _ingest(treepath, dbpath, "prepopulated")
+    if case["mode"] != "fresh":
+        # The writes of populating the db should not be flushed and compacted during the measured ingest
+        dbif = plyvel.DB(dbpath)
+        dbif.compact_range()
+        dbif.close()
+
+    metrics.reset()
+    written = _written_bytes()
+    sizebefore = bench_hashdb._dbsize(dbpath) if os.path.exists(dbpath) else 0
+    start = time.perf_counter()
+    user_bytes = _ingest(treepath, dbpath, "bench")
+    seconds = time.perf_counter() - start
+    if written is not None:
+        # Without the bloom filter that is saved next to the db at the end
+        bloompath = dbpath + ".bloom"
+        written = _written_bytes() - written - (os.path.getsize(bloompath) if os.path.exists(bloompath) else 0)
+
+    result = dict(case)
+    snapshot = metrics.snapshot()
+    result.update({"files": tree_files,
+                   "bytes": tree_bytes,
+                   "seconds": seconds,
+                   "files_s": tree_files / seconds,
+                   "mb_s": tree_bytes / seconds / 1e6,
+                   "stages": {stage: stats["seconds"] for (stage, stats) in snapshot["stages"].items()},
+                   "keys_written": snapshot["counters"].get("keys_written", 0),
+                   "user_bytes": user_bytes,
+                   "written_bytes": written,
+                   "write_amplification": written / user_bytes if written is not None and user_bytes else None,
+                   "db_size": bench_hashdb._dbsize(dbpath),
+                   "db_growth": bench_hashdb._dbsize(dbpath) - sizebefore,
+                   # ru_maxrss is in KiB on Linux
+                   "peak_rss": 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)})
+    return result
+
+def _run_case_process(conn, *args):
+    try:
+        conn.send(run_case(*args))
+    except BaseException as exc:
+        conn.send(exc)
+        raise
+    finally:
+        conn.close()
+
+def _run_isolated(*args):
+    # Spawned, not forked, so the peak RSS is of this case only. Not a Pool, its processes can not start hashing pools.
+    ctx = multiprocessing.get_context("spawn")
+    (parent, child) = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_case_process, args=(child,) + args)
+    process.start()
+    child.close()
+    result = parent.recv()
+    process.join()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+def _remove_db(dbpath):
+    for leftover in (dbpath, dbpath + ".bloom", dbpath + ".digestcache"):
+        if os.path.isdir(leftover):
+            shutil.rmtree(leftover)
+        elif os.path.exists(leftover):
+            os.remove(leftover)
+
+def _size(text):
+    """
+    :return: bytes of a size like 65536, 64K or 4M
+    """
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    if text[-1:].upper() in units:
+        return int(text[:-1]) * units[text[-1:].upper()]
+    return int(text)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark build_whitelist ingest of a synthetic file tree")
+    parser.add_argument("-n", "--files", type=int, default=10000, help="Number of files in the tree. Default: %(default)s")
+    parser.add_argument("--dist", choices=sorted(SIZE_DISTRIBUTIONS), default="android", help="File size distribution. Default: %(default)s")
+    parser.add_argument("--dup-ratio", type=float, default=0.2, help="Fraction of files that are a copy of another file. Default: %(default)s")
+    parser.add_argument("--tree", help="Ingest this existing directory instead of a synthetic tree")
+    parser.add_argument("-m", "--mode", action="append", choices=MODES, help="Database state, can be repeated. Default: all")
+    parser.add_argument("-p", "--populate", type=int, default=100000, help="Number of records in the populated database. Default: %(default)s")
+    parser.add_argument("-B", "--batch-size", type=int, action="append", help="Files per batch_write, can be repeated. Default: 1024")
+    parser.add_argument("-b", "--hash-buf-size", type=_size, action="append", help="Hash read size, like 64K or 1M, can be repeated. Default: 1M")
+    parser.add_argument("-j", "--jobs", type=int, action="append", help="Number of hashing processes, can be repeated. Default: 1")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Default: 0")
+    parser.add_argument("-w", "--workdir", default=tempfile.gettempdir(), help="Directory for the tree and databases. Default: system temp dir")
+    parser.add_argument("--json", help="Also write the results to this json file")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    workdir = os.path.join(args.workdir, "bench_ingest.{}".format(os.getpid()))
+    os.makedirs(workdir)
+    try:
+        if args.tree:
+            treepath = os.path.abspath(args.tree)
+            (tree_files, tree_bytes) = (0, 0)
+            for (root, dirs, files) in os.walk(treepath):
+                for fl in files:
+                    fp = os.path.join(root, fl)
+                    if not os.path.islink(fp):
+                        tree_files += 1
+                        tree_bytes += os.path.getsize(fp)
+        else:
+            treepath = os.path.join(workdir, "tree")
+            (tree_files, tree_bytes) = make_tree(treepath, args.files, args.dist, args.dup_ratio, args.seed)
+        _log.info("Tree %s: %d files, %.1f MB", treepath, tree_files, tree_bytes / 1e6)
+
+        results = {"files": tree_files, "bytes": tree_bytes, "dist": None if args.tree else args.dist,
+                   "dup_ratio": None if args.tree else args.dup_ratio, "populate": args.populate, "seed": args.seed,
+                   "cases": []}
+        print("{:<10} {:>6} {:>8} {:>3} {:>9} {:>8} {:>6} {:>12} {:>10}".format(
+            "mode", "batch", "buf", "j", "files/s", "MB/s", "WA", "db size", "peak RSS"))
+        dbpath = os.path.join(workdir, "hashes.db")
+        for (mode, batch_size, hash_buf_size, workers) in itertools.product(
+                args.mode or MODES, args.batch_size or [1024], args.hash_buf_size or [1024 * 1024], args.jobs or [1]):
+            case = {"mode": mode, "batch_size": batch_size, "hash_buf_size": hash_buf_size, "workers": workers}
+            try:
+                result = _run_isolated(case, treepath, dbpath, tree_files, tree_bytes, args.populate, args.seed)
+            finally:
+                _remove_db(dbpath)
+            results["cases"].append(result)
+            amplification = result["write_amplification"]
+            print("{:<10} {:>6d} {:>8d} {:>3d} {:>9.0f} {:>8.1f} {:>6} {:>12d} {:>10d}".format(
+                mode, batch_size, hash_buf_size, workers, result["files_s"], result["mb_s"],
+                "-" if amplification is None else "{:.2f}".format(amplification), result["db_size"],
+                result["peak_rss"]))
+    finally:
+        shutil.rmtree(workdir)
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+if __name__ == "__main__":
+    main()
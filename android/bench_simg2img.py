@@ -0,0 +1,271 @@
+__author__ = 'ivo'
+
+"""
+Benchmark for simg2img. Generates reproducible synthetic sparse images with a configurable mix of RAW, FILL,
+DONT_CARE and CRC32 chunks, then times the unsparse engines on them. Reports MB/s of output, time per chunk type
+(serial engine only) and peak RSS. Every run is done in a fresh process, so the peak RSS is of that run only.
+
+Example:
+    python -m android.bench_simg2img --size 1024 --mix raw=40,fill=30,dont_care=25,crc=5 --json results.json
+"""
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import tempfile
+import time
+
+from android import simg2img
+from android.simg2img import ChunkHeader, SparseHeader
+
+_log = logging.getLogger()
+
+DEFAULT_MIX = {"raw": 40, "fill": 30, "dont_care": 25, "crc": 5}
+CHUNK_TYPES = {"raw": simg2img.CHUNK_TYPE_RAW,
+               "fill": simg2img.CHUNK_TYPE_FILL,
+               "dont_care": simg2img.CHUNK_TYPE_DONT_CARE,
+               "crc": simg2img.CHUNK_TYPE_CRC32}
+ENGINES = ("serial", "parallel", "stream")
+
+def parse_mix(mix):
+    """
+    Parse "raw=40,fill=30,dont_care=25,crc=5" into a dict of relative weights per chunk type.
+    """
+    weights = {}
+    for item in mix.split(","):
+        (name, weight) = item.split("=")
+        if name not in CHUNK_TYPES:
+            raise ValueError("Unknown chunk type {}".format(name))
+        weights[name] = float(weight)
+    return weights
+
+def _write_chunk(fh, chunk_type, num_blocks, data):
+    ch = ChunkHeader()
+    ch.chunk_type = chunk_type
+    ch.reserved1 = 0
+    ch.chunk_sz = num_blocks
+    ch.total_sz = simg2img.CHUNK_HEADER_LEN + len(data)
+    fh.write(ch.to_bytes())
+    fh.write(data)
+
+def generate_image(path, size, blk_sz=4096, mix=DEFAULT_MIX, chunk_blocks=(1, 1024), zero_fill_ratio=0.5, seed=0):
+    """
+    Write a synthetic sparse image. The same arguments always give the same image.
+    :param size: Size of the unsparsed image in bytes, rounded up to whole chunks
+    :param mix: Relative weight per chunk type, by number of chunks
+    :param chunk_blocks: (min, max) blocks per chunk
+    :param zero_fill_ratio: Fraction of the fill chunks that fill zeroes
+    :return: Number of chunks per chunk type
+    """
+    rnd = random.Random(seed)
+    names = [name for name in mix if mix[name] > 0]
+    weights = [mix[name] for name in names]
+    if not [name for name in names if name != "crc"]:
+        raise ValueError("The mix needs at least one chunk type with data")
+    crc = simg2img.Crc32Engine(simg2img.CRC_COMPUTE)
+    counts = collections.Counter()
+    total_blks = 0
+    with open(path, "wb") as fh:
+        fh.write(bytes(simg2img.SPARSE_HEADER_LEN))
+        while total_blks * blk_sz < size:
+            name = rnd.choices(names, weights)[0]
+            if name == "crc":
+                # No more crc chunks than data chunks, so a crc heavy mix still makes progress
+                if counts["crc"] and counts["crc"] >= sum(counts.values()) - counts["crc"]:
+                    continue
+                _write_chunk(fh, simg2img.CHUNK_TYPE_CRC32, 0, struct.pack("<I", crc.value))
+                counts[name] += 1
+                continue
+            num_blocks = rnd.randint(*chunk_blocks)
+            length = num_blocks * blk_sz
+            if name == "raw":
+                data = rnd.randbytes(length)
+                crc.update(data)
+                _write_chunk(fh, simg2img.CHUNK_TYPE_RAW, num_blocks, data)
+            elif name == "fill":
+                fill_val = b"\x00\x00\x00\x00" if rnd.random() < zero_fill_ratio else struct.pack("<I", rnd.getrandbits(32))
+                crc.update(fill_val * (length // 4))
+                _write_chunk(fh, simg2img.CHUNK_TYPE_FILL, num_blocks, fill_val)
+            else:
+                crc.update_zeros(length)
+                _write_chunk(fh, simg2img.CHUNK_TYPE_DONT_CARE, num_blocks, b"")
+            total_blks += num_blocks
+            counts[name] += 1
+
+        sh = SparseHeader()
+        sh.magic = simg2img.SPARSE_HEADER_MAGIC
+        sh.major_version = simg2img.SPARSE_HEADER_MAJOR_VER
+        sh.minor_version = 0
+        sh.file_hdr_sz = simg2img.SPARSE_HEADER_LEN
+        sh.chunk_hdr_sz = simg2img.CHUNK_HEADER_LEN
+        sh.blk_sz = blk_sz
+        sh.total_blks = total_blks
+        sh.total_chunks = sum(counts.values())
+        sh.image_checksum = crc.value
+        fh.seek(0)
+        fh.write(sh.to_bytes())
+    _log.info("Generated %s: %d blocks, chunks %s", path, total_blks, dict(counts))
+    return dict(counts)
+
+class _ChunkTimers():
+    """
+    Wraps the process_*_chunk functions of simg2img to measure the time spent per chunk type.
+    Nested calls (a zero fill chunk skipped in holes mode) count for the outer chunk type only.
+    """
+    _functions = {"raw": "process_raw_chunk",
+                  "fill": "process_fill_chunk",
+                  "dont_care": "process_skip_chunk",
+                  "crc": "process_crc32_chunk"}
+
+    def __init__(self, blk_sz):
+        self.blk_sz = blk_sz
+        self.seconds = collections.Counter()
+        self.bytes = collections.Counter()
+        self.calls = collections.Counter()
+        self._orig = {}
+        self._depth = 0
+
+    def _wrap(self, name, func):
+        def timed(*args):
+            if self._depth:
+                return func(*args)
+            self._depth += 1
+            start = time.perf_counter()
+            try:
+                ret = func(*args)
+            finally:
+                self._depth -= 1
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+            if ret:
+                self.bytes[name] += ret * self.blk_sz
+            return ret
+        return timed
+
+    def __enter__(self):
+        for name, funcname in self._functions.items():
+            self._orig[funcname] = getattr(simg2img, funcname)
+            setattr(simg2img, funcname, self._wrap(name, self._orig[funcname]))
+        return self
+
+    def __exit__(self, *exc):
+        for funcname, func in self._orig.items():
+            setattr(simg2img, funcname, func)
+
+    def results(self):
+        results = {}
+        for name in self.calls:
+            results[name] = {"calls": self.calls[name],
+                             "seconds": self.seconds[name],
+                             "mb_s": self.bytes[name] / self.seconds[name] / 2**20 if self.bytes[name] and self.seconds[name] else None}
+        return results
+
+def run_case(image, output, engine, crc_mode, output_mode, workers=None):
+    """
+    Unsparse image once with one engine. Meant to run in a fresh process.
+    :return: dict with the results
+    """
+    result = {"engine": engine, "crc_mode": crc_mode, "output_mode": output_mode, "workers": workers}
+    timers = None
+    with open(image, "rb") as inputfd:
+        blk_sz = SparseHeader.from_bytes(inputfd.read(simg2img.SPARSE_HEADER_LEN)).blk_sz
+        inputfd.seek(0)
+        start = time.perf_counter()
+        if engine == "serial":
+            with open(output, "wb") as outputfd, _ChunkTimers(blk_sz) as timers:
+                stats = simg2img.unsparse(inputfd, outputfd, crc_mode=crc_mode, output_mode=output_mode)
+        elif engine == "parallel":
+            with open(output, "wb") as outputfd:
+                stats = simg2img.unsparse_parallel(inputfd, outputfd, workers=workers, crc_mode=crc_mode,
+                                                   output_mode=output_mode)
+        elif engine == "stream":
+            gen = simg2img.iter_unsparse(inputfd, crc_mode=crc_mode, output_mode=output_mode)
+            while True:
+                try:
+                    next(gen)
+                except StopIteration as e:
+                    stats = e.value
+                    break
+        else:
+            raise ValueError("Unknown engine {}".format(engine))
+        seconds = time.perf_counter() - start
+    output_size = stats.total_blocks * blk_sz
+    result.update({"seconds": seconds,
+                   "mb_s": output_size / seconds / 2**20,
+                   "bytes_written": stats.bytes_written,
+                   "bytes_skipped": stats.bytes_skipped,
+                   "crc32": stats.crc.value,
+                   "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+    if timers:
+        result["chunk_types"] = timers.results()
+    if os.path.exists(output):
+        os.remove(output)
+    return result
+
+def run_isolated(*args):
+    # Spawn, not fork, so the peak RSS of the parent does not count
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_case, args)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark simg2img on synthetic sparse images")
+    parser.add_argument("-s", "--size", type=int, default=256, help="Unsparsed image size in MiB. Default: 256")
+    parser.add_argument("-b", "--block-size", type=int, default=4096, help="Block size. Default: 4096")
+    parser.add_argument("-m", "--mix", default="raw=40,fill=30,dont_care=25,crc=5", help="Relative number of chunks per type. Default: raw=40,fill=30,dont_care=25,crc=5")
+    parser.add_argument("--min-blocks", type=int, default=1, help="Minimum blocks per chunk. Default: 1")
+    parser.add_argument("--max-blocks", type=int, default=1024, help="Maximum blocks per chunk. Default: 1024")
+    parser.add_argument("--zero-fill-ratio", type=float, default=0.5, help="Fraction of fill chunks that fill zeroes. Default: 0.5")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Default: 0")
+    parser.add_argument("-e", "--engine", action="append", choices=ENGINES, help="Engine to run, can be repeated. Default: all")
+    parser.add_argument("-c", "--crc", action="append", choices=simg2img.CRC_MODES, help="Crc mode to run, can be repeated. Default: verify and off")
+    parser.add_argument("-o", "--output-mode", action="append", choices=simg2img.OUTPUT_MODES, help="Output mode to run, can be repeated. Default: all")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="Workers for the parallel engine. 0 means the default. Default: 0")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per case, the fastest counts. Default: 3")
+    parser.add_argument("-w", "--workdir", default=tempfile.gettempdir(), help="Directory for the images. Default: system temp dir")
+    parser.add_argument("--json", help="Also write the results to this json file")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    image = os.path.join(args.workdir, "bench_simg2img.{}.img".format(os.getpid()))
+    output = image + ".out"
+    results = {"size": args.size * 2**20, "block_size": args.block_size, "mix": parse_mix(args.mix),
+               "chunk_blocks": [args.min_blocks, args.max_blocks], "zero_fill_ratio": args.zero_fill_ratio,
+               "seed": args.seed, "cases": []}
+    try:
+        start = time.perf_counter()
+        results["chunks"] = generate_image(image, results["size"], args.block_size, results["mix"],
+                                           (args.min_blocks, args.max_blocks), args.zero_fill_ratio, args.seed)
+        results["sparse_size"] = os.path.getsize(image)
+        print("Generated {} ({} bytes sparse) in {:.1f}s, chunks: {}".format(
+            image, results["sparse_size"], time.perf_counter() - start, results["chunks"]))
+        print("{:<9} {:<8} {:<6} {:>8} {:>9} {:>12}".format("engine", "crc", "output", "seconds", "MB/s", "peak RSS kB"))
+        for engine in args.engine or ENGINES:
+            for crc_mode in args.crc or (simg2img.CRC_VERIFY, simg2img.CRC_OFF):
+                for output_mode in args.output_mode or simg2img.OUTPUT_MODES:
+                    runs = [run_isolated(image, output, engine, crc_mode, output_mode, args.jobs or None)
+                            for _ in range(args.repeat)]
+                    best = min(runs, key=lambda run: run["seconds"])
+                    best["runs"] = [run["seconds"] for run in runs]
+                    results["cases"].append(best)
+                    print("{:<9} {:<8} {:<6} {:>8.3f} {:>9.1f} {:>12d}".format(
+                        engine, crc_mode, output_mode, best["seconds"], best["mb_s"], best["peak_rss_kb"]))
+                    for name, chunk_result in sorted(best.get("chunk_types", {}).items()):
+                        print("    {:<10} {:>8d} chunks {:>8.3f}s {:>9}".format(
+                            name, chunk_result["calls"], chunk_result["seconds"],
+                            "{:.1f} MB/s".format(chunk_result["mb_s"]) if chunk_result["mb_s"] else ""))
+    finally:
+        if os.path.exists(image):
+            os.remove(image)
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+if __name__ == "__main__":
+    main()
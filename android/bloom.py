@@ -0,0 +1,84 @@
+__author__ = 'ivo'
+
+"""
+Bloom filter for digest keys, used to skip database lookups for hashes that are certainly new.
+The keys are md5/sha1/sha256 digests, so the bit positions are taken from the key bytes instead of hashing them again
+(double hashing with two 64 bit halves of the key).
+
+File layout: header struct "<4sQIQQ16s" (magic, number of bits, number of hashes, number of added keys, capacity,
+token), then the bits. The token is set by the owner of the file, to check that the filter is still in sync with
+the keys it describes.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import struct
+
+_log = logging.getLogger(__name__)
+
+MAGIC = b"BLM1"
+HEADER_FORMAT = "<4sQIQQ16s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+class BloomFilter():
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        :param capacity: Number of keys for which the false positive rate is error_rate
+        :param error_rate: False positive rate at capacity
+        """
+        capacity = max(capacity, 1)
+        self.nbits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        self.nhashes = max(int(round(self.nbits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+        self.capacity = capacity
+        self.token = bytes(16)
+
+    def _positions(self, key):
+        if len(key) < 16:
+            key = hashlib.md5(key).digest()
+        h1 = int.from_bytes(key[:8], "little")
+        h2 = int.from_bytes(key[8:16], "little") | 1
+        nbits = self.nbits
+        return [(h1 + i * h2) % nbits for i in range(self.nhashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count > self.capacity
+
+    def save(self, path):
+        tmppath = path + ".tmp"
+        with open(tmppath, "wb") as fh:
+            fh.write(struct.pack(HEADER_FORMAT, MAGIC, self.nbits, self.nhashes, self.count, self.capacity,
+                                 self.token))
+            fh.write(self.bits)
+        os.replace(tmppath, path)
+        _log.debug("Bloom filter with %d keys saved to %s", self.count, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fh:
+            (magic, nbits, nhashes, count, capacity, token) = struct.unpack(HEADER_FORMAT, fh.read(HEADER_SIZE))
+            if magic != MAGIC:
+                raise Exception("Not a bloom filter file: {}".format(path))
+            bf = cls.__new__(cls)
+            bf.nbits, bf.nhashes, bf.count, bf.capacity, bf.token = nbits, nhashes, count, capacity, token
+            bf.bits = bytearray(fh.read())
+        if len(bf.bits) != (nbits + 7) // 8:
+            raise Exception("Truncated bloom filter file: {}".format(path))
+        _log.debug("Bloom filter with %d keys loaded from %s", count, path)
+        return bf
@@ -29,6 +29,9 @@ The file format is as follows:
 **    else: jump to kernel_addr
 */
 
+Header version 1 adds a recovery dtbo after the second stage, version 2 adds a dtb after that. Version 3 and 4 have a
+new header with a fixed page size of 4096 and only a kernel and ramdisk (and a boot signature in version 4).
+
 Kernel is a zimage file.
 Ramdisk is the initramfs file, which is a gzipped cpio archive containing the dir tree that is mounted at '/'
 by the boot loader.
@@ -40,15 +43,30 @@ import struct
 import io
 import logging
 import gzip
-import subprocess
-import os.path
-import os
-import tempfile
+import mmap
+import lzma
+
+try:
+    import lz4.block
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from android import cpio
+from android import metrics
 
 _log = logging.getLogger(__name__)
 
+BOOT_MAGIC = b"ANDROID!"
+
 class BootImgHeader():
-    _struct = "<8sIIIIIIII4x4x16s512s32s1024s"
+    """
+    Header version 0 to 2. Version 0 images use the header_version field for other purposes or leave it 0, so
+    anything above 2 is treated as version 0.
+    """
+    _struct = "<8sIIIIIIIIII16s512s32s1024s"
+    _struct_v1 = "<IQI"
+    _struct_v2 = "<IQ"
     structlen = struct.calcsize(_struct)
 
     @classmethod
@@ -57,7 +75,18 @@ class BootImgHeader():
         (bih.magic, bih.kernel_size, bih.kernel_addr,
          bih.ramdisk_size, bih.ramdisk_addr, bih.second_size,
          bih.second_addr, bih.tags_addr, bih.page_size,
+         bih.header_version, bih.os_version,
          bih.name, bih.cmdline, bih.id, bih.extra_cmdline) = struct.unpack_from(cls._struct, blob)
+        if bih.header_version > 2:
+            bih.header_version = 0
+        bih.recovery_dtbo_size, bih.recovery_dtbo_offset, bih.header_size = 0, 0, cls.structlen
+        bih.dtb_size, bih.dtb_addr = 0, 0
+        if bih.header_version >= 1:
+            (bih.recovery_dtbo_size, bih.recovery_dtbo_offset,
+             bih.header_size) = struct.unpack_from(cls._struct_v1, blob, cls.structlen)
+        if bih.header_version >= 2:
+            (bih.dtb_size, bih.dtb_addr) = struct.unpack_from(cls._struct_v2, blob,
+                                                              cls.structlen + struct.calcsize(cls._struct_v1))
         return bih
 
     @classmethod
@@ -67,43 +96,236 @@ class BootImgHeader():
     def __repr__(self):
         return "<{}({})>".format(self.__class__.__name__, vars(self))
 
-def _extract_kernel(fh):
-    hdr = BootImgHeader.fromFile(fh)
-    fh.seek(hdr.page_size - BootImgHeader.structlen, io.SEEK_CUR)
-    kernel_blob = fh.read(hdr.kernel_size)
-    return kernel_blob
+class BootImgHeaderV3():
+    """
+    Header version 3 and 4. The page size is fixed and the second stage, recovery dtbo and dtb moved to the vendor
+    boot image.
+    """
+    _struct = "<8sIIII16sI1536s"
+    _struct_v4 = "<I"
+    structlen = struct.calcsize(_struct)
+    page_size = 4096
+
+    @classmethod
+    def fromBytes(cls, blob):
+        bih = cls()
+        (bih.magic, bih.kernel_size, bih.ramdisk_size, bih.os_version,
+         bih.header_size, bih.reserved, bih.header_version, bih.cmdline) = struct.unpack_from(cls._struct, blob)
+        bih.signature_size = 0
+        if bih.header_version >= 4:
+            (bih.signature_size,) = struct.unpack_from(cls._struct_v4, blob, cls.structlen)
+        return bih
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, vars(self))
+
+def parse_header(blob):
+    """
+    Parse a boot image header of any version.
+    """
+    (magic,) = struct.unpack_from("8s", blob)
+    if magic != BOOT_MAGIC:
+        raise Exception("Not an android boot image")
+    # header_version is at the same offset in all versions
+    (header_version,) = struct.unpack_from("<I", blob, 40)
+    if header_version in (3, 4):
+        return BootImgHeaderV3.fromBytes(blob)
+    return BootImgHeader.fromBytes(blob)
+
+HEADER_READ_SIZE = 4096
+
+def _align(size, page_size):
+    return (size + page_size - 1) // page_size * page_size
+
+class BootImage():
+    """
+    A boot image, opened and mapped once. The header is parsed once and the sections are zero copy memoryview slices
+    of the mapping, computed from the page size alignment.
+    Release any section views you keep before closing.
+    """
+    def __init__(self, image):
+        """
+        :param image: Path or binary file object. File objects without a file descriptor are read into memory.
+        """
+        self._fh = open(image, "rb") if isinstance(image, str) else None
+        fh = self._fh or image
+        self.name = getattr(fh, "name", None)
+        try:
+            fh.seek(0)
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, io.UnsupportedOperation, ValueError):
+            fh.seek(0)
+            self._map = fh.read()
+        self._view = memoryview(self._map)
+        self.header = parse_header(self._view[:HEADER_READ_SIZE])
+        self._sections = self._layout()
+
+    def _layout(self):
+        hdr = self.header
+        page_size = hdr.page_size
+        sections = {}
+        offset = page_size if hdr.header_version < 3 else _align(hdr.header_size, page_size)
+        order = [("kernel", hdr.kernel_size), ("ramdisk", hdr.ramdisk_size)]
+        if hdr.header_version < 3:
+            order += [("second", hdr.second_size), ("recovery_dtbo", hdr.recovery_dtbo_size),
+                      ("dtb", hdr.dtb_size)]
+        else:
+            order += [("signature", hdr.signature_size)]
+        for name, size in order:
+            sections[name] = (offset, size)
+            offset += _align(size, page_size)
+        return sections
+
+    @property
+    def header_version(self):
+        return self.header.header_version
+
+    def section(self, name):
+        """
+        :return: memoryview of a section, empty if the image does not have it
+        """
+        (offset, size) = self._sections[name]
+        if offset + size > len(self._view):
+            _log.error("Boot image section %s (%d bytes at %d) is truncated", name, size, offset)
+            raise Exception("Truncated boot image")
+        return self._view[offset:offset + size]
+
+    @property
+    def kernel(self):
+        return self.section("kernel")
+
+    @property
+    def ramdisk(self):
+        return self.section("ramdisk")
+
+    @property
+    def second(self):
+        return self.section("second") if "second" in self._sections else self._view[0:0]
+
+    def close(self):
+        self._view.release()
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                _log.debug("Section views of %s still in use, mapping closed when released", self.name)
+        if self._fh:
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return "<{}({}, {})>".format(self.__class__.__name__, self.name, repr(self.header))
 
 def extract_kernel(fh):
-    if isinstance(fh, str):
-        with open(fh, "rb") as fh:
-            return _extract_kernel(fh)
-    else:
-        return _extract_kernel(fh)
-
-def _extract_ramdisk(fh):
-    hdr = BootImgHeader.fromFile(fh)
-    fh.seek(hdr.page_size - BootImgHeader.structlen, io.SEEK_CUR)
-    fh.seek(hdr.kernel_size, io.SEEK_CUR)
-    fh.seek(hdr.page_size - (hdr.kernel_size % hdr.page_size), io.SEEK_CUR)
-    ramdisk_blob = fh.read(hdr.ramdisk_size)
-    return ramdisk_blob
+    with BootImage(fh) as bi:
+        return bytes(bi.kernel)
 
 def extract_ramdisk(fh):
-    if isinstance(fh, str):
-        with open(fh, "rb") as fh:
-            return _extract_ramdisk(fh)
-    else:
-        return _extract_ramdisk(fh)
-
-def unpack_ramdisk(blob, destdir):
-    extractdir = os.path.join(destdir, "ramdisk_unpacked")
-    if not os.path.exists(extractdir):
-        os.mkdir(extractdir)
-    _log.info("Unpacking ramdisk to %s...", extractdir)
-
-    tfh = tempfile.TemporaryFile()
-    with gzip.open(io.BytesIO(blob), "rb") as gfh:
-            tfh.write(gfh.read())
-    tfh.seek(0)
-    subprocess.check_call(["cpio", "-i", "--no-absolute-filenames"], stdin=tfh, cwd=extractdir)
-    return extractdir
+    with BootImage(fh) as bi:
+        return bytes(bi.ramdisk)
+
+class BufferReader(io.RawIOBase):
+    """
+    File object over a bytes like object (like a memoryview of a mapping), without copying it like io.BytesIO.
+    """
+    def __init__(self, buf):
+        super().__init__()
+        self._view = memoryview(buf).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), len(self._view) - self._pos)
+        memoryview(b).cast("B")[:size] = self._view[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+LZ4_LEGACY_MAGIC = b"\x02\x21\x4c\x18"
+LZ4_LEGACY_BLOCK_SIZE = 8 * 1024 * 1024
+
+class _Lz4LegacyReader(io.RawIOBase):
+    """
+    Decompressing reader for the legacy lz4 format (lz4 -l), used for Android ramdisks: the magic, followed by
+    blocks of at most 8 MiB uncompressed, each prefixed with its compressed size.
+    """
+    def __init__(self, fh):
+        super().__init__()
+        self._fh = fh
+        self._block = b""
+        self._pos = 0
+        if self._fh.read(4) != LZ4_LEGACY_MAGIC:
+            raise Exception("Not a legacy lz4 stream")
+
+    def readable(self):
+        return True
+
+    def _next_block(self):
+        sizebytes = self._fh.read(4)
+        if len(sizebytes) < 4:
+            return False
+        (size,) = struct.unpack("<I", sizebytes)
+        # Multiple lz4 streams can be concatenated, a magic starts the next one
+        if sizebytes == LZ4_LEGACY_MAGIC:
+            return self._next_block()
+        self._block = lz4.block.decompress(self._fh.read(size), uncompressed_size=LZ4_LEGACY_BLOCK_SIZE)
+        self._pos = 0
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._block):
+            if not self._next_block():
+                return 0
+        size = min(len(b), len(self._block) - self._pos)
+        memoryview(b).cast("B")[:size] = self._block[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+def open_ramdisk(blob):
+    """
+    Open a (compressed) ramdisk as a decompressing stream. Supports gzip, xz, lzma, lz4 (legacy and frame format,
+    needs the lz4 package) and uncompressed cpio.
+    """
+    raw = io.BufferedReader(BufferReader(blob))
+    magic = bytes(blob[:6])
+    if magic[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    elif magic == b"\xfd7zXZ\x00" or magic[:3] == b"\x5d\x00\x00":
+        return lzma.LZMAFile(raw)
+    elif magic[:4] in (LZ4_LEGACY_MAGIC, b"\x04\x22\x4d\x18"):
+        if lz4 is None:
+            raise Exception("lz4 compressed ramdisk, install the lz4 package")
+        if magic[:4] == LZ4_LEGACY_MAGIC:
+            return io.BufferedReader(_Lz4LegacyReader(raw))
+        return lz4.frame.LZ4FrameFile(raw)
+    elif magic in cpio.NEWC_MAGICS:
+        return raw
+    raise Exception("Unknown ramdisk compression, magic {}".format(repr(magic)))
+
+class _TimedStream():
+    """
+    Adds the time spent in read to a metrics stage.
+    """
+    __slots__ = ("_fh", "_stage")
+
+    def __init__(self, fh, stage):
+        self._fh = fh
+        self._stage = stage
+
+    def read(self, size=-1):
+        with metrics.timer(self._stage):
+            return self._fh.read(size)
+
+def iter_ramdisk(blob):
+    """
+    Iterate over the files in a ramdisk without extracting it. See cpio.iter_cpio. Reading the ramdisk, also the file
+    data of the entries, is timed as the decompress stage.
+    """
+    with open_ramdisk(blob) as fh:
+        yield from cpio.iter_cpio(_TimedStream(fh, "decompress"))
@@ -11,6 +11,10 @@ This database can be used as an authenticated whitelist reference set to check e
 The script creates a meta db containing information on the processed sources. This can be used to verify from which sources
 the hash values are generated.
 
+With -c, sources are downloaded, extracted and processed at the same time (see SourceScheduler), within a scratch
+space budget. --index-url points the script to another index page, like a local stand-in served with
+"python -m http.server" that has rows in the format of the AOSP page, for testing offline.
+
 """
 
 
@@ -28,17 +32,31 @@ import subprocess
 import hashlib
 import datetime
 import json
+import itertools
+import stat
+import sys
+import threading
+import queue
+import functools
+import concurrent.futures
+import contextlib
 
 from android import filesystem
 from android import simg2img
 from android import bootimg
 from android import build_whitelist
+from android import ext4
+from android import yaffs
+from android import metrics
 
 import plyvel
 
 _log = logging.getLogger()
 
 TMPDIR = tempfile.gettempdir()
+INDEX_URL = "https://developers.google.com/android/nexus/images"
+# Mounted images and the bootloader content dir are in TMPDIR under a fixed name, one at a time
+_mount_lock = threading.Lock()
 
 def md5file(fp):
     md5digest = hashlib.md5()
@@ -49,12 +67,12 @@ def md5file(fp):
             blob = fh.read(1024*1024*16)
     return md5digest.hexdigest()
 
-def scrape_links():
+def scrape_links(index_url=INDEX_URL):
     """
     Scrape links to image archive from AOSP website
+    :param index_url: The index page, or a local stand-in of it with rows in the same format
     :return: list with 3-tuple (source id, url, md5 string)
     """
-    index_url = "https://developers.google.com/android/nexus/images"
     index_page = requests.get(index_url)
     results = re.findall("<tr id=\"(.*)\">\s*<td.*\s*<td><a href=\"(http.*\.tgz)\">Link</a>\s*<td>([a-f0-9A-F]{32})", index_page.text, flags=re.M)
     _log.info("Scraped %d links from %s", len(results), index_url)
@@ -68,17 +86,20 @@ def select_interesting(members):
         if os.path.splitext(tarinfo.name)[1] == ".img" or os.path.splitext(tarinfo.name)[1] == ".zip":
             yield tarinfo
 
-def untar_files(fp, destdir):
+def untar_files(fp, destdir, reserve=None):
     """
     Untar all interesting files to destdir.
     :param fp: The tar or tgz file.
     :param destdir: The directory to unpack the files in
+    :param reserve: Function called with the size of every file before it is extracted, for the scratch space budget
     """
     with tarfile.open(fp) as tar:
         members = select_interesting(tar)
         for member in members:
             fn = os.path.basename(member.name)
             destpath = os.path.join(destdir, fn)
+            if reserve:
+                reserve(member.size)
             with tar.extractfile(member) as memberfh, open(destpath, "wb") as destfh:
                 blob = memberfh.read(4096)
                 while blob:
@@ -86,7 +107,7 @@ def untar_files(fp, destdir):
                     blob = memberfh.read(4096)
             _log.info("Extracted %s to %s", member.name, destpath)
 
-def unzip_images(fp, destdir):
+def unzip_images(fp, destdir, reserve=None):
     with zipfile.ZipFile(fp) as zf:
         imagemembers = [im for im in zf.infolist() if os.path.splitext(im.filename)[-1] == ".img"]
         for member in imagemembers:
@@ -95,6 +116,8 @@ def unzip_images(fp, destdir):
             if os.path.exists(destpath):
                 _log.info("No need to unzip %s, it allready exists", member.filename)
                 continue
+            if reserve:
+                reserve(member.file_size)
             with zf.open(member, "r") as memberfh, open(destpath, "wb") as destfh:
                 blob = memberfh.read(4096)
                 while blob:
@@ -103,8 +126,95 @@ def unzip_images(fp, destdir):
             _log.info("Unzipped %s to %s", member.filename, destpath)
     return len(imagemembers)
 
-def build(hashdb, sourcesdb):
-    sources = scrape_links()
+def sourcesdb_path(hashdb):
+    return os.path.splitext(hashdb.rstrip(os.path.sep))[0] + ".sources.db"
+
+def parse_shard(shard):
+    """
+    :param shard: "index/count", for example 0/4
+    :return: (index, count)
+    """
+    (index, count) = (int(part) for part in shard.split("/"))
+    if not 0 <= index < count:
+        raise ValueError("Invalid shard {}".format(shard))
+    return index, count
+
+def in_shard(md5val, shard):
+    """
+    Sources are spread over the shards by the md5 of their archive, so every node selects the same sources for a shard.
+    """
+    (index, count) = shard
+    return int(md5val, 16) % count == index
+
+def parse_size(size):
+    """
+    :param size: number of bytes, optionally with a K, M, G or T suffix
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * units[size[-1:].upper()])
+    return int(size)
+
+def _select_sources(index_url, shard):
+    sources = scrape_links(index_url)
+    if shard:
+        sources = [source for source in sources if in_shard(source[2], shard)]
+        _log.info("%d sources in shard %d/%d", len(sources), *shard)
+    return sources
+
+def _source_record(source_id, source):
+    return bytes(json.dumps({"processed":str(datetime.datetime.now()), "source_id":source_id, "source":source}), encoding="utf8")
+
+def fetch_source(source, md5val, fp, reserve=None):
+    """
+    Download an archive to fp, unless it is there with the right md5 already.
+    :param reserve: Function called with the size of the download, for the scratch space budget
+    """
+    if os.path.exists(fp):
+        _log.info("File %s allready present", fp)
+        if md5val == md5file(fp):
+            _log.info("Md5 match, will skip download")
+            if reserve:
+                reserve(os.path.getsize(fp))
+            return
+        _log.info("Md5 does not match value on remote source, will download again")
+        os.remove(fp)
+    with metrics.timer("download"):
+        r = requests.get(source, stream=True)
+        r.raise_for_status()
+        if reserve:
+            reserve(int(r.headers.get("Content-Length", 0)))
+        with open(fp, 'wb') as fd:
+            for chunk in r.iter_content(64 * 1024):
+                fd.write(chunk)
+                metrics.count("download_bytes", len(chunk))
+    if md5val.lower() != md5file(fp):
+        raise Exception("Md5 of downloaded {} does not match the md5 on the index page".format(fp))
+    _log.info("File downloaded to %s", fp)
+
+def extract_source(fp, untardir, reserve=None):
+    """
+    Untar the images and zip files of an archive, and unzip the images in the zip files. The zip files are removed
+    once they are unzipped.
+    :return: paths of the image files
+    """
+    if not os.path.isdir(untardir):
+        os.makedirs(untardir)
+    with metrics.timer("extract"):
+        untar_files(fp, untardir, reserve)
+        _log.info("Files untard to %s", untardir)
+        for zfile in [os.path.join(untardir, entry) for entry in os.listdir(untardir) if os.path.splitext(entry)[-1] == ".zip"]:
+            unzip_images(zfile, untardir, reserve)
+            os.remove(zfile)
+            _log.info("Images from zip file %s unzipped to %s", zfile, untardir)
+    return sorted(os.path.join(untardir, entry) for entry in os.listdir(untardir) if os.path.splitext(entry)[-1] == ".img")
+
+def build(hashdb, sourcesdb, shard=None, index_url=INDEX_URL):
+    """
+    :param shard: (index, count), only process the sources of this shard. The shard databases are combined with
+                  android.merge afterwards.
+    """
+    sources = _select_sources(index_url, shard)
     _log.info("Using %s as sources database", sourcesdb)
     for (source_id, source, md5val) in sources:
         _log.info("Processing %s...", source)
@@ -117,77 +227,112 @@ def build(hashdb, sourcesdb):
             _log.info("Source found in sourcesdb: %s", str(dbval, encoding="utf8"))
             _log.info("Source processed!: %s", source)
             continue
-        if not os.path.exists(fp):
-            download = True
-        else:
-            _log.info("File %s allready present", fp)
-            if md5val != md5file(fp):
-                _log.info("Md5 does not match value on remote source, will download again")
-                os.remove(fp)
-                download = True
-            else:
-                _log.info("Md5 match, will skip download")
-                download = False
-
-        if download:
-            r = requests.get(source, stream=True)
-            with open(fp, 'wb') as fd:
-                for chunk in r.iter_content(4096):
-                    fd.write(chunk)
-            _log.info("File downloaded to %s", fp)
+        fetch_source(source, md5val, fp)
 
         untardir = os.path.join(TMPDIR, os.path.splitext(fn)[0])
-        if not os.path.isdir(untardir):
-            os.makedirs(untardir)
-        untar_files(fp, untardir)
-        _log.info("Files untard to %s", untardir)
-        for zfile in [os.path.join(untardir, entry) for entry in os.listdir(untardir) if os.path.splitext(entry)[-1] == ".zip"]:
-            unzip_images(zfile, untardir)
-            _log.info("Images from zip file %s unzipped to %s", zfile, untardir)
-        img_filepaths = [os.path.join(untardir, entry) for entry in os.listdir(untardir) if os.path.splitext(entry)[-1] == ".img"]
+        img_filepaths = extract_source(fp, untardir)
         _log.info("Processing image files:\n%s", "\n".join(img_filepaths))
         for imgfp in img_filepaths:
             process_imagefile(imgfp, hashdb, source_id)
         shutil.rmtree(untardir)
         _log.info("Removed temp dir: %s", untardir)
         dbif = plyvel.DB(sourcesdb, create_if_missing=True)
-        dbif.put(bytes(md5val, encoding="utf8"), bytes(json.dumps({"processed":str(datetime.datetime.now()), "source_id":source_id, "source":source}), encoding="utf8"))
+        dbif.put(bytes(md5val, encoding="utf8"), _source_record(source_id, source))
         dbif.close()
+        metrics.count("sources")
         _log.info("Source processed!: %s", source)
 
-
-def process_imagefile(fp, hashdb, source):
+def image_hashes(fp, reserve=None):
+    """
+    Hash the files in an image file. ext4 (also in sparse images), yaffs2 and boot images are read in process, other
+    sparse images are unsparsed next to the image first, other images are mounted.
+    Mounting uses a directory in TMPDIR named after the image, like images of other sources, so mounted images are
+    processed one at a time. The digest cache is not used: the stat keys of a mounted image differ per mount.
+    :param reserve: Function called with the size of the unsparsed image before unsparsing, for the scratch budget
+    :return: generator of (filepath, (md5, sha1, sha256))
+    """
     _log.info("Processing image file %s...", fp)
 
-    mounted, tempdir = False, False
-    if filesystem.is_sparseext4(fp):
-        _log.info("Detected sparse image")
-        curfp = fp
-        fp = os.path.join(os.path.dirname(fp), "unsparsed." + os.path.basename(fp))
-        if os.path.exists(fp):
-            _log.info("Unsparsed allready found at %s, no need to unsparse.", fp)
+    mounted, tempdir, locked = False, False, False
+    bootimage, ext4fs, yaffsimage, sparsereader = None, None, None, None
+    image = fp
+    try:
+        fstypes = filesystem.detect(fp)
+        if "sparse" in fstypes:
+            _log.info("Detected sparse image")
+            curfp = fp
+            fp = os.path.join(os.path.dirname(fp), "unsparsed." + os.path.basename(fp))
+            sparsereader = simg2img.SparseImageReader(curfp)
+            fstypes = filesystem.detect_bytes(sparsereader.pread(filesystem.HEADER_SIZE, 0))
+            if "ext4" in fstypes:
+                _log.info("Sparse image contains ext4, no need to unsparse.")
+                image = sparsereader
+            elif os.path.exists(fp):
+                _log.info("Unsparsed allready found at %s, no need to unsparse.", fp)
+                image = fp
+            else:
+                if reserve:
+                    reserve(len(sparsereader))
+                with open(curfp, "rb") as infd, open(fp, "wb") as outfd:
+                    simg2img.unsparse(infd, outfd)
+                image = fp
+        if "yaffs" in fstypes:
+            _log.info("Detected yaffs image, reading it without unyaffs")
+            yaffsimage = yaffs.Yaffs2Image(image)
+            rootpath = os.path.join(TMPDIR, os.path.basename(fp))
+        elif "boot" in fstypes:
+            _log.info("Detected android boot image")
+            # The ramdisk files and kernel are hashed straight from the image, the rootpath is only used for the file paths
+            bootimage = bootimg.BootImage(fp)
+            rootpath = os.path.join(TMPDIR, "ramdisk_unpacked")
+        elif "ext4" in fstypes:
+            _log.info("Detected ext4 image, reading it without mounting")
+            # Same file paths as when it would have been mounted
+            ext4fs = ext4.Ext4Filesystem(image)
+            rootpath = os.path.join(TMPDIR, os.path.basename(fp))
         else:
-            with open(curfp, "rb") as infd, open(fp, "wb") as outfd:
-                simg2img.unsparse(infd, outfd)
-    if filesystem.is_yaffs_image(fp):
-        _log.info("Detected yaffs image")
-        rootpath = filesystem.unpack_yaffs(fp, TMPDIR)
-    elif filesystem.is_boot_image(fp):
-        _log.info("Detected android boot image")
-        ramdisk_blob = bootimg.extract_ramdisk(fp)
-        rootpath = bootimg.unpack_ramdisk(ramdisk_blob, TMPDIR)
-        with open(os.path.join(rootpath, "vmlinuz"), "wb") as ofh:
-            ofh.write(bootimg.extract_kernel(fp))
-    elif filesystem.is_bootloader_image(fp) or "loader" in os.path.basename(fp).lower():
-        _log.info("Detected android bootloader image, not supported yet")
-        rootpath = os.path.join(TMPDIR, "bootloader_content")
-        if not os.path.isdir(rootpath):
-            os.mkdir(rootpath)
-    else:
-        _log.info("Assuming file system image which is known by mount")
-        rootpath = filesystem.mount_image(fp, TMPDIR)
-        mounted = True
+            _mount_lock.acquire()
+            locked = True
+            if "bootloader" in fstypes or "loader" in os.path.basename(fp).lower():
+                _log.info("Detected android bootloader image, not supported yet")
+                rootpath = os.path.join(TMPDIR, "bootloader_content")
+                if not os.path.isdir(rootpath):
+                    os.mkdir(rootpath)
+                tempdir = True
+            else:
+                _log.info("Assuming file system image which is known by mount")
+                rootpath = filesystem.mount_image(fp, TMPDIR)
+                mounted, tempdir = True, True
+
+        if bootimage:
+            entries = itertools.chain(bootimg.iter_ramdisk(bootimage.ramdisk),
+                                      [("vmlinuz", stat.S_IFREG | 0o644, len(bootimage.kernel),
+                                        bootimg.BufferReader(bootimage.kernel))])
+        elif ext4fs:
+            entries = ((path, inode.mode, size, fh) for (path, inode, size, fh) in ext4fs.walk(physical_order=True))
+        elif yaffsimage:
+            entries = yaffsimage.walk()
+        else:
+            entries = None
+        if entries is not None:
+            yield from build_whitelist.hash_entries(entries, rootpath)
+        else:
+            yield from build_whitelist.hash_tree(rootpath)
+    finally:
+        for opened in (bootimage, ext4fs, yaffsimage, sparsereader):
+            if opened:
+                opened.close()
+        if mounted:
+            filesystem.unmount_image(rootpath)
+        if tempdir:
+            shutil.rmtree(rootpath)
+            _log.info("Temp dir %s deleted", rootpath)
+        if locked:
+            _mount_lock.release()
+    metrics.count("images")
+    _log.info("Done with image file: %s", fp)
 
+def process_imagefile(fp, hashdb, source):
     build_whitelist.configure(dbpath=hashdb)
     dbcreated = False
     if not os.path.exists(hashdb):
@@ -195,27 +340,236 @@ def process_imagefile(fp, hashdb, source):
     build_whitelist.configure(dbif=plyvel.DB(hashdb, create_if_missing=True))
     _log.info("Connected to Ldb database %s", repr(hashdb))
 
-    build_whitelist.explore_filesystem(rootpath, sourceid=source,
-                                       threat=build_whitelist.THREAT_LEVELS["good"],
-                                       trust=build_whitelist.TRUST_LEVELS["high"])
+    hashed_files = image_hashes(fp)
+    try:
+        build_whitelist.store_hashes(hashed_files, source, build_whitelist.THREAT_LEVELS["good"],
+                                     build_whitelist.TRUST_LEVELS["high"])
+    finally:
+        hashed_files.close()
     # In case this script is run as sudo because of mounting, we want to change the owner to actual user
-    if os.environ["SUDO_USER"] and dbcreated:
+    if os.environ.get("SUDO_USER") and dbcreated:
         subprocess.check_call(["chown", "-R", "{}:{}".format(os.environ["SUDO_UID"], os.environ["SUDO_GID"]), hashdb])
         _log.info("Owner of %s set to %s:%s", hashdb,os.environ["SUDO_UID"], os.environ["SUDO_GID"])
-    if mounted:
-        filesystem.unmount_image(rootpath)
-    shutil.rmtree(rootpath)
-    _log.info("Temp dir %s deleted", rootpath)
-    _log.info("Done with image file: %s", fp)
+
+class DiskBudget():
+    """
+    Scratch space budget shared by the sources in progress. A source reserves space before it writes a download,
+    an extracted file or an unsparsed image, and releases all of it when it is done.
+    The oldest source that holds space never waits, even if that takes it over the budget. A source doesn't wait
+    either while an older source waits for a stage (see stall), the stage may be held by the source that reserves.
+    So the budget is soft by at most what one source needs, plus what sources reserve while an older one is stalled,
+    and sources can not wait on each other forever.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._held = {}
+        # Jobs waiting for a stage
+        self._stalled = set()
+        self._cond = threading.Condition()
+
+    def reserve(self, job, size):
+        with self._cond:
+            while (self._held and self.used + size > self.limit and job > min(self._held)
+                   and not any(other < job for other in self._stalled)):
+                self._cond.wait()
+            self._held[job] = self._held.get(job, 0) + size
+            self.used += size
+
+    def stall(self, job):
+        """
+        Mark job as waiting for a stage, until unstall. Younger jobs waiting for space go ahead meanwhile.
+        """
+        with self._cond:
+            self._stalled.add(job)
+            self._cond.notify_all()
+
+    def unstall(self, job):
+        with self._cond:
+            self._stalled.discard(job)
+
+    def release(self, job):
+        with self._cond:
+            self.used -= self._held.pop(job, 0)
+            self._cond.notify_all()
+
+class SourceScheduler():
+    """
+    Processes sources concurrently: every source is downloaded, extracted and its images hashed, like build does, with
+    the number of sources in each of these stages bounded. Scratch space is bounded by a DiskBudget. The hashes of all
+    sources go to one writer thread, the only one that touches the hash db. A source is marked in the sources db once
+    the writer has written all its files, after which its archive and extracted files are removed.
+    Sources are written in the order they get through their stages. A file that is in more than one source is stored
+    with the source that was written last, like in build, but that need not be the last one on the index page.
+    """
+    def __init__(self, hashdb, sourcesdb, downloads=2, extracts=1, processors=1, budget=None, queue_depth=8):
+        self.hashdb = hashdb
+        self.sourcesdb = sourcesdb
+        self._stages = {"download": threading.BoundedSemaphore(downloads),
+                        "extract": threading.BoundedSemaphore(extracts),
+                        "process": threading.BoundedSemaphore(processors)}
+        self.max_sources = downloads + extracts + processors
+        self.budget = DiskBudget(budget if budget is not None else int(shutil.disk_usage(TMPDIR).free * 0.9))
+        # (source sequence number, batch of items, or an Event to set once the earlier batches are written)
+        self._writequeue = queue.Queue(maxsize=queue_depth)
+        self._writer_error = None
+        self._sourcesif = None
+
+    @contextlib.contextmanager
+    def _stage(self, job, stage):
+        """
+        Hold the semaphore of stage. The budget knows while job waits for it, see DiskBudget.
+        """
+        semaphore = self._stages[stage]
+        if not semaphore.acquire(blocking=False):
+            self.budget.stall(job)
+            try:
+                semaphore.acquire()
+            finally:
+                self.budget.unstall(job)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def _writer(self):
+        while True:
+            (job, batch) = self._writequeue.get()
+            if batch is None:
+                break
+            if isinstance(batch, threading.Event):
+                batch.set()
+                continue
+            if self._writer_error:
+                continue
+            try:
+                build_whitelist.batch_write(batch)
+                metrics.count("files", len(batch))
+                metrics.progress()
+            except Exception as exc:
+                _log.exception("Writing a batch of source %d failed", job)
+                self._writer_error = exc
+
+    def _write(self, job, hashed_files, source_id):
+        batch_size = build_whitelist.batch_size()
+        batch = []
+        for (fp, hashes) in hashed_files:
+            batch.append((hashes, {"source_id": source_id,
+                                   "threat": build_whitelist.THREAT_LEVELS["good"],
+                                   "trust": build_whitelist.TRUST_LEVELS["high"],
+                                   "filepath": fp}))
+            if len(batch) >= batch_size:
+                self._writequeue.put((job, batch))
+                batch = []
+        if batch:
+            self._writequeue.put((job, batch))
+
+    def _flush(self, job):
+        written = threading.Event()
+        self._writequeue.put((job, written))
+        written.wait()
+        if self._writer_error:
+            raise Exception("Hash db writer failed") from self._writer_error
+
+    def _run_source(self, job, source_id, source, md5val):
+        if self._sourcesif.get(bytes(md5val, encoding="utf8")):
+            _log.info("Source processed!: %s", source)
+            return True
+        fn = get_filename(source)
+        fp = os.path.join(TMPDIR, fn)
+        untardir = os.path.join(TMPDIR, os.path.splitext(fn)[0])
+        reserve = functools.partial(self.budget.reserve, job)
+        done = False
+        try:
+            with self._stage(job, "download"):
+                _log.info("Downloading %s...", source)
+                fetch_source(source, md5val, fp, reserve)
+            with self._stage(job, "extract"):
+                img_filepaths = extract_source(fp, untardir, reserve)
+            for imgfp in img_filepaths:
+                with self._stage(job, "process"):
+                    hashed_files = image_hashes(imgfp, reserve)
+                    try:
+                        self._write(job, hashed_files, source_id)
+                    finally:
+                        hashed_files.close()
+            self._flush(job)
+            self._sourcesif.put(bytes(md5val, encoding="utf8"), _source_record(source_id, source))
+            metrics.count("sources")
+            _log.info("Source processed!: %s", source)
+            done = True
+        except Exception:
+            _log.exception("Processing %s failed", source)
+        finally:
+            if os.path.isdir(untardir):
+                shutil.rmtree(untardir)
+            # The archive is only needed again if the source failed
+            if done and os.path.exists(fp):
+                os.remove(fp)
+            self.budget.release(job)
+        return done
+
+    def run(self, sources):
+        """
+        :param sources: list of (source id, url, md5 string), as scrape_links returns
+        :return: number of sources that failed
+        """
+        build_whitelist.configure(dbpath=self.hashdb, dbif=plyvel.DB(self.hashdb, create_if_missing=True))
+        self._sourcesif = plyvel.DB(self.sourcesdb, create_if_missing=True)
+        # The hashing processes of all sources are forked before any thread runs
+        build_whitelist.start_pool()
+        writer = threading.Thread(target=self._writer)
+        writer.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.max_sources) as executor:
+                futures = [executor.submit(self._run_source, job, *source) for (job, source) in enumerate(sources)]
+                failed = sum(not future.result() for future in futures)
+        finally:
+            self._writequeue.put((None, None))
+            writer.join()
+            build_whitelist.close()
+            self._sourcesif.close()
+            build_whitelist.stop_pool()
+        metrics.progress(force=True)
+        _log.info("%d sources processed, %d failed", len(sources) - failed, failed)
+        return failed
+
+def build_concurrent(hashdb, sourcesdb, shard=None, index_url=INDEX_URL, **kwargs):
+    """
+    Like build, with the sources processed by a SourceScheduler. kwargs are passed to SourceScheduler.
+    :return: number of sources that failed
+    """
+    sources = _select_sources(index_url, shard)
+    _log.info("Using %s as sources database", sourcesdb)
+    return SourceScheduler(hashdb, sourcesdb, **kwargs).run(sources)
 
 def main():
+    global TMPDIR
     parser = argparse.ArgumentParser(description="Build a hash whitelist from the AOSP images. Downloads and processes the images found on AOSP website.")
     parser.add_argument("hashdb", help="Path to existing or non-existing leveldb database to store hashes")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of hashing processes for mounted images. 0 means one per core. Default: 1")
+    parser.add_argument("-s", "--shard", type=parse_shard, help="Only process shard INDEX/COUNT of the sources, e.g. 0/4. Merge the shard databases with android.merge")
+    parser.add_argument("-c", "--concurrent", action="store_true", help="Download, extract and process several sources at the same time")
+    parser.add_argument("--downloads", type=int, default=2, help="With -c, max number of sources downloading. Default: %(default)s")
+    parser.add_argument("--extracts", type=int, default=1, help="With -c, max number of sources extracting. Default: %(default)s")
+    parser.add_argument("--processors", type=int, default=1, help="With -c, max number of images hashed at the same time. Default: %(default)s")
+    parser.add_argument("--scratch-budget", type=parse_size, help="With -c, max scratch space in the temp dir for downloads, extracted and unsparsed images, like 50G. Default: 90%% of the free space")
+    parser.add_argument("--index-url", default=INDEX_URL, help="The index page with the image archives. Default: %(default)s")
+    parser.add_argument("--tempdir", default=TMPDIR, help="Directory for downloads and extracted images. Default: %(default)s")
+    parser.add_argument("--metrics", help="Write stage timings and counters to this file at exit, as json if it ends with .json, Prometheus text otherwise")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging, this logs every file")
     args = parser.parse_args()
-    logging.basicConfig(level=logging.INFO)
-    sourcesdb = os.path.splitext(args.hashdb.rstrip(os.path.sep))[0] + ".sources.db"
-    build(args.hashdb, sourcesdb)
-    pass
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    TMPDIR = args.tempdir
+    build_whitelist.configure(workers=args.jobs)
+    if args.metrics:
+        metrics.dump_at_exit(args.metrics)
+    if args.concurrent:
+        failed = build_concurrent(args.hashdb, sourcesdb_path(args.hashdb), shard=args.shard, index_url=args.index_url,
+                                  downloads=args.downloads, extracts=args.extracts, processors=args.processors,
+                                  budget=args.scratch_budget)
+        sys.exit(1 if failed else 0)
+    build(args.hashdb, sourcesdb_path(args.hashdb), shard=args.shard, index_url=args.index_url)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
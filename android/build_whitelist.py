@@ -5,32 +5,70 @@ import os
 import os.path
 import subprocess
 import hashlib
-import json
 import shutil
 import stat
+import collections
+import multiprocessing
+import queue
+import threading
+import concurrent.futures
+import mmap
+import time
 
 import plyvel
 
 from android import filesystem
 from android import simg2img
-
-TRUST_LEVELS = {"high":2, # Known good source
-                "medium":1, # Source probably good, but not verified
-                "low":0} # Source trust unknown
-
-THREAT_LEVELS = {"good":0,
-                 "evil":1}
+from android import ext4
+from android import yaffs
+from android import bloom
+from android import records
+from android import digestcache
+from android import sqldb
+from android import metrics
+from android.records import TRUST_LEVELS, THREAT_LEVELS
 
 _log = logging.getLogger()
 _tempdir = "/tmp"
 _config = {"tempdir":"/tmp",
           "dbpath": "hashes.db",
-          "dbif": None
+          "dbif": None,
+          "workers": 1, # Hashing processes for explore_filesystem, 1 hashes in the writer process, 0 one per core
+          "pool": None, # multiprocessing.Pool of the hashing processes to share, instead of one per tree
+          "queue_depth": 1024, # Max number of walked paths waiting to be hashed
+          "bloom": True, # Keep a bloom filter of the keys in the db next to it, to skip lookups of new hashes
+          "digest_cache": True, # Reuse the digests of files with an unchanged stat signature, from a cache next to the db
+          "verify": False, # Hash all files again, and check the digest cache
+          "cache_max_age": 30, # Days after which unseen files are evicted from the digest cache
+          "hash_buf_size": 1024 * 1024, # Read size for hashing
+          "mmap_threshold": 64 * 1024 * 1024, # Files of at least this size are hashed from an mmap
+          "batch_size": 1024 # Files per batch_write
           }
 
+# Number of files per task sent to a hashing process
+HASH_TASK_SIZE = 32
+
+BLOOM_STAMP_KEY = b"meta:bloom"
+BLOOM_MIN_CAPACITY = 1 << 20
+_bloom = {"dbpath": None, "dbif": None, "filter": None}
+_records = {"dbif": None, "store": None}
+
 def configure(**kwargs):
     _config.update(**kwargs)
 
+def batch_size():
+    """
+    :return: the configured number of files per batch_write
+    """
+    return _config["batch_size"]
+
+def close():
+    """
+    Save the bloom filter of the configured db and close the db.
+    """
+    _save_bloom()
+    _config["dbif"].close()
+
 def _update_value(curval, value):
    newval = {"filepath":value["filepath"],
              "source_id":value["source_id"],
@@ -40,75 +78,483 @@ def _update_value(curval, value):
 
    return newval
 
+def _bloom_path():
+    return _config["dbpath"].rstrip(os.path.sep) + ".bloom"
+
+def _build_bloom(dbif):
+    count = sum(1 for key in dbif.iterator(include_value=False) if records.is_hash_key(key))
+    bf = bloom.BloomFilter(max(2 * count, BLOOM_MIN_CAPACITY))
+    for key in dbif.iterator(include_value=False):
+        if records.is_hash_key(key):
+            bf.add(key)
+    _log.info("Bloom filter rebuilt from %d keys in db", count)
+    return bf
+
+def _get_bloom():
+    """
+    Bloom filter of the hash keys in the db. The filter is saved next to the db by _save_bloom, together with a
+    token that is also stored in the db. The token is removed from the db before it is changed, so a filter is only
+    used if nothing was written to the db since it was saved. Otherwise it is rebuilt from the db.
+    Writers that do not use batch_write should delete the .bloom file.
+    """
+    dbif = _config["dbif"]
+    if _bloom["dbif"] is dbif:
+        return _bloom["filter"]
+    stamp = dbif.get(BLOOM_STAMP_KEY)
+    bf = _bloom["filter"] if _bloom["dbpath"] == _config["dbpath"] else None
+    if stamp and not (bf and bf.token == stamp) and os.path.exists(_bloom_path()):
+        bf = bloom.BloomFilter.load(_bloom_path())
+        _log.info("Bloom filter with %d keys loaded from %s", bf.count, _bloom_path())
+    if not (stamp and bf and bf.token == stamp):
+        bf = _build_bloom(dbif)
+    if stamp:
+        dbif.delete(BLOOM_STAMP_KEY)
+    _bloom.update(dbpath=_config["dbpath"], dbif=dbif, filter=bf)
+    return bf
+
+def _save_bloom():
+    bf = _bloom["filter"]
+    if _bloom["dbif"] is not _config["dbif"]:
+        return
+    bf.token = os.urandom(16)
+    bf.save(_bloom_path())
+    _config["dbif"].put(BLOOM_STAMP_KEY, bf.token)
+    _bloom["dbif"] = None
+
+def _get_records():
+    dbif = _config["dbif"]
+    if _records["dbif"] is not dbif:
+        _records.update(dbif=dbif, store=records.RecordStore(dbif))
+    return _records["store"]
+
+def _count_keys(added, procd, dupl):
+    metrics.count("keys_processed", procd)
+    metrics.count("keys_duplicate", dupl)
+    metrics.count("keys_written", added)
+
 def batch_write(items, replace=True):
+    """
+    Write the hashes of a batch of files. Hashes that are in the db, or earlier in the batch, are duplicates. These are
+    replaced with the _update_value of the current value if replace is True, otherwise they are left alone.
+    :param items: list of (hashes, value)
+    :return: (number of keys written, number of hashes processed, number of duplicates)
+    """
     _log.debug("Batch write of %d items to %s", len(items), repr(_config["dbif"]))
+    dbif = _config["dbif"]
+    if isinstance(dbif, sqldb.SqlHashDb):
+        with metrics.timer("db_write"):
+            (num_added, num_procd, dupl) = dbif.batch_write(items, replace)
+        _count_keys(num_added, num_procd, dupl)
+        return num_added, num_procd, dupl
+    store = _get_records()
+    bf = _get_bloom() if _config["bloom"] else None
+    with metrics.timer("db_lookup"):
+        keys = sorted({hash for hashes, value in items for hash in hashes if not bf or hash in bf})
+        owners = {}
+        curvals = store.unpack_many(records.lookup_sorted(dbif, keys), owners)
+    _log.debug("%d of %d hashes looked up in db, %d found", len(keys),
+               sum(len(hashes) for hashes, value in items), len(curvals))
+    # Per key logging is only formatted when debugging is on
+    debug = _log.isEnabledFor(logging.DEBUG)
     num_added, num_procd, dupl = 0, 0, 0
-    with _config["dbif"].write_batch() as wb:
-        for hashes,value in items:
+    newvals = {}
+    for hashes,value in items:
+        for hash in hashes:
+            num_procd += 1
+            if hash in newvals:
+                curval = newvals[hash]
+            elif hash in curvals:
+                curval = curvals[hash]
+            else:
+                newvals[hash] = value
+                if debug:
+                    _log.debug("%r added to database", hash)
+                continue
+            dupl += 1
+            if not replace:
+                if debug:
+                    _log.debug("%r allready present in db, not added", hash)
+                newvals.setdefault(hash, curval)
+                continue
+            newvals[hash] = _update_value(curval, value)
+            if debug:
+                _log.debug("%r allready present in db, replaced with %s", hash, newvals[hash])
+    with metrics.timer("db_write"), dbif.write_batch() as wb:
+        # The digests of a file share a record of their own. A record that all digests of a file point to is replaced
+        # in place, one that no digest points to anymore is removed.
+        owner = {hash: record_id for (record_id, hashes) in owners.items() for hash in hashes}
+        written = set()
+        for hashes, _ in items:
+            groups = {}
             for hash in hashes:
-                num_procd += 1
-                curval = _config["dbif"].get(hash)
-                if curval:
-                    _log.info("%s allready present in db", repr(hash))
-                    dupl += 1
-                    if not replace:
-                        _log.info("not added")
-                        continue
-                    else:
-                        newval = _update_value(json.loads(str(curval, encoding="utf8")), value)
-                        wb.put(hash, bytes(json.dumps(newval), encoding="utf8"))
-                        num_added += 1
-                        _log.info("Replaced with %s", newval)
-                else:
-                    wb.put(hash, bytes(json.dumps(value), encoding="utf8"))
-                    _log.debug("%s added to database", repr(hash))
+                value = newvals[hash]
+                if hash in written or hash in curvals and curvals[hash] == value:
+                    continue
+                written.add(hash)
+                groups.setdefault((value["filepath"], value["source_id"], value["threat"], value["trust"]),
+                                  []).append(hash)
+            for group in groups.values():
+                value = newvals[group[0]]
+                num_added += len(group)
+                record_id = owner.get(group[0])
+                if (record_id is not None and owners[record_id] == set(group)
+                        and len(group) == len(records.HASH_KEY_SIZES)):
+                    store.pack(value, wb, owned=True, record_id=record_id)
+                    continue
+                packed = store.pack(value, wb, owned=True)
+                for hash in group:
+                    wb.put(hash, packed)
+                    if bf and hash not in curvals:
+                        bf.add(hash)
+                    owner.pop(hash, None)
+        # owner is left with the digests that still point to the record they did
+        for (record_id, hashes) in owners.items():
+            if len(hashes) == len(records.HASH_KEY_SIZES) and not any(owner.get(hash) == record_id for hash in hashes):
+                store.delete(record_id, wb)
+    if bf and bf.is_full():
+        _bloom["filter"] = _build_bloom(dbif)
+    _count_keys(num_added, num_procd, dupl)
     return num_added, num_procd, dupl
 
+# Upper bounds of the file size classes in the hashing statistics
+HASH_SIZE_CLASSES = ((64 * 1024, "<64K"), (1024 * 1024, "64K-1M"), (16 * 1024 * 1024, "1M-16M"),
+                     (256 * 1024 * 1024, "16M-256M"), (float("inf"), ">=256M"))
+# Size class -> [files, bytes, seconds]
+_hash_stats = {}
+_hash_local = threading.local()
+_hash_executor = {"pid": None, "executor": None}
+
+def _new_hashers():
+    return hashlib.md5(), hashlib.sha1(), hashlib.sha256()
+
+def _digest_executor():
+    # Not shared with forked processes, the threads of the parent do not exist there
+    if _hash_executor["pid"] != os.getpid():
+        _hash_executor.update(pid=os.getpid(), executor=concurrent.futures.ThreadPoolExecutor(3))
+    return _hash_executor["executor"]
+
+def _hash_buffers(size):
+    """
+    Two preallocated buffers per thread: one is read into while the digests of the other are computed.
+    """
+    if getattr(_hash_local, "size", None) != size:
+        _hash_local.size = size
+        _hash_local.buffers = (memoryview(bytearray(size)), memoryview(bytearray(size)))
+    return _hash_local.buffers
+
+def _update_all(hashers, view):
+    for hasher in hashers:
+        hasher.update(view)
+
+def _fill(readinto, view):
+    start = time.perf_counter()
+    filled = 0
+    while filled < len(view):
+        size = readinto(view[filled:])
+        if not size:
+            break
+        filled += size
+    metrics.add_time("read", time.perf_counter() - start)
+    return filled
+
+def _hash_chunks(readinto, hashers, bufsize):
+    """
+    Feed everything readinto returns to the hashers. Chunks after the first are hashed on three threads (hashlib
+    releases the GIL), while the next chunk is read.
+    """
+    buffers = _hash_buffers(bufsize)
+    size = _fill(readinto, buffers[0])
+    if size < bufsize:
+        _update_all(hashers, buffers[0][:size])
+        return size
+    total = 0
+    executor = _digest_executor()
+    futures = []
+    current = 0
+    while size:
+        view = buffers[current][:size]
+        total += size
+        for future in futures:
+            future.result()
+        futures = [executor.submit(hasher.update, view) for hasher in hashers]
+        current ^= 1
+        size = _fill(readinto, buffers[current])
+    for future in futures:
+        future.result()
+    return total
+
+def _hash_mmap(fd, size, hashers):
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            executor = _digest_executor()
+            for future in [executor.submit(hasher.update, view) for hasher in hashers]:
+                future.result()
+    return size
+
+def _record_hash_stats(name, size, seconds, method):
+    for (limit, sizeclass) in HASH_SIZE_CLASSES:
+        if size < limit:
+            break
+    stats = _hash_stats.setdefault(sizeclass, [0, 0, 0.0])
+    stats[0] += 1
+    stats[1] += size
+    stats[2] += seconds
+    metrics.add_time("hash", seconds)
+    metrics.count("files_hashed")
+    metrics.count("bytes", size)
+    _log.debug("Hashed %s, %d bytes in %.3fs, %.1f MB/s (%s)", name, size, seconds,
+               size / seconds / 1e6 if seconds else 0, method)
+
+def _merge_hash_stats(stats):
+    for (sizeclass, (files, size, seconds)) in stats.items():
+        total = _hash_stats.setdefault(sizeclass, [0, 0, 0.0])
+        total[0] += files
+        total[1] += size
+        total[2] += seconds
+
+def _log_hash_stats():
+    for (limit, sizeclass) in HASH_SIZE_CLASSES:
+        if sizeclass in _hash_stats:
+            (files, size, seconds) = _hash_stats[sizeclass]
+            _log.info("Hashed %d files of %s, %.1f MB in %.1fs, %.1f MB/s", files, sizeclass, size / 1e6, seconds,
+                      size / seconds / 1e6 if seconds else 0)
+    _hash_stats.clear()
+
+def hash_stream(fh):
+    start = time.perf_counter()
+    hashers = _new_hashers()
+    readinto = getattr(fh, "readinto", None)
+    if readinto is None:
+        def readinto(view):
+            blob = fh.read(len(view))
+            view[:len(blob)] = blob
+            return len(blob)
+    size = _hash_chunks(readinto, hashers, _config["hash_buf_size"])
+    _record_hash_stats(getattr(fh, "name", repr(fh)), size, time.perf_counter() - start, "stream")
+    return tuple(hasher.digest() for hasher in hashers)
+
 def hash_file(filepath):
+    """
+    :return: (md5, sha1, sha256) digests of the file. Big files are hashed from an mmap, others with readinto in
+    preallocated buffers. The three digests are computed on separate threads, unless the file fits in one buffer.
+    """
     _log.debug("Hashing %s", filepath)
-    with open(filepath, mode="br") as fh:
-        mmd5 = hashlib.md5()
-        msha1 = hashlib.sha1()
-        msha256 = hashlib.sha256()
-        blob = fh.read(1024*1024)
-        while blob:
-            mmd5.update(blob)
-            msha1.update(blob)
-            msha256.update(blob)
-            blob = fh.read(1024*1024)
-    return mmd5.digest(), msha1.digest(), msha256.digest()
+    start = time.perf_counter()
+    hashers = _new_hashers()
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if size >= _config["mmap_threshold"]:
+            method = "mmap"
+            size = _hash_mmap(fd, size, hashers)
+        else:
+            method = "readinto"
+            size = _hash_chunks(lambda view: os.readv(fd, [view]), hashers, _config["hash_buf_size"])
+    finally:
+        os.close(fd)
+    _record_hash_stats(filepath, size, time.perf_counter() - start, method)
+    return tuple(hasher.digest() for hasher in hashers)
+
+def _walk_paths(rootpath):
+    for (root, dirs, files) in os.walk(rootpath, followlinks=False):
+        for fl in files:
+            fp = os.path.join(root, fl)
+            _log.debug("Encountered file %s", fp)
+            st = os.lstat(fp)
+            if stat.S_ISLNK(st.st_mode):
+                _log.debug("%s is a symlink, so skipped", fp)
+                metrics.count("skipped")
+                continue
+            yield fp, st
+
+def _open_digest_cache():
+    if not _config["digest_cache"]:
+        return None
+    return digestcache.DigestCache(_config["dbpath"].rstrip(os.path.sep) + ".digestcache",
+                                   max_age=_config["cache_max_age"], verify=_config["verify"])
 
+def _cache_hashes(cache, fp, st, hashes):
+    if cache and not cache.put(st, hashes):
+        _log.warning("Digests of %s differ from the cached digests", fp)
+
+def _walk_files(rootpath, cache=None):
+    for (fp, st) in metrics.timed("walk", _walk_paths(rootpath)):
+        hashes = cache.get(st) if cache else None
+        if hashes is None:
+            hashes = hash_file(fp)
+            _cache_hashes(cache, fp, st, hashes)
+        else:
+            metrics.count("files_cached")
+        yield fp, hashes
+
+def _hash_files(filepaths):
+    """
+    Task of the hashing processes. The hashing statistics and metrics of the task are sent back with the digests.
+    """
+    _hash_stats.clear()
+    metrics.reset()
+    return [hash_file(fp) for fp in filepaths], dict(_hash_stats), metrics.snapshot()
+
+def _walker(rootpath, pathqueue):
+    try:
+        for entry in metrics.timed("walk", _walk_paths(rootpath)):
+            pathqueue.put(entry)
+    except BaseException as exc:
+        pathqueue.put(exc)
+    pathqueue.put(None)
+
+def _walk_files_parallel(rootpath, workers, queue_depth, cache=None, pool=None):
+    """
+    Like _walk_files, but a thread walks the tree into a bounded queue of paths and a pool of processes hashes them.
+    Results are yielded in walk order, so they are stored exactly like in serial mode.
+    :param pool: Pool of worker processes to use, a pool is started for the tree if None. A process that runs other
+    threads should start its pool before them, see the pool option of configure.
+    """
+    if pool is None:
+        # The pool is started before the walker thread, so no process is forked while the walker holds a lock
+        with multiprocessing.Pool(workers) as pool:
+            yield from _walk_files_parallel(rootpath, workers, queue_depth, cache, pool)
+        return
+    pathqueue = queue.Queue(maxsize=queue_depth)
+    walker = threading.Thread(target=_walker, args=(rootpath, pathqueue), daemon=True)
+    walker.start()
+    pending = collections.deque()
+    done = False
+    while not done or pending:
+        while not done and len(pending) < 2 * workers:
+            entries = []
+            while len(entries) < HASH_TASK_SIZE:
+                entry = pathqueue.get()
+                if isinstance(entry, BaseException):
+                    raise entry
+                if entry is None:
+                    done = True
+                    break
+                entries.append(entry)
+            if entries:
+                cached = [cache.get(st) if cache else None for (fp, st) in entries]
+                missing = [fp for ((fp, st), hashes) in zip(entries, cached) if hashes is None]
+                result = pool.apply_async(_hash_files, (missing,)) if missing else None
+                pending.append((entries, cached, result))
+        if pending:
+            (entries, cached, result) = pending.popleft()
+            hashed = []
+            if result:
+                (hashed, stats, taskmetrics) = result.get()
+                _merge_hash_stats(stats)
+                metrics.merge(taskmetrics)
+            hashed = iter(hashed)
+            for ((fp, st), hashes) in zip(entries, cached):
+                if hashes is None:
+                    hashes = next(hashed)
+                    _cache_hashes(cache, fp, st, hashes)
+                else:
+                    metrics.count("files_cached")
+                yield fp, hashes
+    walker.join()
 
+def _walk_entries(entries, rootpath):
+    for (path, mode, size, fh) in metrics.timed("walk", entries):
+        fp = os.path.join(rootpath, path)
+        _log.debug("Encountered file %s", fp)
+        if not stat.S_ISREG(mode):
+            _log.debug("%s is not a regular file, so skipped", fp)
+            metrics.count("skipped")
+            continue
+        yield fp, hash_stream(fh)
+
+def start_pool():
+    """
+    Start the configured number of hashing processes as a pool that all trees share, see the pool option. A process
+    that hashes trees from several threads calls this before it starts them, so it does not fork while they run.
+    :return: the pool, or None if files are hashed in this process
+    """
+    workers = _config["workers"]
+    if workers == 1:
+        return None
+    _config["pool"] = multiprocessing.Pool(workers or os.cpu_count())
+    return _config["pool"]
+
+def stop_pool():
+    pool = _config["pool"]
+    if pool:
+        pool.close()
+        pool.join()
+        _config["pool"] = None
+
+def hash_tree(rootpath, cache=None):
+    """
+    Walk a directory tree and hash its files, with the configured number of workers. Symlinks are skipped.
+    :param cache: digestcache.DigestCache to take digests of unchanged files from, or None
+    :return: generator of (filepath, (md5, sha1, sha256)), in walk order
+    """
+    workers = _config["workers"]
+    if workers == 1:
+        return _walk_files(rootpath, cache)
+    workers = workers or os.cpu_count()
+    _log.info("Hashing with %d processes", workers)
+    return _walk_files_parallel(rootpath, workers, _config["queue_depth"], cache, _config["pool"])
+
+def hash_entries(entries, rootpath):
+    """
+    Hash the regular files in entries.
+    :param entries: iterable of (path, mode, size, data stream), as yielded by cpio.iter_cpio
+    :param rootpath: Prefix for the returned file paths
+    :return: generator of (filepath, (md5, sha1, sha256))
+    """
+    return _walk_entries(entries, rootpath)
 
 def explore_filesystem(rootpath, sourceid=None, threat=None, trust=None):
-    dbif = _config["dbif"]
     _log.info("Exploring from root %s...", rootpath)
+    cache = _open_digest_cache()
+    hashed_files = hash_tree(rootpath, cache)
+    try:
+        store_hashes(hashed_files, sourceid, threat, trust)
+    finally:
+        if cache:
+            cache.close()
+
+def explore_entries(entries, rootpath, sourceid=None, threat=None, trust=None):
+    """
+    Like explore_filesystem, but for files that are not on disk, like the files in a ramdisk.
+    :param entries: iterable of (path, mode, size, data stream), as yielded by cpio.iter_cpio
+    :param rootpath: Prefix for the stored file paths
+    """
+    _log.info("Exploring entries as root %s...", rootpath)
+    store_hashes(hash_entries(entries, rootpath), sourceid, threat, trust)
 
-    batch_size = 1024
+def store_hashes(hashed_files, sourceid, threat, trust):
+    """
+    Write hashed files to the configured db in batches, then save the bloom filter and close the db.
+    :param hashed_files: iterable of (filepath, (md5, sha1, sha256)), like hash_tree returns
+    """
+    size = batch_size()
     batch = []
     total_added, total_procd, total_dupl = 0, 0, 0
-    for (root, dirs, files) in os.walk(rootpath, followlinks=False):
-        for fl in files:
-            fp = os.path.join(root, fl)
-            _log.info("Encountered file %s", fp)
-            if stat.S_ISLNK(os.lstat(fp).st_mode):
-                _log.info("Is symlink, so skipped")
-                continue
-            hashes = hash_file(fp)
-            batch.append((hashes, {"source_id": sourceid,
-                                   "threat":threat,
-                                   "trust":trust,
-                                   "filepath":fp}))
-            if len(batch) >= batch_size:
-                added, procd, dupl = batch_write(batch)
-                total_added, total_procd, total_dupl = total_added + added, total_procd + procd, total_dupl + dupl
-                batch = []
+    for fp, hashes in hashed_files:
+        batch.append((hashes, {"source_id": sourceid,
+                               "threat":threat,
+                               "trust":trust,
+                               "filepath":fp}))
+        metrics.count("files")
+        metrics.progress()
+        if len(batch) >= size:
+            added, procd, dupl = batch_write(batch)
+            total_added, total_procd, total_dupl = total_added + added, total_procd + procd, total_dupl + dupl
+            batch = []
     added, procd, dupl = batch_write(batch)
     total_added, total_procd, total_dupl = total_added + added, total_procd + procd, total_dupl + dupl
     _log.info("Done exploring!")
     _log.info("%d records processed", total_procd)
     _log.info("%d records allready in db", total_dupl)
-    dbif.close()
+    _log.info("%d records added or replaced", total_added)
+    metrics.progress(force=True)
+    _log_hash_stats()
+    close()
 
 def main():
     parser = argparse.ArgumentParser(description="Build hash list from images files or dirs")
@@ -119,12 +565,27 @@ def main():
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
     parser.add_argument("-o", "--output", default="hashes.db", help="The output database. If existing, the data is added. Default: hashes.db")
     parser.add_argument("-f", "--format", choices=["ldb", "sql"], default="ldb", help="The output format. Default: ldb")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of hashing processes. 0 means one per core. Default: 1")
+    parser.add_argument("-q", "--queue-depth", type=int, default=_config["queue_depth"], help="Max number of files waiting to be hashed. Default: %(default)s")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the digest cache next to the output database")
+    parser.add_argument("-b", "--hash-buf-size", type=int, default=_config["hash_buf_size"], help="Read size in bytes for hashing. Default: %(default)s")
+    parser.add_argument("--mmap-threshold", type=int, default=_config["mmap_threshold"], help="Hash files of at least this many bytes from an mmap. Default: %(default)s")
+    parser.add_argument("--metrics", help="Write stage timings and counters to this file at exit, as json if it ends with .json, Prometheus text otherwise")
+    parser.add_argument("--verify", action="store_true", help="Hash all files again, even when the digest cache has them, and report cached digests that differ")
     args = parser.parse_args()
     
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
     global _log
 
     _config["dbpath"] = args.output
+    _config["workers"] = args.jobs
+    _config["queue_depth"] = args.queue_depth
+    _config["digest_cache"] = not args.no_cache
+    _config["verify"] = args.verify
+    _config["hash_buf_size"] = args.hash_buf_size
+    _config["mmap_threshold"] = args.mmap_threshold
+    if args.metrics:
+        metrics.dump_at_exit(args.metrics)
     dbcreated = False
     if args.format == "ldb":
         if not os.path.exists(_config["dbpath"]):
@@ -132,39 +593,66 @@ def main():
         _config["dbif"] = plyvel.DB(_config["dbpath"], create_if_missing=True)
         _log.info("Connected to Ldb database %s", repr(_config["dbif"]))
     else:
-        raise Exception("db format not implemented")
+        if not os.path.exists(_config["dbpath"]):
+            dbcreated = True
+        _config["dbif"] = sqldb.SqlHashDb(_config["dbpath"])
+        _log.info("Connected to sqlite database %s", _config["dbpath"])
 
+    threat, trust = THREAT_LEVELS[args.threat], TRUST_LEVELS[args.trust]
     source = os.path.abspath(args.source)
     _log.info("New source: %s...", source)
     tempdir, mounted = False, False
+    ext4fs, yaffsimage, sparsereader = None, None, None
     if not os.path.exists(source):
         _log.error("Path does not exist")
     if os.path.isfile(source):
-        if filesystem.is_sparseext4(source):
+        fstypes = filesystem.detect(source)
+        image = source
+        if "sparse" in fstypes:
             _log.info("Smells like sparse ext4 image")
             curfp = source
             source = os.path.join(os.path.dirname(source), "unsparsed." + os.path.basename(source))
-            with open(curfp, "rb") as infd, open(source, "wb") as outfd:
-                simg2img.unsparse(infd, outfd)
-        if filesystem.is_yaffs_image(source):
-            _log.info("Smells like yaffs image")
-            rootpath = filesystem.unpack_yaffs(source)
+            sparsereader = simg2img.SparseImageReader(curfp)
+            fstypes = filesystem.detect_bytes(sparsereader.pread(filesystem.HEADER_SIZE, 0))
+            if "ext4" in fstypes:
+                image = sparsereader
+            else:
+                with open(curfp, "rb") as infd, open(source, "wb") as outfd:
+                    simg2img.unsparse(infd, outfd)
+                image = source
+        if "yaffs" in fstypes:
+            _log.info("Smells like yaffs image, reading it without unyaffs")
+            yaffsimage = yaffs.Yaffs2Image(image)
+            rootpath = os.path.join(_config["tempdir"], os.path.basename(source))
+        elif "ext4" in fstypes:
+            _log.info("Smells like ext4 image, reading it without mounting")
+            ext4fs = ext4.Ext4Filesystem(image)
+            rootpath = os.path.join(_config["tempdir"], os.path.basename(source))
         else:
             _log.info("Doesn't smell familier, i'll try to mount")
-            rootpath = filesystem.mount_image(source)
-            mounted = True
-        tempdir = True
+            rootpath = filesystem.mount_image(source, _config["tempdir"])
+            mounted, tempdir = True, True
     else:
         _log.info("assuming this the root of file tree")
         rootpath = source
 
-    explore_filesystem(rootpath, sourceid=args.id, threat=args.threat, trust=args.trust)
+    if ext4fs:
+        entries = ((path, inode.mode, size, fh) for (path, inode, size, fh) in ext4fs.walk(physical_order=True))
+        explore_entries(entries, rootpath, sourceid=args.id, threat=threat, trust=trust)
+        ext4fs.close()
+    elif yaffsimage:
+        explore_entries(yaffsimage.walk(), rootpath, sourceid=args.id, threat=threat, trust=trust)
+        yaffsimage.close()
+    else:
+        explore_filesystem(rootpath, sourceid=args.id, threat=threat, trust=trust)
+    if sparsereader:
+        sparsereader.close()
     # In case this script is run as sudo because of mounting, we want to change the owner to actual user
-    if os.environ["SUDO_USER"] and dbcreated:
+    if os.environ.get("SUDO_USER") and dbcreated:
         subprocess.check_call(["chown", "-R", "{}:{}".format(os.environ["SUDO_UID"], os.environ["SUDO_GID"]), _config["dbpath"]])
         _log.info("Owner of %s set to %s:%s", _config["dbpath"],os.environ["SUDO_UID"], os.environ["SUDO_GID"])
     if mounted:
-        mounting.unmount_image(rootpath)
+        filesystem.unmount_image(rootpath)
     if tempdir:
         shutil.rmtree(rootpath)
         _log.info("Temp dir %s deleted", rootpath)
@@ -0,0 +1,185 @@
+__author__ = 'ivo'
+
+"""
+Check files against a hash whitelist database. The source can be a directory, an image file (ext4, sparse ext4,
+yaffs2 or boot image, read in process), any other file, or a list of hex digests (one per line, optionally followed
+by a file name, like md5sum output).
+Files are hashed like build_whitelist does and looked up in sorted batches, in the database itself or through a
+lookupd server.
+
+Prints a line per file: KNOWN or UNKNOWN, the path, and for known files the path and source id in the database.
+The exit status is 1 if there were unknown files, 2 for usage errors and malformed lines in a list of hex digests.
+
+Example:
+    python -m android.check /mnt/system -o hashes.db
+    python -m android.check system.img -f hset -o hashes.hset
+    md5sum suspicious/* | python -m android.check - --hash-list -s /tmp/whitelist.sock
+"""
+
+import argparse
+import binascii
+import itertools
+import json
+import logging
+import os
+import stat
+import sys
+
+import plyvel
+
+from android import bootimg
+from android import build_whitelist
+from android import ext4
+from android import filesystem
+from android import hashset
+from android import lookupd
+from android import records
+from android import simg2img
+from android import sqldb
+from android import yaffs
+
+_log = logging.getLogger()
+
+BATCH_SIZE = 1024
+
+def _image_entries(imagepath):
+    """
+    Open an image that can be read in process.
+    :return: (entries, opened objects to close), or None if the file is not such an image
+    """
+    opened = []
+    image = imagepath
+    fstypes = filesystem.detect(imagepath)
+    if "sparse" in fstypes:
+        image = simg2img.SparseImageReader(imagepath)
+        opened.append(image)
+        fstypes = filesystem.detect_bytes(image.pread(filesystem.HEADER_SIZE, 0))
+    if "ext4" in fstypes:
+        ext4fs = ext4.Ext4Filesystem(image)
+        opened.append(ext4fs)
+        entries = ((path, inode.mode, size, fh) for (path, inode, size, fh) in ext4fs.walk(physical_order=True))
+    elif "yaffs" in fstypes:
+        yaffsimage = yaffs.Yaffs2Image(image)
+        opened.append(yaffsimage)
+        entries = yaffsimage.walk()
+    elif "boot" in fstypes:
+        bootimage = bootimg.BootImage(imagepath)
+        opened.append(bootimage)
+        entries = itertools.chain(bootimg.iter_ramdisk(bootimage.ramdisk),
+                                  [("vmlinuz", stat.S_IFREG | 0o644, len(bootimage.kernel),
+                                    bootimg.BufferReader(bootimage.kernel))])
+    else:
+        for obj in opened:
+            obj.close()
+        return None
+    return entries, opened
+
+def read_hash_list(fh):
+    """
+    :param fh: Text file with a hex digest per line, optionally followed by a file name
+    :return: generator of (name, (digest,)), the name is the digest if the line has no file name
+    :raise ValueError: at a line that does not start with a digest, with the line number in the message
+    """
+    for (lineno, line) in enumerate(fh, 1):
+        fields = line.split(None, 1)
+        if not fields or fields[0].startswith("#"):
+            continue
+        try:
+            digest = binascii.unhexlify(fields[0])
+        except binascii.Error as exc:
+            raise ValueError("Line {}: not a hex digest: {} ({})".format(lineno, fields[0], exc))
+        if not records.is_hash_key(digest):
+            raise ValueError("Line {}: not an md5, sha1 or sha256 digest: {}".format(lineno, fields[0]))
+        name = fields[1].strip().lstrip("*") if len(fields) > 1 else fields[0]
+        yield name, (digest,)
+
+def check(hashed_files, lookup_many, batch_size=BATCH_SIZE):
+    """
+    Look up hashed files in batches.
+    :param hashed_files: iterable of (name, digests)
+    :param lookup_many: function that takes digests and returns a dict of digest -> record for the known ones
+    :return: generator of (name, record or None), in the order of hashed_files
+    """
+    hashed_files = iter(hashed_files)
+    while True:
+        batch = list(itertools.islice(hashed_files, batch_size))
+        if not batch:
+            break
+        found = lookup_many([digest for (name, digests) in batch for digest in digests])
+        for (name, digests) in batch:
+            yield name, next((found[digest] for digest in reversed(digests) if digest in found), None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check files against a hash whitelist")
+    parser.add_argument("source", help="Directory, image file, file, or file with hex digests (- for stdin, with --hash-list)")
+    parser.add_argument("-o", "--database", default="hashes.db", help="The hash database. Default: hashes.db")
+    parser.add_argument("-f", "--format", choices=["ldb", "sql", "hset"], default="ldb", help="The database format, hset is a hash set file exported with android.hashset. Default: ldb")
+    parser.add_argument("-s", "--server", help="Ask a lookupd server at this unix socket path or [host:]port instead of opening the database")
+    parser.add_argument("-H", "--hash-list", action="store_true", help="The source is a list of hex digests")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of hashing processes for directories. 0 means one per core. Default: 1")
+    parser.add_argument("-u", "--unknown", action="store_true", help="Only print unknown files")
+    parser.add_argument("--json", action="store_true", help="Print a json object per file")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    build_whitelist.configure(workers=args.jobs)
+
+    if args.server:
+        client = lookupd.LookupClient(args.server)
+        lookup_many, closedb = client.lookup_many, client.close
+    elif args.format == "sql":
+        sqlif = sqldb.SqlHashDb(args.database)
+        lookup_many, closedb = sqlif.get_many, sqlif.close
+    elif args.format == "hset":
+        hset = hashset.HashSet(args.database)
+        lookup_many, closedb = hset.get_many, hset.close
+    else:
+        dbif = plyvel.DB(args.database)
+        lookup_many, closedb = records.RecordStore(dbif).get_many, dbif.close
+
+    opened = []
+    source = args.source
+    if args.hash_list:
+        fh = sys.stdin if source == "-" else open(source)
+        opened.append(fh)
+        hashed_files = read_hash_list(fh)
+    elif os.path.isdir(source):
+        hashed_files = build_whitelist.hash_tree(source)
+    else:
+        image = _image_entries(source)
+        if image:
+            (entries, opened) = image
+            hashed_files = build_whitelist.hash_entries(entries, source)
+        else:
+            hashed_files = [(source, build_whitelist.hash_file(source))]
+
+    total, unknown = 0, 0
+    try:
+        for (name, record) in check(hashed_files, lookup_many):
+            total += 1
+            if record is None:
+                unknown += 1
+            elif args.unknown:
+                continue
+            if args.json:
+                print(json.dumps({"path": name, "known": record is not None, "record": record}))
+            elif record is None:
+                print("UNKNOWN\t{}".format(name))
+            else:
+                print("KNOWN\t{}\t{}\t{}".format(name, record["filepath"], record["source_id"]))
+    except ValueError as exc:
+        if not args.hash_list:
+            raise
+        # Not the status of unknown files
+        parser.error("{}: {}".format(source, exc))
+    finally:
+        for obj in opened:
+            if obj is not sys.stdin:
+                obj.close()
+        closedb()
+    _log.info("%d files checked, %d unknown", total, unknown)
+    sys.exit(1 if unknown else 0)
+
+if __name__ == "__main__":
+    main()
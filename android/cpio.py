@@ -0,0 +1,122 @@
+__author__ = 'ivo'
+
+"""
+Streaming reader for cpio archives in the "new ascii" (newc) format, as used for Android ramdisks (initramfs).
+Entries are read straight from a (decompressing) stream, nothing is extracted to disk.
+
+From the cpio(5) man page:
+    struct cpio_newc_header {
+        char    c_magic[6];     "070701" (or "070702" with checksum)
+        char    c_ino[8];
+        char    c_mode[8];
+        char    c_uid[8];
+        char    c_gid[8];
+        char    c_nlink[8];
+        char    c_mtime[8];
+        char    c_filesize[8];
+        char    c_devmajor[8];
+        char    c_devminor[8];
+        char    c_rdevmajor[8];
+        char    c_rdevminor[8];
+        char    c_namesize[8];  including the trailing NUL
+        char    c_check[8];
+    };
+All numbers are hex. The name follows the header, padded to a multiple of 4 bytes counting the header. The file
+data follows the name, padded to a multiple of 4 bytes. The archive ends with an entry named TRAILER!!!.
+"""
+
+import io
+import logging
+import struct
+
+_log = logging.getLogger(__name__)
+
+NEWC_MAGICS = (b"070701", b"070702")
+TRAILER = "TRAILER!!!"
+
+class CpioNewcHeader():
+    format = "6s8s8s8s8s8s8s8s8s8s8s8s8s8s"
+    structlen = struct.calcsize(format)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        ch = cls()
+        fields = struct.unpack(cls.format, blob)
+        ch.magic = fields[0]
+        if ch.magic not in NEWC_MAGICS:
+            raise Exception("Bad cpio magic {}".format(repr(ch.magic)))
+        (ch.ino, ch.mode, ch.uid, ch.gid, ch.nlink, ch.mtime, ch.filesize, ch.devmajor, ch.devminor,
+         ch.rdevmajor, ch.rdevminor, ch.namesize, ch.check) = [int(field, 16) for field in fields[1:]]
+        return ch
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, vars(self))
+
+def _pad4(size):
+    return (4 - size % 4) % 4
+
+def _read_exact(fh, size):
+    blob = fh.read(size)
+    while len(blob) < size:
+        more = fh.read(size - len(blob))
+        if not more:
+            raise Exception("Truncated cpio archive")
+        blob += more
+    return blob
+
+def _skip(fh, size):
+    while size:
+        blob = fh.read(min(size, 1024 * 1024))
+        if not blob:
+            raise Exception("Truncated cpio archive")
+        size -= len(blob)
+
+class CpioEntryReader(io.RawIOBase):
+    """
+    File object for the data of one entry. Only valid until the next entry is requested.
+    """
+    def __init__(self, fh, size):
+        super().__init__()
+        self._fh = fh
+        self.size = size
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        size = min(len(view), self.remaining)
+        if not size:
+            return 0
+        blob = self._fh.read(size)
+        if not blob:
+            raise Exception("Truncated cpio archive")
+        view[:len(blob)] = blob
+        self.remaining -= len(blob)
+        return len(blob)
+
+def iter_cpio(fh):
+    """
+    Iterate over the entries of one or more concatenated newc cpio archives.
+    Yields (path, mode, size, data stream). The data stream is only valid until the next entry; unread data is
+    skipped. Symlinks have the link target as data.
+    """
+    while True:
+        # Archives are padded, often to 512 bytes. Look for the start of the next one.
+        blob = fh.read(4)
+        while blob == b"\x00\x00\x00\x00":
+            blob = fh.read(4)
+        if not blob:
+            return
+        blob += _read_exact(fh, CpioNewcHeader.structlen - len(blob))
+        header = CpioNewcHeader.from_bytes(blob)
+        name = _read_exact(fh, header.namesize + _pad4(CpioNewcHeader.structlen + header.namesize))
+        name = str(name[:header.namesize].rstrip(b"\x00"), encoding="utf8", errors="surrogateescape")
+        if name == TRAILER:
+            continue
+        reader = CpioEntryReader(fh, header.filesize)
+        path = name[2:] if name.startswith("./") else name
+        if path and path != ".":
+            yield path, header.mode, header.filesize, reader
+        _skip(fh, reader.remaining + _pad4(header.filesize))
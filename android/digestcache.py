@@ -0,0 +1,130 @@
+__author__ = 'ivo'
+
+"""
+Persistent cache of file digests, keyed by the stat signature of the file, so unchanged files are not read again
+when a tree is rescanned.
+
+Layout (leveldb):
+    struct ">QQQq" (st_dev, st_ino, st_size, st_mtime_ns) -> md5 + sha1 + sha256 digests + struct "<I" (day last seen)
+    b"meta:evicted" -> struct "<I" (day of the last eviction sweep)
+Days are days since the epoch. Entries that were not seen for max_age days are evicted, at most one sweep per day.
+"""
+
+import logging
+import struct
+import time
+
+import plyvel
+
+_log = logging.getLogger(__name__)
+
+KEY_FORMAT = ">QQQq"
+DIGEST_SIZES = (16, 20, 32)
+DIGESTS_SIZE = sum(DIGEST_SIZES)
+DAY_FORMAT = "<I"
+EVICTED_KEY = b"meta:evicted"
+WRITE_BATCH_SIZE = 1024
+
+def _today():
+    return int(time.time() // 86400)
+
+def stat_key(st):
+    return struct.pack(KEY_FORMAT, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+class DigestCache():
+    def __init__(self, path, max_age=30, verify=False):
+        """
+        :param path: Path of the cache database, created if missing
+        :param max_age: Days after which an entry that was not seen is evicted
+        :param verify: If True, get never returns a hit, so all files are hashed again. put checks the new digests
+        against the cached ones.
+        """
+        self.path = path
+        self.max_age = max_age
+        self.verify = verify
+        self.today = _today()
+        self.hits, self.misses, self.mismatches = 0, 0, 0
+        self._db = plyvel.DB(path, create_if_missing=True)
+        self._wb = self._db.write_batch()
+        self._pending = 0
+
+    def _put(self, key, value):
+        self._wb.put(key, value)
+        self._pending += 1
+        if self._pending >= WRITE_BATCH_SIZE:
+            self._wb.write()
+            self._wb = self._db.write_batch()
+            self._pending = 0
+
+    def _pack(self, hashes):
+        return b"".join(hashes) + struct.pack(DAY_FORMAT, self.today)
+
+    def _unpack(self, value):
+        hashes = []
+        offset = 0
+        for size in DIGEST_SIZES:
+            hashes.append(value[offset:offset + size])
+            offset += size
+        (day,) = struct.unpack_from(DAY_FORMAT, value, offset)
+        return tuple(hashes), day
+
+    def get(self, st):
+        """
+        :param st: os.stat_result of the file
+        :return: (md5, sha1, sha256) digests, or None if the file is not in the cache or verify is set
+        """
+        if self.verify:
+            return None
+        key = stat_key(st)
+        value = self._db.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        (hashes, day) = self._unpack(value)
+        if day != self.today:
+            self._put(key, self._pack(hashes))
+        return hashes
+
+    def put(self, st, hashes):
+        """
+        Store the digests of a file.
+        :return: False if verify is set and the cache had different digests for the file, otherwise True
+        """
+        key = stat_key(st)
+        consistent = True
+        if self.verify:
+            value = self._db.get(key)
+            if value is not None and self._unpack(value)[0] != tuple(hashes):
+                self.mismatches += 1
+                consistent = False
+        self._put(key, self._pack(hashes))
+        return consistent
+
+    def evict(self):
+        """
+        Delete the entries that were not seen in the last max_age days.
+        :return: Number of evicted entries
+        """
+        oldest = self.today - self.max_age
+        evicted = 0
+        with self._db.write_batch() as wb:
+            for (key, value) in self._db.iterator():
+                if key == EVICTED_KEY:
+                    continue
+                if self._unpack(value)[1] < oldest:
+                    wb.delete(key)
+                    evicted += 1
+            wb.put(EVICTED_KEY, struct.pack(DAY_FORMAT, self.today))
+        _log.info("%d stale entries evicted from digest cache %s", evicted, self.path)
+        return evicted
+
+    def close(self):
+        self._wb.write()
+        lastevicted = self._db.get(EVICTED_KEY)
+        if lastevicted is None or struct.unpack(DAY_FORMAT, lastevicted)[0] < self.today:
+            self.evict()
+        _log.info("Digest cache: %d hits, %d misses", self.hits, self.misses)
+        if self.mismatches:
+            _log.warning("Digest cache: %d files had different digests than cached", self.mismatches)
+        self._db.close()
@@ -0,0 +1,387 @@
+__author__ = 'ivo'
+
+"""
+Read only ext4 (and ext2/ext3) image parser in pure python, so images can be walked and hashed without root,
+mount or loop devices. Works on anything seekable: a file object, an mmap, bytes or a simg2img.SparseImageReader.
+
+Supported: superblock, 32 and 64 bit group descriptors, extent trees, indirect block maps, inline data, linear and
+htree directories (htree index blocks look like empty directory blocks).
+Not supported: meta_bg, encryption and compression.
+
+Layout, from the ext4 disk layout documentation:
+- The superblock is at offset 1024. The group descriptor table starts in the block after the superblock.
+- Inode n is in group (n - 1) / inodes_per_group, at index (n - 1) % inodes_per_group of that group's inode table.
+- Inode 2 is the root directory.
+"""
+
+import bisect
+import io
+import logging
+import mmap
+import os
+import stat
+import struct
+
+_log = logging.getLogger(__name__)
+
+SUPERBLOCK_OFFSET = 1024
+EXT4_MAGIC = 0xEF53
+ROOT_INODE = 2
+
+INCOMPAT_COMPRESSION = 0x1
+INCOMPAT_FILETYPE = 0x2
+INCOMPAT_META_BG = 0x10
+INCOMPAT_EXTENTS = 0x40
+INCOMPAT_64BIT = 0x80
+INCOMPAT_INLINE_DATA = 0x8000
+INCOMPAT_ENCRYPT = 0x10000
+UNSUPPORTED_INCOMPAT = INCOMPAT_COMPRESSION | INCOMPAT_META_BG | INCOMPAT_ENCRYPT
+
+INODE_FLAG_EXTENTS = 0x80000
+INODE_FLAG_INLINE_DATA = 0x10000000
+
+XATTR_MAGIC = 0xEA020000
+XATTR_INDEX_SYSTEM = 7
+
+EXTENT_MAGIC = 0xF30A
+EXTENT_MAX_INIT_LEN = 32768
+
+class Superblock():
+    @classmethod
+    def from_bytes(cls, blob):
+        sb = cls()
+        (sb.inodes_count, sb.blocks_count_lo, sb.first_data_block, sb.log_block_size,
+         sb.blocks_per_group, sb.inodes_per_group) = struct.unpack_from("<II12xII4xI4xI", blob, 0)
+        (sb.magic,) = struct.unpack_from("<H", blob, 0x38)
+        (sb.rev_level,) = struct.unpack_from("<I", blob, 0x4C)
+        (sb.inode_size,) = struct.unpack_from("<H", blob, 0x58)
+        (sb.feature_compat, sb.feature_incompat, sb.feature_ro_compat) = struct.unpack_from("<III", blob, 0x5C)
+        (sb.volume_name,) = struct.unpack_from("<16s", blob, 0x78)
+        (sb.desc_size,) = struct.unpack_from("<H", blob, 0xFE)
+        (sb.blocks_count_hi,) = struct.unpack_from("<I", blob, 0x150)
+        if sb.rev_level == 0:
+            sb.inode_size = 128
+        sb.block_size = 1024 << sb.log_block_size
+        if not sb.feature_incompat & INCOMPAT_64BIT:
+            sb.desc_size = 32
+            sb.blocks_count_hi = 0
+        sb.blocks_count = sb.blocks_count_lo | (sb.blocks_count_hi << 32)
+        return sb
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, vars(self))
+
+class Inode():
+    def __init__(self, number, blob):
+        self.number = number
+        (self.mode, self.size_lo) = struct.unpack_from("<H2xI", blob, 0)
+        (self.links_count,) = struct.unpack_from("<H", blob, 0x1A)
+        (self.flags,) = struct.unpack_from("<I", blob, 0x20)
+        self.block = bytes(blob[0x28:0x28 + 60])
+        (self.size_high,) = struct.unpack_from("<I", blob, 0x6C)
+        self.size = self.size_lo | (self.size_high << 32)
+        self._blob = blob
+
+    def inline_data(self):
+        """
+        Data of an inode with the inline data flag: the 60 bytes of i_block, followed by the value of the system.data
+        extended attribute in the inode.
+        """
+        data = self.block
+        extra_isize = struct.unpack_from("<H", self._blob, 0x80)[0] if len(self._blob) > 0x80 else 0
+        offset = 0x80 + extra_isize
+        if offset + 4 <= len(self._blob) and struct.unpack_from("<I", self._blob, offset)[0] == XATTR_MAGIC:
+            start = offset + 4
+            entry = start
+            while entry + 16 <= len(self._blob):
+                (name_len, name_index, value_offs, value_inum, value_size) = struct.unpack_from("<BBHII", self._blob,
+                                                                                             entry)
+                if not name_len and not name_index and not value_offs:
+                    break
+                name = self._blob[entry + 16:entry + 16 + name_len]
+                if name_index == XATTR_INDEX_SYSTEM and name == b"data":
+                    data += bytes(self._blob[start + value_offs:start + value_offs + value_size])
+                    break
+                entry += (16 + name_len + 3) // 4 * 4
+        return data
+
+    def is_reg(self):
+        return stat.S_ISREG(self.mode)
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.mode)
+
+    def __repr__(self):
+        return "<{}({}, mode {:o}, {} bytes)>".format(self.__class__.__name__, self.number, self.mode, self.size)
+
+def _make_pread(source):
+    """
+    :return: function pread(offset, size) -> bytes for the source
+    """
+    if hasattr(source, "pread"):
+        return lambda offset, size: source.pread(size, offset)
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return lambda offset, size: bytes(source[offset:offset + size])
+    try:
+        fd = source.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            return lambda offset, size: os.pread(fd, size, offset)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    def pread(offset, size):
+        source.seek(offset)
+        return source.read(size)
+    return pread
+
+class Ext4File(io.RawIOBase):
+    """
+    File object for the data of an inode. Holes and uninitialized extents read as zeroes.
+    """
+    def __init__(self, fs, inode):
+        super().__init__()
+        self.fs = fs
+        self.inode = inode
+        self.size = inode.size
+        self._pos = 0
+        self._inline = None
+        if inode.flags & INODE_FLAG_INLINE_DATA:
+            self._inline = inode.inline_data()
+            if not inode.is_dir():
+                self._inline = self._inline[:inode.size]
+            self.size = len(self._inline)
+            self.extents = []
+        elif inode.is_symlink() and inode.size < 60 and not inode.flags & INODE_FLAG_EXTENTS:
+            self._inline = inode.block[:inode.size]
+            self.extents = []
+        else:
+            # Sorted list of (logical block, physical block, number of blocks, initialized)
+            self.extents = fs._map_blocks(inode)
+        self._starts = [extent[0] for extent in self.extents]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+        return self._pos
+
+    def first_physical_block(self):
+        return self.extents[0][1] if self.extents else 0
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        length = max(0, min(len(view), self.size - self._pos))
+        if self._inline is not None:
+            view[:length] = self._inline[self._pos:self._pos + length]
+            self._pos += length
+            return length
+        block_size = self.fs.block_size
+        done = 0
+        while done < length:
+            pos = self._pos + done
+            lblock = pos // block_size
+            i = bisect.bisect_right(self._starts, lblock) - 1
+            if i >= 0 and lblock < self.extents[i][0] + self.extents[i][2]:
+                (start, pblock, count, initialized) = self.extents[i]
+                end = (start + count) * block_size
+            else:
+                # Hole up to the next extent
+                initialized = False
+                end = self.extents[i + 1][0] * block_size if i + 1 < len(self.extents) else self.size
+            size = min(end - pos, length - done)
+            if initialized:
+                blob = self.fs.pread(pblock * block_size + pos - start * block_size, size)
+                if len(blob) != size:
+                    raise Exception("Read beyond end of image (inode {})".format(self.inode.number))
+                view[done:done + size] = blob
+            else:
+                view[done:done + size] = bytes(size)
+            done += size
+        self._pos += length
+        return length
+
+class Ext4Filesystem():
+    """
+    A read only ext4 file system in an image.
+    """
+    def __init__(self, source):
+        """
+        :param source: Path, seekable binary file object, mmap, bytes or object with a pread(size, offset) method
+        """
+        self._fh = open(source, "rb") if isinstance(source, str) else None
+        self.pread = _make_pread(self._fh or source)
+        self.superblock = Superblock.from_bytes(self.pread(SUPERBLOCK_OFFSET, 1024))
+        sb = self.superblock
+        if sb.magic != EXT4_MAGIC:
+            raise Exception("Bad ext4 magic 0x{:04x}".format(sb.magic))
+        if sb.feature_incompat & UNSUPPORTED_INCOMPAT:
+            raise Exception("Unsupported ext4 features 0x{:x}".format(sb.feature_incompat & UNSUPPORTED_INCOMPAT))
+        self.block_size = sb.block_size
+        num_groups = (sb.blocks_count - sb.first_data_block + sb.blocks_per_group - 1) // sb.blocks_per_group
+        gdt = self.pread((sb.first_data_block + 1) * self.block_size, num_groups * sb.desc_size)
+        self.inode_tables = []
+        for group in range(num_groups):
+            offset = group * sb.desc_size
+            (table_lo,) = struct.unpack_from("<I", gdt, offset + 0x8)
+            table_hi = struct.unpack_from("<I", gdt, offset + 0x28)[0] if sb.desc_size >= 64 else 0
+            self.inode_tables.append(table_lo | (table_hi << 32))
+        _log.debug("Opened ext4 file system: %s", repr(sb))
+
+    def close(self):
+        if self._fh:
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def inode(self, number):
+        sb = self.superblock
+        (group, index) = divmod(number - 1, sb.inodes_per_group)
+        offset = self.inode_tables[group] * self.block_size + index * sb.inode_size
+        return Inode(number, self.pread(offset, sb.inode_size))
+
+    def open(self, inode):
+        """
+        :param inode: Inode or inode number
+        :return: Ext4File with the data of the inode
+        """
+        if not isinstance(inode, Inode):
+            inode = self.inode(inode)
+        return Ext4File(self, inode)
+
+    def _map_blocks(self, inode):
+        if inode.flags & INODE_FLAG_EXTENTS:
+            extents = []
+            self._walk_extent_node(inode.block, extents, inode.number)
+        else:
+            extents = self._walk_block_map(inode)
+        extents.sort()
+        return extents
+
+    def _walk_extent_node(self, node, extents, number):
+        (magic, entries, max_entries, depth) = struct.unpack_from("<HHHH", node, 0)
+        if magic != EXTENT_MAGIC:
+            raise Exception("Bad extent header in inode {}".format(number))
+        for i in range(entries):
+            offset = 12 + i * 12
+            if depth == 0:
+                (lblock, length, start_hi, start_lo) = struct.unpack_from("<IHHI", node, offset)
+                initialized = length <= EXTENT_MAX_INIT_LEN
+                if not initialized:
+                    length -= EXTENT_MAX_INIT_LEN
+                extents.append((lblock, start_lo | (start_hi << 32), length, initialized))
+            else:
+                (lblock, leaf_lo, leaf_hi) = struct.unpack_from("<IIH", node, offset)
+                child = self.pread((leaf_lo | (leaf_hi << 32)) * self.block_size, self.block_size)
+                self._walk_extent_node(child, extents, number)
+
+    def _walk_block_map(self, inode):
+        # ext2/3 style: 12 direct blocks, then single, double and triple indirect blocks
+        per_block = self.block_size // 4
+        num_blocks = (inode.size + self.block_size - 1) // self.block_size
+        pointers = struct.unpack_from("<15I", inode.block)
+        extents = []
+        def add(lblock, pblock):
+            if extents and extents[-1][0] + extents[-1][2] == lblock and extents[-1][1] + extents[-1][2] == pblock:
+                extents[-1] = (extents[-1][0], extents[-1][1], extents[-1][2] + 1, True)
+            else:
+                extents.append((lblock, pblock, 1, True))
+        def walk(pblock, level, lblock):
+            if level == 0:
+                if pblock:
+                    add(lblock, pblock)
+                return
+            span = per_block ** level
+            if not pblock:
+                return
+            table = struct.unpack("<{}I".format(per_block), self.pread(pblock * self.block_size, self.block_size))
+            for i, child in enumerate(table):
+                if lblock + i * (span // per_block) >= num_blocks:
+                    break
+                walk(child, level - 1, lblock + i * (span // per_block))
+        for i in range(12):
+            walk(pointers[i], 0, i)
+        lblock = 12
+        for level in (1, 2, 3):
+            if lblock >= num_blocks:
+                break
+            walk(pointers[11 + level], level, lblock)
+            lblock += per_block ** level
+        return extents
+
+    def listdir(self, inode):
+        """
+        :param inode: Inode or inode number of a directory
+        :return: list of (name, inode number), without . and ..
+        """
+        fh = self.open(inode)
+        data = fh.read()
+        if fh.inode.flags & INODE_FLAG_INLINE_DATA:
+            # Inline directories start with the parent inode number, without . and .. entries. The part in the
+            # extended attribute is a separate list of entries.
+            return self._parse_dirents(data[4:60], fh.inode) + self._parse_dirents(data[60:], fh.inode)
+        return self._parse_dirents(data, fh.inode)
+
+    def _parse_dirents(self, data, inode):
+        entries = []
+        offset = 0
+        while offset + 8 <= len(data):
+            (number, rec_len, name_len) = struct.unpack_from("<IHB", data, offset)
+            if rec_len < 8:
+                _log.warning("Bad directory entry in inode %d at %d", inode.number, offset)
+                break
+            if number:
+                name = str(data[offset + 8:offset + 8 + name_len], encoding="utf8", errors="surrogateescape")
+                if name not in (".", ".."):
+                    entries.append((name, number))
+            offset += rec_len
+        return entries
+
+    def walk(self, physical_order=False):
+        """
+        Walk the whole file system. Yields (path, Inode, size, data stream) for every regular file. Paths are relative
+        to the root directory. The data stream is only valid until the next file is requested.
+        :param physical_order: Yield the files in the order of their first block in the image, to reduce seeking
+        """
+        files = self._iter_files() if not physical_order else \
+            sorted(self._iter_files(), key=lambda item: item[1].first_physical_block())
+        for (path, fh) in files:
+            yield path, fh.inode, fh.size, fh
+
+    def _iter_files(self):
+        stack = [("", ROOT_INODE)]
+        seen = set()
+        while stack:
+            (dirpath, number) = stack.pop()
+            if number in seen:
+                continue
+            seen.add(number)
+            for name, child in sorted(self.listdir(number)):
+                path = os.path.join(dirpath, name)
+                inode = self.inode(child)
+                if inode.is_dir():
+                    stack.append((path, child))
+                elif inode.is_reg():
+                    yield path, self.open(inode)
+
+    def __repr__(self):
+        return "<{}({} blocks of {})>".format(self.__class__.__name__, self.superblock.blocks_count, self.block_size)
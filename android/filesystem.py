@@ -4,18 +4,91 @@ import os
 import struct
 import subprocess
 import logging
+import stat
+import collections
+import shutil
+
+from android import metrics
+from android import yaffs
 
 _log = logging.getLogger(__name__)
 
+HEADER_SIZE = 4096
+CACHE_SIZE = 65536
+
+_detectors = []
+_cache = collections.OrderedDict()
+
+def register_detector(name):
+    """
+    Decorator to register a function that detects an image type from the first HEADER_SIZE bytes of a file (less if
+    the file is smaller). Detectors are tried in registration order.
+    """
+    def decorator(func):
+        _detectors.append((name, func))
+        return func
+    return decorator
+
+def detect_bytes(headerbytes):
+    """
+    :return: tuple with the names of all detectors that match headerbytes
+    """
+    return tuple(name for (name, func) in _detectors if func(headerbytes))
+
+def detect(filepath):
+    """
+    Detect the image type(s) of a file, with one read of HEADER_SIZE bytes. Results are cached by
+    (device, inode, mtime, size), so calling this (or the is_* functions) repeatedly for a file is cheap.
+    :return: tuple with the names of all matching detectors, empty for unknown or non regular files
+    """
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return ()
+    if not stat.S_ISREG(st.st_mode):
+        return ()
+    key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    with open(filepath, "rb") as fh:
+        headerbytes = fh.read(HEADER_SIZE)
+    result = detect_bytes(headerbytes)
+    _cache[key] = result
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    _log.debug("Detected %s as %s", filepath, result)
+    return result
+
 def fstype(filepath):
-    if is_yaffs_image(filepath):
-        return "yaffs"
-    elif is_ext4(filepath):
-        return "ext4"
-    elif is_sparseext4(filepath):
-        return "sparse"
-    else:
-        return None
+    types = detect(filepath)
+    for name in ("yaffs", "ext4", "sparse"):
+        if name in types:
+            return name
+    return None
+
+@register_detector("sparse")
+def _detect_sparse(headerbytes):
+    return headerbytes[:4] == struct.pack("<I", 0xed26ff3a)
+
+@register_detector("boot")
+def _detect_boot(headerbytes):
+    return headerbytes[:8] == b"ANDROID!"
+
+@register_detector("bootloader")
+def _detect_bootloader(headerbytes):
+    return headerbytes[:8] == b"BOOTLDR!"
+
+@register_detector("ext4")
+def _detect_ext4(headerbytes):
+    return headerbytes[1024 + 0x38:1024 + 0x3a] == b"\x53\xef"
+
+@register_detector("yaffs")
+def _detect_yaffs(headerbytes):
+    if len(headerbytes) < 10:
+        return False
+    (obj_type, sum_no_longer_used) = struct.unpack_from("<I4x2s", headerbytes)
+    return obj_type in range(0, 5) and sum_no_longer_used == b"\xFF\xFF"
 
 def is_boot_image(filepath):
     """
@@ -34,14 +107,7 @@ def is_boot_image(filepath):
     :param filepath:
     :return:True or false
     """
-    if not os.path.isfile(filepath):
-        return False
-    try:
-        headerbytes = open(filepath, "br").read(2048)
-        (magic,) = struct.unpack("8s2040x", headerbytes)
-        return magic == b"ANDROID!"
-    except struct.error:
-        return False
+    return "boot" in detect(filepath)
 
 def is_bootloader_image(filepath):
     """
@@ -50,14 +116,7 @@ def is_bootloader_image(filepath):
     :param filepath:
     :return:True or false
     """
-    if not os.path.isfile(filepath):
-        return False
-    try:
-        headerbytes = open(filepath, "br").read(2048)
-        (magic,) = struct.unpack("8s2040x", headerbytes)
-        return magic == b"BOOTLDR!"
-    except struct.error:
-        return False
+    return "bootloader" in detect(filepath)
 
 def is_yaffs_image(filepath):
     """
@@ -67,15 +126,7 @@ def is_yaffs_image(filepath):
         int parent_obj_id; <-- Usually 1, but not sure enough to use
         u16 sum_no_longer_used;	/* checksum of name. No longer used */ <-- this is set to 0xFFFF
     """
-    if not os.path.isfile(filepath):
-        return False
-    try:
-        headerbytes = open(filepath, "br").read(10)
-        (parent_obj_id, sum_no_longer_used) = struct.unpack("I4x2s", headerbytes)
-        #_log.debug("%d, %s", parent_obj_id, sum_no_longer_used)
-        return (parent_obj_id in range(0,5) and sum_no_longer_used == b"\xFF\xFF")
-    except struct.error:
-        return False
+    return "yaffs" in detect(filepath)
 
 def is_sparseext4(filepath):
     """
@@ -96,12 +147,7 @@ def is_sparseext4(filepath):
 
     #define SPARSE_HEADER_MAGIC 0xed26ff3a
     """
-    try:
-        headerbytes = open(filepath, "br").read(4)
-        (magic,) = struct.unpack("I", headerbytes)
-        return magic == 0xed26ff3a
-    except struct.error:
-        return False
+    return "sparse" in detect(filepath)
 
 def is_ext4(filepath):
     """
@@ -111,16 +157,29 @@ def is_ext4(filepath):
     :param filepath: The file to check
     :return:true or false
     """
-    try:
-        headerbytes = open(filepath, "br").read(4)
-        (m,) = struct.unpack("1024x62c2c", headerbytes)
-        return m == b"\xed\x26\xff\x3a"
-    except struct.error:
-        return False
+    return "ext4" in detect(filepath)
+
+def _extract_path(extractdir, path):
+    """
+    :return: the path in extractdir to extract an image entry to, or None if the entry would end up outside of it.
+    Symlinks extracted earlier are resolved, so these can not point the entry elsewhere.
+    """
+    if os.path.isabs(path):
+        return None
+    fp = os.path.normpath(os.path.join(extractdir, path))
+    if os.path.commonpath([extractdir, fp]) != extractdir or fp == extractdir:
+        return None
+    realdir = os.path.realpath(extractdir)
+    if os.path.commonpath([realdir, os.path.realpath(os.path.dirname(fp))]) != realdir:
+        return None
+    return fp
 
 def unpack_yaffs(imagepath, destdir):
     """
     Unpack yaffs2 image to a directory. A subdirectory with the same name as the file name is created in destdir.
+    The image is read with yaffs.Yaffs2Image, so no unyaffs binary is needed. To just hash the files, walk the image
+    with yaffs.Yaffs2Image.walk instead of unpacking it.
+    Entries with names that lead outside of the subdirectory, or that are extracted already, are skipped.
     :param imagepath: Path to yaffs2 image file
     :param destdir: Directory to create mountdir in
     :return:the actual mount directory
@@ -135,7 +194,26 @@ def unpack_yaffs(imagepath, destdir):
         else:
             os.rmdir(extractdir)
     os.makedirs(extractdir)
-    subprocess.check_call(["unyaffs", imagepath, extractdir])
+    extractdir = os.path.abspath(extractdir)
+    with metrics.timer("extract"), yaffs.Yaffs2Image(imagepath) as image:
+        for (path, mode, size, fh) in image.walk():
+            fp = _extract_path(extractdir, path)
+            if fp is None:
+                _log.warning("Skipping %s, it is outside of %s", path, extractdir)
+                continue
+            if os.path.lexists(fp) and not (stat.S_ISDIR(mode) and os.path.isdir(fp) and not os.path.islink(fp)):
+                _log.warning("Skipping %s, it is extracted already", path)
+                continue
+            if stat.S_ISDIR(mode):
+                os.makedirs(fp, exist_ok=True)
+            elif stat.S_ISLNK(mode):
+                os.symlink(fh.read(), fp)
+            elif stat.S_ISREG(mode):
+                with open(fp, "wb") as outfd:
+                    shutil.copyfileobj(fh, outfd)
+                os.chmod(fp, stat.S_IMODE(mode))
+                metrics.count("extracted_files")
+                metrics.count("extracted_bytes", size)
     _log.info("Image extracted to %s", extractdir)
     return extractdir
 
@@ -156,7 +234,8 @@ def mount_image(imagepath, destdir):
         else:
             os.rmdir(mountdir)
     os.makedirs(mountdir)
-    subprocess.check_call(["sudo", "mount",imagepath, mountdir, "-o", "ro"])
+    with metrics.timer("mount"):
+        subprocess.check_call(["sudo", "mount",imagepath, mountdir, "-o", "ro"])
     _log.info("%s mounted", imagepath)
     return mountdir
 
@@ -0,0 +1,386 @@
+__author__ = 'ivo'
+
+"""
+Compiled, read only hash set: an export of a whitelist database for fast membership tests on analysis nodes.
+The file is mmapped, opening it only reads the header.
+
+Layout (little endian, sections aligned to 8 bytes):
+    header struct "<4sHH" (b"HSET", version, fan-out bits)
+    per algorithm (md5, sha1, sha256) struct "<QQQQ" (count, fan-out offset, digests offset, record numbers offset)
+    struct "<QQQQQ" (records, record offsets offset, records offset, sources offset, sources size)
+    per algorithm:
+        fan-out table: 2 ** bits + 1 uint32, entry p is the number of digests with a prefix below p
+        digests: count sorted digests of the fixed digest size
+        record numbers: count uint32, the record of the digest at the same index
+    record offsets: records + 1 uint64, record n is records[offsets[n]:offsets[n + 1]]
+    records: struct "<IBB" (source index, threat, trust) followed by the utf8 file path
+    sources: json list of the source ids
+NONE_INDEX and NONE_LEVEL stand for a source id, threat or trust of None.
+
+Single lookups use interpolation search within the fan-out bucket of the digest. get_many and contains_many use
+numpy searchsorted on the 8 byte digest prefixes if numpy is installed, and fall back to single lookups otherwise.
+
+Example:
+    python -m android.hashset export hashes.db hashes.hset
+    python -m android.hashset lookup hashes.hset d41d8cd98f00b204e9800998ecf8427e
+"""
+
+import argparse
+import array
+import binascii
+import bisect
+import json
+import logging
+import mmap
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import plyvel
+
+from android import records
+from android import sqldb
+
+_log = logging.getLogger()
+
+MAGIC = b"HSET"
+VERSION = 1
+FANOUT_BITS = 16
+ALGORITHMS = (("md5", 16), ("sha1", 20), ("sha256", 32))
+HEADER_FORMAT = "<4sHH"
+ALGORITHM_FORMAT = "<QQQQ"
+TRAILER_FORMAT = "<QQQQQ"
+HEADER_SIZE = (struct.calcsize(HEADER_FORMAT) + len(ALGORITHMS) * struct.calcsize(ALGORITHM_FORMAT)
+               + struct.calcsize(TRAILER_FORMAT))
+RECORD_FORMAT = "<IBB"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_FORMAT)
+NONE_INDEX = 0xFFFFFFFF
+NONE_LEVEL = 0xFF
+
+def _pad(fh):
+    fh.write(bytes(-fh.tell() % 8))
+
+def _iter_ldb(path, batch_size=4096):
+    dbif = plyvel.DB(path)
+    try:
+        store = records.RecordStore(dbif)
+        batch = {}
+        for (key, rawval) in dbif.iterator():
+            if not records.is_hash_key(key):
+                continue
+            batch[key] = rawval
+            if len(batch) >= batch_size:
+                yield from store.unpack_many(batch).items()
+                batch = {}
+        yield from store.unpack_many(batch).items()
+    finally:
+        dbif.close()
+
+def _iter_sql(path):
+    sqlif = sqldb.SqlHashDb(path)
+    try:
+        rows = sqlif._conn.execute("SELECT md5, sha1, sha256, filepath, source_id, threat, trust FROM files")
+        for (md5, sha1, sha256, filepath, source_id, threat, trust) in rows:
+            value = {"filepath": filepath, "source_id": source_id, "threat": threat, "trust": trust}
+            yield md5, value
+            yield sha1, value
+            yield sha256, value
+    finally:
+        sqlif.close()
+
+def _sorted_digests(digests, recnos, size):
+    """
+    :param digests: bytearray with the digests of one algorithm, in any order
+    :param recnos: array of the record numbers of the digests
+    :return: (sorted digests, record numbers in the same order) as bytes
+    """
+    if numpy is not None:
+        order = numpy.argsort(numpy.frombuffer(digests, dtype="S{}".format(size)), kind="stable")
+        sorted_digests = numpy.frombuffer(digests, dtype=numpy.uint8).reshape(-1, size)[order]
+        return sorted_digests.tobytes(), numpy.frombuffer(recnos, dtype="<u4")[order].tobytes()
+    order = sorted(range(len(recnos)), key=lambda i: digests[i * size:(i + 1) * size])
+    return (b"".join(digests[i * size:(i + 1) * size] for i in order),
+            array.array("I", (recnos[i] for i in order)).tobytes())
+
+def export(entries, path):
+    """
+    Write a hash set file.
+    :param entries: iterable of (digest, value dict) for md5, sha1 and sha256 digests
+    :return: Number of digests written
+    """
+    sizes = {size: name for (name, size) in ALGORITHMS}
+    digests = {size: bytearray() for size in sizes}
+    recnos = {size: array.array("I") for size in sizes}
+    recordnums = {}
+    sources = {}
+    recordblobs = []
+    for (digest, value) in entries:
+        if len(digest) not in sizes:
+            continue
+        source_id = value["source_id"]
+        recordkey = (value["filepath"], source_id, value["threat"], value["trust"])
+        if recordkey not in recordnums:
+            if source_id is not None and source_id not in sources:
+                sources[source_id] = len(sources)
+            # Json databases of older versions have the level names
+            try:
+                levels = [NONE_LEVEL if level is None else records._pack_level(level, names)
+                          for (level, names) in ((value["threat"], records.THREAT_LEVELS),
+                                                 (value["trust"], records.TRUST_LEVELS))]
+            except ValueError as exc:
+                raise ValueError("Record of {}: {}".format(value["filepath"], exc))
+            recordnums[recordkey] = len(recordblobs)
+            recordblobs.append(struct.pack(RECORD_FORMAT, NONE_INDEX if source_id is None else sources[source_id],
+                                           *levels) + value["filepath"].encode("utf8", errors="surrogateescape"))
+        digests[len(digest)] += digest
+        recnos[len(digest)].append(recordnums[recordkey])
+
+    fanout_entries = (1 << FANOUT_BITS) + 1
+    with open(path, "wb") as fh:
+        fh.write(bytes(HEADER_SIZE))
+        _pad(fh)
+        algorithms = []
+        for (name, size) in ALGORITHMS:
+            (sorted_digests, sorted_recnos) = _sorted_digests(digests[size], recnos[size], size)
+            count = len(recnos[size])
+            # Prefixes of the sorted digests are in order, so the fan-out table follows from one pass
+            fanout = array.array("I", bytes(4 * fanout_entries))
+            shift = 16 - FANOUT_BITS
+            for i in range(count):
+                fanout[(int.from_bytes(sorted_digests[i * size:i * size + 2], "big") >> shift) + 1] += 1
+            for p in range(1, fanout_entries):
+                fanout[p] += fanout[p - 1]
+            fanout_off = fh.tell()
+            fh.write(fanout.tobytes())
+            _pad(fh)
+            digests_off = fh.tell()
+            fh.write(sorted_digests)
+            _pad(fh)
+            recnos_off = fh.tell()
+            fh.write(sorted_recnos)
+            _pad(fh)
+            algorithms.append((count, fanout_off, digests_off, recnos_off))
+            _log.info("%d %s digests", count, name)
+        offsets = array.array("Q", [0])
+        for blob in recordblobs:
+            offsets.append(offsets[-1] + len(blob))
+        recoffsets_off = fh.tell()
+        fh.write(offsets.tobytes())
+        records_off = fh.tell()
+        for blob in recordblobs:
+            fh.write(blob)
+        _pad(fh)
+        sources_off = fh.tell()
+        sourcesblob = json.dumps(sorted(sources, key=sources.get)).encode()
+        fh.write(sourcesblob)
+        fh.seek(0)
+        fh.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, FANOUT_BITS))
+        for algorithm in algorithms:
+            fh.write(struct.pack(ALGORITHM_FORMAT, *algorithm))
+        fh.write(struct.pack(TRAILER_FORMAT, len(recordblobs), recoffsets_off, records_off, sources_off,
+                             len(sourcesblob)))
+    _log.info("%d records, %d sources written to %s", len(recordblobs), len(sources), path)
+    return sum(len(recnos[size]) for size in sizes)
+
+class _DigestArray():
+    """
+    Sequence view of the sorted digests of one algorithm in the mmap, for bisect.
+    """
+    def __init__(self, mm, offset, size, count):
+        self.mm, self.offset, self.size, self.count = mm, offset, size, count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        start = self.offset + index * self.size
+        return self.mm[start:start + self.size]
+
+class HashSet():
+    def __init__(self, path):
+        self._fh = open(path, "rb")
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.fanout_bits) = struct.unpack_from(HEADER_FORMAT, self._mm)
+        if magic != MAGIC:
+            raise Exception("Not a hash set file: {}".format(path))
+        if version != VERSION:
+            raise Exception("Unsupported hash set version {}".format(version))
+        offset = struct.calcsize(HEADER_FORMAT)
+        self._algorithms = {}
+        for (name, size) in ALGORITHMS:
+            (count, fanout_off, digests_off, recnos_off) = struct.unpack_from(ALGORITHM_FORMAT, self._mm, offset)
+            offset += struct.calcsize(ALGORITHM_FORMAT)
+            fanout = memoryview(self._mm)[fanout_off:fanout_off + 4 * ((1 << self.fanout_bits) + 1)].cast("I")
+            recnos = memoryview(self._mm)[recnos_off:recnos_off + 4 * count].cast("I")
+            self._algorithms[size] = (name, fanout, _DigestArray(self._mm, digests_off, size, count), recnos)
+        (self.num_records, recoffsets_off, self._records_off, sources_off, sources_size) = struct.unpack_from(
+            TRAILER_FORMAT, self._mm, offset)
+        self._recoffsets = memoryview(self._mm)[recoffsets_off:recoffsets_off + 8 * (self.num_records + 1)].cast("Q")
+        self.sources = json.loads(self._mm[sources_off:sources_off + sources_size])
+        self._numpy_arrays = {}
+
+    def __len__(self):
+        return sum(len(digests) for (name, fanout, digests, recnos) in self._algorithms.values())
+
+    def record(self, recno):
+        """
+        :return: value dict of record recno
+        """
+        start = self._records_off + self._recoffsets[recno]
+        end = self._records_off + self._recoffsets[recno + 1]
+        (sourceindex, threat, trust) = struct.unpack_from(RECORD_FORMAT, self._mm, start)
+        return {"filepath": str(self._mm[start + RECORD_HEADER_SIZE:end], encoding="utf8", errors="surrogateescape"),
+                "source_id": None if sourceindex == NONE_INDEX else self.sources[sourceindex],
+                "threat": None if threat == NONE_LEVEL else threat,
+                "trust": None if trust == NONE_LEVEL else trust}
+
+    def find(self, digest):
+        """
+        Interpolation search in the fan-out bucket of digest, binary search once the range is small.
+        :return: record number of digest, or None
+        """
+        if len(digest) not in self._algorithms:
+            return None
+        (name, fanout, digests, recnos) = self._algorithms[len(digest)]
+        prefix = int.from_bytes(digest[:2], "big") >> (16 - self.fanout_bits)
+        (lo, hi) = (fanout[prefix], fanout[prefix + 1])
+        target = int.from_bytes(digest[:8], "big")
+        while hi - lo > 8:
+            lowval = int.from_bytes(digests[lo][:8], "big")
+            highval = int.from_bytes(digests[hi - 1][:8], "big")
+            if not lowval <= target <= highval:
+                return None
+            mid = lo + (target - lowval) * (hi - 1 - lo) // max(highval - lowval, 1)
+            current = digests[mid]
+            if current == digest:
+                return recnos[mid]
+            if current < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        index = bisect.bisect_left(digests, digest, lo, hi)
+        if index < hi and digests[index] == digest:
+            return recnos[index]
+        return None
+
+    def __contains__(self, digest):
+        return self.find(digest) is not None
+
+    def get(self, digest):
+        recno = self.find(digest)
+        return None if recno is None else self.record(recno)
+
+    def _numpy_arrays_of(self, size):
+        """
+        The digests and record numbers as numpy arrays over the mmap, and the first 8 bytes of every digest as a
+        native uint64 array. The prefixes are the only copy, made on the first batch lookup of the algorithm.
+        """
+        if size not in self._numpy_arrays:
+            (name, fanout, digests, recnos) = self._algorithms[size]
+            sorted_digests = numpy.frombuffer(self._mm, dtype="S{}".format(size), count=digests.count,
+                                              offset=digests.offset)
+            prefixes = numpy.ndarray(digests.count, dtype=">u8", buffer=self._mm, offset=digests.offset,
+                                     strides=(size,)).astype(numpy.uint64)
+            self._numpy_arrays[size] = (sorted_digests, prefixes, numpy.frombuffer(recnos, dtype=numpy.uint32))
+        return self._numpy_arrays[size]
+
+    def find_many(self, digests):
+        """
+        Vectorised lookup: searchsorted on the 8 byte prefixes, then a compare of the full digests.
+        :param digests: digests of one algorithm, or numpy "S" array of them
+        :return: list (numpy array with numpy) of the record numbers of the digests, -1 for unknown ones
+        """
+        if numpy is None:
+            return [-1 if recno is None else recno for recno in map(self.find, digests)]
+        if not isinstance(digests, numpy.ndarray):
+            if not digests:
+                return numpy.empty(0, dtype=numpy.int64)
+            digests = numpy.array(digests, dtype="S{}".format(len(digests[0])))
+        size = digests.dtype.itemsize
+        if size not in self._algorithms or not len(digests) or not self._algorithms[size][2].count:
+            return numpy.full(len(digests), -1, dtype=numpy.int64)
+        (sorted_digests, prefixes, recnos) = self._numpy_arrays_of(size)
+        queries = numpy.ndarray(len(digests), dtype=">u8", buffer=numpy.ascontiguousarray(digests),
+                                strides=(size,)).astype(numpy.uint64)
+        # Searching the queries in sorted order walks the prefix array forward, that is a lot more cache friendly
+        order = numpy.argsort(queries)
+        index = numpy.empty(len(queries), dtype=numpy.intp)
+        index[order] = numpy.searchsorted(prefixes, queries[order])
+        numpy.minimum(index, len(prefixes) - 1, out=index)
+        found = sorted_digests[index] == digests
+        result = numpy.where(found, recnos[index].astype(numpy.int64), -1)
+        # Different digests with the same 8 byte prefix are practically nonexistent, these are resolved one by one
+        for i in numpy.flatnonzero(~found & (prefixes[index] == queries)):
+            recno = self.find(bytes(digests[i]).ljust(size, b"\x00"))
+            result[i] = -1 if recno is None else recno
+        return result
+
+    def contains_many(self, digests):
+        """
+        :return: list (numpy bool array with numpy) telling for every digest of one algorithm if it is in the set
+        """
+        recnos = self.find_many(digests)
+        if numpy is None:
+            return [recno >= 0 for recno in recnos]
+        return recnos >= 0
+
+    def get_many(self, digests):
+        """
+        :param digests: md5, sha1 or sha256 digests, mixed
+        :return: dict of digest -> value dict, for the digests that are in the set
+        """
+        bysize = {}
+        for digest in set(digests):
+            bysize.setdefault(len(digest), []).append(digest)
+        found = {}
+        for (size, sizedigests) in bysize.items():
+            for (digest, recno) in zip(sizedigests, self.find_many(sizedigests)):
+                if recno >= 0:
+                    found[digest] = self.record(int(recno))
+        return found
+
+    def close(self):
+        self._numpy_arrays.clear()
+        for (name, fanout, digests, recnos) in self._algorithms.values():
+            fanout.release()
+            recnos.release()
+        self._recoffsets.release()
+        self._mm.close()
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a whitelist database to a compiled hash set, or look up digests in one")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    exportparser = subparsers.add_parser("export", help="Export a database")
+    exportparser.add_argument("database", help="The hash database")
+    exportparser.add_argument("output", help="The hash set file")
+    exportparser.add_argument("-f", "--format", choices=["ldb", "sql"], default="ldb", help="The database format. Default: ldb")
+    lookupparser = subparsers.add_parser("lookup", help="Look up hex digests, from the arguments or stdin")
+    lookupparser.add_argument("hashset", help="The hash set file")
+    lookupparser.add_argument("digests", nargs="*", help="Hex digests. Default: read from stdin, one per line")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    if args.command == "export":
+        entries = _iter_sql(args.database) if args.format == "sql" else _iter_ldb(args.database)
+        export(entries, args.output)
+    else:
+        hexdigests = args.digests or [line.split()[0] for line in sys.stdin if line.strip()]
+        with HashSet(args.hashset) as hashset:
+            found = hashset.get_many([binascii.unhexlify(hexdigest) for hexdigest in hexdigests])
+            for hexdigest in hexdigests:
+                print("{}\t{}".format(hexdigest, json.dumps(found.get(binascii.unhexlify(hexdigest)))))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+__author__ = 'ivo'
+
+"""
+Script for converting regular (ext4) image files to Android sparse image files. The counterpart of simg2img.
+
+The input is read in large buffers, which are classified in bulk: buffers that consist of one repeated 32 bit word
+(usually all zeroes) are detected with a single compare. Otherwise every block is checked for a repeated word,
+vectorised with numpy if it is installed (optional, not in requirements.txt: without it the blocks are checked one
+by one). Runs of fill blocks become FILL (or DONT_CARE) chunks, the rest RAW chunks.
+Memory use is bounded by the read buffer and MAX_RAW_CHUNK_SIZE, whatever the image size.
+"""
+
+import argparse
+import logging
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from android import simg2img
+from android.simg2img import SparseHeader, ChunkHeader
+
+_log = logging.getLogger()
+
+READ_BUF_SIZE = 16 * simg2img.COPY_BUF_SIZE
+MAX_RAW_CHUNK_SIZE = 16 * simg2img.COPY_BUF_SIZE
+ZERO_FILL = b"\x00\x00\x00\x00"
+
+def _classify_blocks_numpy(buf, blk_sz):
+    words = numpy.frombuffer(buf, dtype="<u4").reshape(-1, blk_sz // 4)
+    first = words[:, 0]
+    isfill = (words == first[:, None]).all(axis=1)
+    # One key per block: the fill value, or -1 for raw blocks. Runs are where the key does not change.
+    keys = numpy.where(isfill, first.astype(numpy.int64), -1)
+    bounds = (numpy.flatnonzero(keys[1:] != keys[:-1]) + 1).tolist()
+    runs = []
+    for start, end in zip([0] + bounds, bounds + [len(keys)]):
+        key = int(keys[start])
+        runs.append((None if key < 0 else struct.pack("<I", key), end - start))
+    return runs
+
+def classify_blocks(buf, blk_sz):
+    """
+    Split buf, a bytes object with a multiple of blk_sz length, in runs of blocks.
+    :return: list of (fill_val, num_blocks). fill_val is the repeated 4 byte value of a run of fill blocks, or None
+    for a run of raw blocks.
+    """
+    num_blocks = len(buf) // blk_sz
+    if not num_blocks:
+        return []
+    # buf[k] == buf[k+4] for all k means the whole buffer is one repeated word. startswith compares buf with a view
+    # of itself shifted by 4 bytes in place, slicing buf would copy it twice.
+    view = memoryview(buf)
+    if buf.startswith(view[4:]):
+        return [(buf[:4], num_blocks)]
+    if numpy is not None:
+        return _classify_blocks_numpy(buf, blk_sz)
+    runs = []
+    for offset in range(0, len(buf), blk_sz):
+        fill_val = buf[offset:offset + 4] if buf.startswith(view[offset + 4:offset + blk_sz], offset) else None
+        if runs and runs[-1][0] == fill_val:
+            runs[-1][1] += 1
+        else:
+            runs.append([fill_val, 1])
+    return [(fill_val, count) for fill_val, count in runs]
+
+class SparseWriter():
+    """
+    Writes chunks to a sparse image. Consecutive blocks of the same kind are merged into one chunk.
+    The output has to be seekable, the file header is rewritten with the chunk count when closed.
+    """
+    def __init__(self, outputfd, blk_sz=4096, dont_care_zeros=False, crc=False):
+        """
+        :param dont_care_zeros: Write zero blocks as DONT_CARE instead of FILL chunks. Smaller, but only correct when
+        the image is written to zeroed storage.
+        :param crc: Add a CRC32 chunk at the end and set image_checksum in the header
+        """
+        if blk_sz % 4:
+            raise ValueError("Block size must be a multiple of 4")
+        self.outputfd = outputfd
+        self.blk_sz = blk_sz
+        self.dont_care_zeros = dont_care_zeros
+        self.crc = simg2img.Crc32Engine(simg2img.CRC_COMPUTE if crc else simg2img.CRC_OFF)
+        self.total_blks = 0
+        self.total_chunks = 0
+        self.bytes_written = 0
+        self._start = outputfd.tell()
+        self._pending_type = None
+        self._pending_fill = None
+        self._pending_blocks = 0
+        self._pending_raw = []
+        self.outputfd.write(self._header().to_bytes())
+
+    def _header(self):
+        sh = SparseHeader()
+        sh.magic = simg2img.SPARSE_HEADER_MAGIC
+        sh.major_version = simg2img.SPARSE_HEADER_MAJOR_VER
+        sh.minor_version = 0
+        sh.file_hdr_sz = simg2img.SPARSE_HEADER_LEN
+        sh.chunk_hdr_sz = simg2img.CHUNK_HEADER_LEN
+        sh.blk_sz = self.blk_sz
+        sh.total_blks = self.total_blks
+        sh.total_chunks = self.total_chunks
+        sh.image_checksum = self.crc.value
+        return sh
+
+    def _write_chunk(self, chunk_type, num_blocks, data_len):
+        ch = ChunkHeader()
+        ch.chunk_type = chunk_type
+        ch.reserved1 = 0
+        ch.chunk_sz = num_blocks
+        ch.total_sz = simg2img.CHUNK_HEADER_LEN + data_len
+        self.outputfd.write(ch.to_bytes())
+        self.total_chunks += 1
+        self.bytes_written += ch.total_sz
+
+    def flush(self):
+        """
+        Write the pending chunk.
+        """
+        if not self._pending_blocks:
+            return
+        if self._pending_type == simg2img.CHUNK_TYPE_RAW:
+            self._write_chunk(simg2img.CHUNK_TYPE_RAW, self._pending_blocks, self._pending_blocks * self.blk_sz)
+            for blob in self._pending_raw:
+                self.outputfd.write(blob)
+            self._pending_raw = []
+        elif self._pending_type == simg2img.CHUNK_TYPE_FILL:
+            self._write_chunk(simg2img.CHUNK_TYPE_FILL, self._pending_blocks, 4)
+            self.outputfd.write(self._pending_fill)
+        else:
+            self._write_chunk(simg2img.CHUNK_TYPE_DONT_CARE, self._pending_blocks, 0)
+        self.total_blks += self._pending_blocks
+        self._pending_blocks = 0
+
+    def _add(self, chunk_type, num_blocks, fill_val=None):
+        if self._pending_blocks and (chunk_type != self._pending_type or fill_val != self._pending_fill):
+            self.flush()
+        self._pending_type = chunk_type
+        self._pending_fill = fill_val
+        self._pending_blocks += num_blocks
+
+    def add_raw(self, blob):
+        """
+        Add raw blocks. blob is kept until the chunk is written, so it must not be modified.
+        """
+        self.crc.update(blob)
+        max_blocks = MAX_RAW_CHUNK_SIZE // self.blk_sz
+        offset = 0
+        while offset < len(blob):
+            if self._pending_type == simg2img.CHUNK_TYPE_RAW and self._pending_blocks >= max_blocks:
+                self.flush()
+            num_blocks = (len(blob) - offset) // self.blk_sz
+            if self._pending_type == simg2img.CHUNK_TYPE_RAW:
+                num_blocks = min(num_blocks, max_blocks - self._pending_blocks)
+            else:
+                num_blocks = min(num_blocks, max_blocks)
+            self._add(simg2img.CHUNK_TYPE_RAW, num_blocks)
+            self._pending_raw.append(blob[offset:offset + num_blocks * self.blk_sz])
+            offset += num_blocks * self.blk_sz
+
+    def add_fill(self, fill_val, num_blocks):
+        if fill_val == ZERO_FILL:
+            self.crc.update_zeros(num_blocks * self.blk_sz)
+            if self.dont_care_zeros:
+                self.add_dont_care(num_blocks)
+                return
+        elif self.crc.enabled:
+            fillbuf = simg2img._fill_buffer(fill_val)
+            length = num_blocks * self.blk_sz
+            while length:
+                size = min(len(fillbuf), length)
+                self.crc.update(fillbuf if size == len(fillbuf) else fillbuf[:size])
+                length -= size
+        self._add(simg2img.CHUNK_TYPE_FILL, num_blocks, fill_val)
+
+    def add_dont_care(self, num_blocks):
+        self._add(simg2img.CHUNK_TYPE_DONT_CARE, num_blocks)
+
+    def close(self):
+        """
+        Write the pending chunk, the optional CRC32 chunk and the final file header.
+        :return: The SparseHeader written
+        """
+        self.flush()
+        if self.crc.enabled:
+            self._write_chunk(simg2img.CHUNK_TYPE_CRC32, 0, 4)
+            self.outputfd.write(struct.pack("<I", self.crc.value))
+        header = self._header()
+        end = self.outputfd.tell()
+        self.outputfd.seek(self._start)
+        self.outputfd.write(header.to_bytes())
+        self.outputfd.seek(end)
+        return header
+
+def sparse(inputfd, outputfd, blk_sz=4096, dont_care_zeros=False, crc=False):
+    """
+    Convert a raw image to a sparse image. inputfd is read sequentially, outputfd has to be seekable.
+    The last block is padded with zeroes if the input is not a multiple of blk_sz.
+    :return: The SparseHeader of the output
+    """
+    writer = SparseWriter(outputfd, blk_sz, dont_care_zeros, crc)
+    read_size = READ_BUF_SIZE - READ_BUF_SIZE % blk_sz
+    while True:
+        buf = inputfd.read(read_size)
+        if not buf:
+            break
+        while len(buf) < read_size:
+            more = inputfd.read(read_size - len(buf))
+            if not more:
+                break
+            buf += more
+        if len(buf) % blk_sz:
+            buf += bytes(blk_sz - len(buf) % blk_sz)
+        offset = 0
+        for fill_val, num_blocks in classify_blocks(buf, blk_sz):
+            if fill_val is None:
+                writer.add_raw(memoryview(buf)[offset:offset + num_blocks * blk_sz])
+            else:
+                writer.add_fill(fill_val, num_blocks)
+            offset += num_blocks * blk_sz
+    header = writer.close()
+    _log.info("Wrote %d blocks in %d chunks, %d bytes", header.total_blks, header.total_chunks, writer.bytes_written)
+    return header
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert regular image to Android sparse image")
+    parser.add_argument("input_image", help="The input image")
+    parser.add_argument("output_image", help="The sparse output image")
+    parser.add_argument("-b", "--block-size", type=int, default=4096, help="Block size. Default: 4096")
+    parser.add_argument("-z", "--dont-care", action="store_true", help="Write zero blocks as don't care chunks instead of fill chunks")
+    parser.add_argument("-c", "--crc", action="store_true", help="Add crc32 checksum")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    with open(args.input_image, "rb") as inputfd, open(args.output_image, "wb") as outputfd:
+        sparse(inputfd, outputfd, blk_sz=args.block_size, dont_care_zeros=args.dont_care, crc=args.crc)
+
+if __name__ == "__main__":
+    main()
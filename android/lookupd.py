@@ -0,0 +1,218 @@
+__author__ = 'ivo'
+
+"""
+Lookup server for a hash whitelist database, so many analysis workers can share one open database.
+
+Protocol, over a unix socket or tcp:
+    request: one line with whitespace separated hex digests (md5, sha1 or sha256)
+    response: one line with a json list, with the record of every digest in request order, or null if unknown.
+              A request with an invalid digest gets {"error": "..."} instead.
+Requests can be pipelined: all complete request lines that arrived are resolved with one sorted lookup, and the
+responses are sent in request order.
+
+Example:
+    python -m android.lookupd hashes.db -s /tmp/whitelist.sock
+    printf "d41d8cd98f00b204e9800998ecf8427e\\n" | nc -U /tmp/whitelist.sock
+"""
+
+import argparse
+import asyncio
+import binascii
+import collections
+import json
+import logging
+import os
+import socket
+import threading
+
+import plyvel
+
+from android import records
+
+_log = logging.getLogger()
+
+READ_SIZE = 256 * 1024
+CACHE_SIZE = 1000000
+
+def parse_address(address):
+    """
+    :return: ("unix", path) for a path, ("tcp", (host, port)) for host:port or port
+    """
+    if os.path.sep in address or ":" not in address and not address.isdigit():
+        return "unix", address
+    (host, _, port) = address.rpartition(":")
+    return "tcp", (host or "127.0.0.1", int(port))
+
+def parse_digests(line):
+    digests = [binascii.unhexlify(token) for token in line.split()]
+    for digest in digests:
+        if not records.is_hash_key(digest):
+            raise ValueError("Not an md5, sha1 or sha256 digest: {}".format(binascii.hexlify(digest).decode()))
+    return digests
+
+class LookupServer():
+    def __init__(self, dbif, cache_size=CACHE_SIZE):
+        self.store = records.RecordStore(dbif)
+        self.cache_size = cache_size
+        # digest -> record, or None for unknown digests
+        self._cache = collections.OrderedDict()
+        self.requests, self.lookups, self.hits = 0, 0, 0
+
+    async def _resolve(self, digests):
+        result = {}
+        missing = set()
+        for digest in digests:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                result[digest] = self._cache[digest]
+                self.hits += 1
+            else:
+                missing.add(digest)
+        found = {}
+        if missing:
+            self.lookups += len(missing)
+            # The lookup blocks, so it runs on a thread. Lookups of several connections can run at the same time.
+            found = await asyncio.get_running_loop().run_in_executor(None, self.store.get_many, missing)
+        for digest in missing:
+            result[digest] = found.get(digest)
+            self._cache[digest] = result[digest]
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    async def _respond(self, lines):
+        requests = []
+        for line in lines:
+            try:
+                requests.append(parse_digests(line))
+            except (ValueError, binascii.Error) as exc:
+                requests.append(exc)
+        self.requests += len(requests)
+        result = await self._resolve({digest for request in requests if not isinstance(request, Exception)
+                                      for digest in request})
+        responses = []
+        for request in requests:
+            if isinstance(request, Exception):
+                response = {"error": str(request)}
+            else:
+                response = [result[digest] for digest in request]
+            responses.append(json.dumps(response).encode() + b"\n")
+        return b"".join(responses)
+
+    async def handle(self, reader, writer):
+        pending = b""
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                lines = (pending + data).split(b"\n")
+                pending = lines.pop()
+                if lines:
+                    writer.write(await self._respond(lines))
+                    await writer.drain()
+            if pending.strip():
+                writer.write(await self._respond([pending]))
+                await writer.drain()
+        except ConnectionError:
+            _log.debug("Connection lost")
+        finally:
+            writer.close()
+
+    async def serve(self, address):
+        (family, addr) = parse_address(address)
+        if family == "unix":
+            if os.path.exists(addr):
+                os.unlink(addr)
+            server = await asyncio.start_unix_server(self.handle, addr)
+        else:
+            server = await asyncio.start_server(self.handle, *addr)
+        _log.info("Serving lookups on %s", address)
+        async with server:
+            await server.serve_forever()
+
+class LookupClient():
+    """
+    Client for the lookup server. lookup_many pipelines its batches: a thread writes the requests while the responses
+    are read, so neither side blocks on a full socket buffer whatever the batch size.
+    """
+    def __init__(self, address, batch_size=1024, pipeline_depth=8):
+        (family, addr) = parse_address(address)
+        self._sock = socket.socket(socket.AF_UNIX if family == "unix" else socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.connect(addr)
+        self._rfh = self._sock.makefile("rb")
+        self._wfh = self._sock.makefile("wb")
+        self.batch_size = batch_size
+        self.pipeline_depth = pipeline_depth
+
+    def _send(self, batches, window, stop, errors):
+        try:
+            for batch in batches:
+                # At most pipeline_depth batches waiting for a response, to bound the memory of both sides
+                window.acquire()
+                if stop.is_set():
+                    return
+                self._wfh.write(b" ".join(binascii.hexlify(digest) for digest in batch) + b"\n")
+                self._wfh.flush()
+        except OSError as exc:
+            errors.append(exc)
+
+    def lookup_many(self, digests):
+        """
+        :return: dict of digest -> record, for the digests that are known
+        """
+        digests = sorted(set(digests))
+        batches = [digests[i:i + self.batch_size] for i in range(0, len(digests), self.batch_size)]
+        found = {}
+        error = None
+        window = threading.Semaphore(self.pipeline_depth)
+        stop = threading.Event()
+        errors = []
+        sender = threading.Thread(target=self._send, args=(batches, window, stop, errors), daemon=True)
+        sender.start()
+        try:
+            for batch in batches:
+                line = self._rfh.readline()
+                if not line:
+                    raise Exception("Lookup server closed the connection") from (errors[0] if errors else None)
+                window.release()
+                response = json.loads(line)
+                # The responses of the batches that were sent are still read, so the connection stays usable
+                if isinstance(response, dict):
+                    error = error or response["error"]
+                    continue
+                found.update((digest, value) for (digest, value) in zip(batch, response) if value is not None)
+        finally:
+            stop.set()
+            window.release()
+            sender.join()
+        if error:
+            raise Exception(error)
+        return found
+
+    def close(self):
+        self._rfh.close()
+        self._wfh.close()
+        self._sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve lookups in a hash whitelist database")
+    parser.add_argument("database", help="The leveldb hash database")
+    parser.add_argument("-s", "--socket", default="127.0.0.1:7420", help="Unix socket path or [host:]port to listen on. Default: %(default)s")
+    parser.add_argument("-c", "--cache-size", type=int, default=CACHE_SIZE, help="Number of digests in the lookup cache. Default: %(default)s")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    dbif = plyvel.DB(args.database)
+    server = LookupServer(dbif, cache_size=args.cache_size)
+    try:
+        asyncio.run(server.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _log.info("%d requests, %d digests looked up, %d cache hits", server.requests, server.lookups, server.hits)
+        dbif.close()
+
+if __name__ == "__main__":
+    main()
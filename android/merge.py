@@ -0,0 +1,228 @@
+__author__ = 'ivo'
+
+"""
+Merge shard hash databases into one. A big whitelist build can be spread over nodes that each build a database of
+their own sources (build_aosp_hashlist --shard, or build_whitelist runs with their own -o), after which the shards are
+merged with a streaming k-way merge over their sorted iterators.
+
+A digest that is in more than one shard is resolved like build_whitelist.batch_write does when the shards are
+written in the order given: the value of each next shard replaces the current one through _update_value, or with
+--keep-first the first value is kept.
+
+The shards must be in the binary record format (see android.records, which also migrates json databases). Every
+shard keeps its own record ids, shifted by an offset, so records are copied without decoding them. Only digests that
+are in more than one shard are decoded. Memory use is a batch of digests plus a bit per shard record, and the output
+is written in key order: first the digest keys, then the records.
+The .sources.db of build_aosp_hashlist next to each shard are merged as well.
+
+Example:
+    python -m android.merge hashes.db shard0.db shard1.db shard2.db
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import struct
+
+import plyvel
+
+from android import build_aosp_hashlist
+from android import build_whitelist
+from android import records
+
+_log = logging.getLogger()
+
+BATCH_SIZE = 4096
+
+class _Shard():
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.dbif = plyvel.DB(path)
+        self.store = records.RecordStore(self.dbif)
+        if self.store.format != records.FORMAT_BINARY:
+            self.dbif.close()
+            raise Exception("Shard {} is a json database, migrate it with android.records first".format(path))
+        # Bit per record id, set for the records the output points to
+        self.referenced = bytearray(self.store.next_record_id // 8 + 1)
+        self.offset = 0
+        self.srcmap = {records.NONE_INDEX: records.NONE_INDEX}
+        self.dirmap = {records.NONE_INDEX: records.NONE_INDEX}
+
+    def hash_items(self):
+        """
+        :return: generator of (digest key, shard index, stored value), sorted by key
+        """
+        for (key, rawval) in self.dbif.iterator():
+            if records.is_hash_key(key):
+                yield key, self.index, rawval
+
+    def pointer(self, rawval):
+        """
+        :return: the stored value rawval, pointing to the record in the output
+        """
+        (version, record_id) = struct.unpack(records.POINTER_FORMAT, rawval)
+        self.referenced[record_id >> 3] |= 1 << (record_id & 7)
+        return struct.pack(records.POINTER_FORMAT, records.FORMAT_BINARY, self.offset + record_id)
+
+    def is_referenced(self, record_id):
+        return record_id >> 3 < len(self.referenced) and self.referenced[record_id >> 3] & 1 << (record_id & 7)
+
+def _resolve(batch, shards, output, replace, wb):
+    """
+    Write a batch of merged digest keys.
+    :param batch: list of (key, [(shard index, stored value), ...]), entries in shard order
+    :return: (number of digests in more than one shard, number of new records)
+    """
+    # The values of digests in more than one shard, decoded per shard with one sorted sweep
+    rawvals = {}
+    for (key, entries) in batch:
+        if len(entries) > 1:
+            for (index, rawval) in entries:
+                rawvals.setdefault(index, {})[key] = rawval
+    values = {index: shards[index].store.unpack_many(shardvals) for (index, shardvals) in rawvals.items()}
+
+    conflicts, created = 0, 0
+    packed = {}
+    for (key, entries) in batch:
+        if len(entries) == 1:
+            (index, rawval) = entries[0]
+            wb.put(key, shards[index].pointer(rawval))
+            continue
+        conflicts += 1
+        curval = None
+        for (index, rawval) in entries:
+            value = values[index].get(key)
+            if value is None:
+                continue
+            if curval is None:
+                curval = value
+            elif replace:
+                curval = build_whitelist._update_value(curval, value)
+        # Point to an existing record with the resolved value, the last one as batch_write would have written it
+        for (index, rawval) in reversed(entries):
+            if values[index].get(key) == curval:
+                wb.put(key, shards[index].pointer(rawval))
+                break
+        else:
+            valuekey = (curval["filepath"], curval["source_id"], curval["threat"], curval["trust"])
+            if valuekey not in packed:
+                packed[valuekey] = output.pack(curval, wb)
+                created += 1
+            wb.put(key, packed[valuekey])
+    return conflicts, created
+
+def _copy_records(shard, output, batch_size):
+    """
+    Copy the referenced records of a shard to the output, with their ids and dictionary indices mapped.
+    :return: (number of records copied, number of records skipped)
+    """
+    copied, skipped = 0, 0
+    wb = output.dbif.write_batch()
+    for (key, blob) in shard.dbif.iterator(prefix=records.RECORD_PREFIX):
+        record_id = int.from_bytes(key[len(records.RECORD_PREFIX):], "big")
+        if not shard.is_referenced(record_id):
+            skipped += 1
+            continue
+        (version, sourceindex, dirindex, levels) = struct.unpack_from(records.RECORD_FORMAT, blob)
+        wb.put(records._record_key(shard.offset + record_id),
+               struct.pack(records.RECORD_FORMAT, version, shard.srcmap[sourceindex], shard.dirmap[dirindex], levels)
+               + blob[records.RECORD_HEADER_SIZE:])
+        copied += 1
+        if copied % batch_size == 0:
+            wb.write()
+            wb = output.dbif.write_batch()
+    wb.write()
+    return copied, skipped
+
+def merge(shardpaths, outpath, replace=True, batch_size=BATCH_SIZE):
+    """
+    Merge shard databases into a new database.
+    :param shardpaths: paths of the shard databases, in the order their values are applied
+    :param replace: resolve digests in more than one shard with _update_value, otherwise keep the first value
+    :return: number of digest keys written
+    """
+    if os.path.exists(outpath):
+        raise Exception("Output database {} exists".format(outpath))
+    shards = []
+    try:
+        for (index, path) in enumerate(shardpaths):
+            shards.append(_Shard(index, path))
+        outdb = plyvel.DB(outpath, create_if_missing=True, error_if_exists=True)
+        output = records.RecordStore(outdb)
+
+        # Record ids of the shards one after the other, the dictionaries are small and merged up front
+        wb = outdb.write_batch()
+        offset = 0
+        for shard in shards:
+            shard.offset = offset
+            offset += shard.store.next_record_id
+            for (index, source) in shard.store.sources.items():
+                shard.srcmap[index] = output._intern(source, output._source_index, output.sources,
+                                                     records.SOURCE_PREFIX, wb)
+            for (index, dirpath) in shard.store.dirs.items():
+                shard.dirmap[index] = output._intern(dirpath, output._dir_index, output.dirs, records.DIR_PREFIX, wb)
+        wb.write()
+        output.next_record_id = offset
+
+        keys, conflicts, created = 0, 0, 0
+        merged = heapq.merge(*(shard.hash_items() for shard in shards))
+        groups = ((key, [(index, rawval) for (_, index, rawval) in group])
+                  for (key, group) in itertools.groupby(merged, key=lambda item: item[0]))
+        while True:
+            batch = list(itertools.islice(groups, batch_size))
+            if not batch:
+                break
+            with outdb.write_batch() as wb:
+                (batchconflicts, batchcreated) = _resolve(batch, shards, output, replace, wb)
+            keys += len(batch)
+            conflicts += batchconflicts
+            created += batchcreated
+            if keys % (100 * batch_size) == 0:
+                _log.info("%d keys merged", keys)
+        _log.info("%d keys merged, %d were in more than one shard, %d new records", keys, conflicts, created)
+
+        for shard in shards:
+            (copied, skipped) = _copy_records(shard, output, batch_size)
+            _log.info("%d records copied from %s, %d no longer referenced", copied, shard.path, skipped)
+        outdb.close()
+    finally:
+        for shard in shards:
+            shard.dbif.close()
+    return keys
+
+def merge_sources(shardpaths, outpath):
+    """
+    Merge the processed sources databases of build_aosp_hashlist next to the shards, if there are any.
+    """
+    sourcepaths = [build_aosp_hashlist.sourcesdb_path(path) for path in shardpaths]
+    sourcepaths = [path for path in sourcepaths if os.path.isdir(path)]
+    if not sourcepaths:
+        return
+    outdb = plyvel.DB(build_aosp_hashlist.sourcesdb_path(outpath), create_if_missing=True)
+    for path in sourcepaths:
+        dbif = plyvel.DB(path)
+        with outdb.write_batch() as wb:
+            for (key, value) in dbif.iterator():
+                wb.put(key, value)
+        dbif.close()
+        _log.info("Sources of %s merged", path)
+    outdb.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge shard hash databases into one")
+    parser.add_argument("output", help="The merged leveldb database, must not exist")
+    parser.add_argument("shards", nargs="+", help="The shard leveldb databases, later shards replace values of earlier ones")
+    parser.add_argument("--keep-first", action="store_true", help="Keep the value of the first shard of a digest instead of replacing it")
+    parser.add_argument("-b", "--batch-size", type=int, default=BATCH_SIZE, help="Digests per write batch. Default: %(default)s")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    merge(args.shards, args.output, replace=not args.keep_first, batch_size=args.batch_size)
+    merge_sources(args.shards, args.output)
+
+if __name__ == "__main__":
+    main()
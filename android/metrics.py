@@ -0,0 +1,170 @@
+__author__ = 'ivo'
+
+"""
+Stage timers, counters and gauges of the image and whitelist pipelines, shared by all modules of a process.
+
+    with metrics.timer("hash"):
+        ...
+    metrics.count("files")
+    metrics.progress()
+
+Stages: walk, read, hash, db_lookup, db_write, unsparse, mount, extract, decompress. Stage timers are inclusive, the
+hash stage includes the read stage of the same file, and for boot image ramdisks the decompress stage. Timing a stage
+costs two perf_counter calls, so it is done per file, per batch or per read buffer, never per block.
+
+progress logs a line with the files/s and bytes/s at most every progress_interval seconds. dump writes everything as
+json or in the Prometheus text format, main scripts call it at exit with --metrics PATH. Worker processes send their
+snapshot back, the parent merges it. Threads of a process share the metrics, updates hold _lock.
+"""
+
+import atexit
+import json
+import logging
+import threading
+import time
+
+_log = logging.getLogger()
+
+_config = {"progress_interval": 10.0, # Seconds between progress lines
+           "prefix": "android" # Prefix of the Prometheus metric names
+           }
+
+# Stage -> [calls, seconds]
+_stages = {}
+# Name -> number
+_counters = {}
+# Name -> number
+_gauges = {}
+_state = {"start": time.perf_counter(), "last_progress": time.perf_counter()}
+_lock = threading.Lock()
+
+def configure(**kwargs):
+    _config.update(**kwargs)
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _gauges.clear()
+        _state.update(start=time.perf_counter(), last_progress=time.perf_counter())
+
+class _Timer():
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_time(self.stage, time.perf_counter() - self.start)
+
+def timer(stage):
+    """
+    :return: context manager that adds its duration to stage
+    """
+    return _Timer(stage)
+
+def add_time(stage, seconds, calls=1):
+    with _lock:
+        stats = _stages.get(stage)
+        if stats is None:
+            stats = _stages[stage] = [0, 0.0]
+        stats[0] += calls
+        stats[1] += seconds
+
+def timed(stage, iterable):
+    """
+    Iterate over iterable, with the time spent in the iterable added to stage. For walkers and other generators.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            add_time(stage, time.perf_counter() - start, calls=0)
+            return
+        add_time(stage, time.perf_counter() - start)
+        yield item
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+def _rates():
+    seconds = time.perf_counter() - _state["start"]
+    if seconds > 0:
+        gauge("files_per_second", _counters.get("files", 0) / seconds)
+        gauge("bytes_per_second", _counters.get("bytes", 0) / seconds)
+    gauge("elapsed_seconds", seconds)
+
+def progress(force=False):
+    """
+    Log a progress line, if the last one is at least progress_interval seconds ago.
+    """
+    now = time.perf_counter()
+    with _lock:
+        if not force and now - _state["last_progress"] < _config["progress_interval"]:
+            return
+        _state["last_progress"] = now
+        stages = ", ".join("{} {:.1f}s".format(stage, seconds) for (stage, (calls, seconds)) in sorted(_stages.items()))
+    _rates()
+    _log.info("%d files, %.1f MB, %.0f files/s, %.1f MB/s (%s)", _counters.get("files", 0),
+              _counters.get("bytes", 0) / 1e6, _gauges["files_per_second"], _gauges["bytes_per_second"] / 1e6,
+              stages)
+
+def snapshot():
+    """
+    :return: dict with the stages, counters and gauges, can be json encoded and merged into another process
+    """
+    _rates()
+    with _lock:
+        return {"stages": {stage: {"calls": calls, "seconds": seconds} for (stage, (calls, seconds)) in _stages.items()},
+                "counters": dict(_counters),
+                "gauges": dict(_gauges)}
+
+def merge(other):
+    """
+    Add the stages and counters of a snapshot of another process. Its gauges are left out, they are not additive.
+    """
+    for (stage, stats) in other["stages"].items():
+        add_time(stage, stats["seconds"], stats["calls"])
+    for (name, value) in other["counters"].items():
+        count(name, value)
+
+def prometheus_text(data=None):
+    data = data or snapshot()
+    prefix = _config["prefix"]
+    lines = ["# TYPE {}_stage_seconds_total counter".format(prefix)]
+    lines += ['{}_stage_seconds_total{{stage="{}"}} {}'.format(prefix, stage, stats["seconds"])
+              for (stage, stats) in sorted(data["stages"].items())]
+    lines.append("# TYPE {}_stage_calls_total counter".format(prefix))
+    lines += ['{}_stage_calls_total{{stage="{}"}} {}'.format(prefix, stage, stats["calls"])
+              for (stage, stats) in sorted(data["stages"].items())]
+    for (name, value) in sorted(data["counters"].items()):
+        lines += ["# TYPE {}_{}_total counter".format(prefix, name), "{}_{}_total {}".format(prefix, name, value)]
+    for (name, value) in sorted(data["gauges"].items()):
+        lines += ["# TYPE {}_{} gauge".format(prefix, name), "{}_{} {}".format(prefix, name, value)]
+    return "\n".join(lines) + "\n"
+
+def dump(path):
+    """
+    Write the metrics to path, as json if it ends with .json, in the Prometheus text format otherwise.
+    """
+    data = snapshot()
+    with open(path, "w") as fh:
+        if path.endswith(".json"):
+            json.dump(data, fh, indent=2, sort_keys=True)
+        else:
+            fh.write(prometheus_text(data))
+    _log.info("Metrics written to %s", path)
+
+def dump_at_exit(path):
+    atexit.register(dump, path)
@@ -0,0 +1,257 @@
+__author__ = 'ivo'
+
+"""
+Storage format of the hash databases.
+
+Format 1 (json): every digest key (md5, sha1 and sha256 of a file) has its own json value
+    {"filepath": ..., "source_id": ..., "threat": ..., "trust": ...}
+
+Format 2 (binary): one record per file, the digest keys point to it.
+    digest key -> struct ">BQ" (2, record id)
+    b"rec:" + record id (8 bytes big endian) -> struct "<BIIB" (kind, source index, dir index, threat << 4 | trust)
+                                                 followed by the utf8 file name
+    b"src:" + source index (4 bytes big endian) -> source id
+    b"dir:" + dir index (4 bytes big endian) -> directory path
+    b"meta:format" -> b"2"
+An index of NONE_INDEX is a source id of None, a level of NONE_LEVEL is a threat or trust of None.
+A record of kind RECORD_OWNED is only pointed to by digests of one file content, so by at most one digest of each
+size: when those are found pointing elsewhere the record is no longer used. Records of kind RECORD_SHARED (2, the
+value of FORMAT_BINARY) can be pointed to by the digests of different files with the same value, like the records of
+migrate, and are kept.
+
+Keys that are not digests are never 16, 20 or 32 bytes long, so digest keys are told apart by their length.
+Values are decoded by their first byte, so a database that is half way a migration reads fine.
+"""
+
+import argparse
+import json
+import logging
+import os
+import struct
+
+import plyvel
+
+_log = logging.getLogger(__name__)
+
+FORMAT_JSON = 1
+FORMAT_BINARY = 2
+
+HASH_KEY_SIZES = (16, 20, 32)
+FORMAT_KEY = b"meta:format"
+RECORD_PREFIX = b"rec:"
+SOURCE_PREFIX = b"src:"
+DIR_PREFIX = b"dir:"
+
+POINTER_FORMAT = ">BQ"
+POINTER_SIZE = struct.calcsize(POINTER_FORMAT)
+RECORD_FORMAT = "<BIIB"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_FORMAT)
+RECORD_SHARED = FORMAT_BINARY
+RECORD_OWNED = 3
+NONE_INDEX = 0xFFFFFFFF
+NONE_LEVEL = 0xF
+
+TRUST_LEVELS = {"high":2, # Known good source
+                "medium":1, # Source probably good, but not verified
+                "low":0} # Source trust unknown
+
+THREAT_LEVELS = {"good":0,
+                 "evil":1}
+
+def is_hash_key(key):
+    return len(key) in HASH_KEY_SIZES
+
+def lookup_sorted(dbif, keys):
+    """
+    Look up sorted keys with one iterator that only seeks forward.
+    :return: dict with the values of the keys that are in the db
+    """
+    found = {}
+    with dbif.iterator() as it:
+        for key in keys:
+            it.seek(key)
+            try:
+                (curkey, curval) = next(it)
+            except StopIteration:
+                break
+            if curkey == key:
+                found[key] = curval
+    return found
+
+def _pack_level(level, names):
+    if level is None:
+        return NONE_LEVEL
+    # Older json databases have the level names
+    level = names.get(level, level)
+    if not isinstance(level, int) or not 0 <= level < NONE_LEVEL:
+        raise ValueError("Level {} can not be packed".format(level))
+    return level
+
+def _unpack_level(level):
+    return None if level == NONE_LEVEL else level
+
+def _record_key(record_id):
+    return RECORD_PREFIX + record_id.to_bytes(8, "big")
+
+class RecordStore():
+    """
+    Encodes and decodes the values of a hash database, in the format of the database. A new database gets the binary
+    format, a database with digest keys but without format key is a json database.
+    The source and directory dictionaries are kept in memory, so one RecordStore should write to a db at a time.
+    """
+    def __init__(self, dbif):
+        self.dbif = dbif
+        fmt = dbif.get(FORMAT_KEY)
+        if fmt is not None:
+            self.format = int(fmt)
+        elif any(is_hash_key(key) for key in dbif.iterator(include_value=False)):
+            self.format = FORMAT_JSON
+        else:
+            self.format = FORMAT_BINARY
+            dbif.put(FORMAT_KEY, str(FORMAT_BINARY).encode())
+        self.sources = self._load_dictionary(SOURCE_PREFIX)
+        self.dirs = self._load_dictionary(DIR_PREFIX)
+        self._source_index = {source: index for index, source in self.sources.items()}
+        self._dir_index = {dirpath: index for index, dirpath in self.dirs.items()}
+        self.next_record_id = 0
+        with dbif.iterator(prefix=RECORD_PREFIX, reverse=True, include_value=False) as it:
+            for key in it:
+                self.next_record_id = int.from_bytes(key[len(RECORD_PREFIX):], "big") + 1
+                break
+        _log.debug("Record format %d, %d sources, %d dirs, %d records", self.format, len(self.sources),
+                   len(self.dirs), self.next_record_id)
+
+    def _load_dictionary(self, prefix):
+        return {int.from_bytes(key[len(prefix):], "big"): str(value, encoding="utf8", errors="surrogateescape")
+                for (key, value) in self.dbif.iterator(prefix=prefix)}
+
+    def _intern(self, value, index, dictionary, prefix, wb):
+        if value is None:
+            return NONE_INDEX
+        if value not in index:
+            newindex = len(dictionary)
+            dictionary[newindex] = value
+            index[value] = newindex
+            wb.put(prefix + newindex.to_bytes(4, "big"), value.encode("utf8", errors="surrogateescape"))
+        return index[value]
+
+    def pack(self, value, wb, owned=False, record_id=None):
+        """
+        Encode a value for the digest keys of a file. In the binary format the record is put in write batch wb, call
+        pack once per file and put the result under all its digests.
+        :param value: dict with filepath, source_id, threat and trust
+        :param owned: only digests of one file content point to the record, see RECORD_OWNED
+        :param record_id: replace this record instead of adding one
+        :return: the bytes to store under the digest keys
+        """
+        if self.format == FORMAT_JSON:
+            return bytes(json.dumps(value), encoding="utf8")
+        source_id = value["source_id"]
+        sourceindex = self._intern(None if source_id is None else str(source_id), self._source_index, self.sources,
+                                   SOURCE_PREFIX, wb)
+        (dirpath, name) = os.path.split(value["filepath"])
+        dirindex = self._intern(dirpath, self._dir_index, self.dirs, DIR_PREFIX, wb)
+        levels = _pack_level(value["threat"], THREAT_LEVELS) << 4 | _pack_level(value["trust"], TRUST_LEVELS)
+        if record_id is None:
+            record_id = self.next_record_id
+            self.next_record_id += 1
+        wb.put(_record_key(record_id), struct.pack(RECORD_FORMAT, RECORD_OWNED if owned else RECORD_SHARED,
+                                                   sourceindex, dirindex, levels)
+               + name.encode("utf8", errors="surrogateescape"))
+        return struct.pack(POINTER_FORMAT, FORMAT_BINARY, record_id)
+
+    def delete(self, record_id, wb):
+        wb.delete(_record_key(record_id))
+
+    def _unpack_record(self, blob):
+        (version, sourceindex, dirindex, levels) = struct.unpack_from(RECORD_FORMAT, blob)
+        name = str(blob[RECORD_HEADER_SIZE:], encoding="utf8", errors="surrogateescape")
+        return {"filepath": os.path.join(self.dirs[dirindex], name),
+                "source_id": None if sourceindex == NONE_INDEX else self.sources[sourceindex],
+                "threat": _unpack_level(levels >> 4),
+                "trust": _unpack_level(levels & 0xF)}
+
+    def unpack_many(self, rawvals, owners=None):
+        """
+        Decode the values of digest keys, in either format. Records are looked up with one sorted sweep.
+        :param rawvals: dict of digest key -> stored value
+        :param owners: dict that gets record id -> set of the digest keys in rawvals pointing to it, for the records
+        of kind RECORD_OWNED
+        :return: dict of digest key -> value dict
+        """
+        values = {}
+        pointers = {}
+        for (key, rawval) in rawvals.items():
+            if rawval[:1] == b"{":
+                values[key] = json.loads(str(rawval, encoding="utf8"))
+            else:
+                (version, record_id) = struct.unpack(POINTER_FORMAT, rawval)
+                pointers[key] = _record_key(record_id)
+        records = lookup_sorted(self.dbif, sorted(set(pointers.values())))
+        for (key, recordkey) in pointers.items():
+            if recordkey in records:
+                blob = records[recordkey]
+                values[key] = self._unpack_record(blob)
+                if owners is not None and blob[0] == RECORD_OWNED:
+                    owners.setdefault(int.from_bytes(recordkey[len(RECORD_PREFIX):], "big"), set()).add(key)
+            else:
+                _log.warning("Record of %s missing", repr(key))
+        return values
+
+    def get_many(self, keys):
+        """
+        :param keys: digests to look up
+        :return: dict of digest -> value dict, for the digests that are in the db
+        """
+        return self.unpack_many(lookup_sorted(self.dbif, sorted(set(keys))))
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+def migrate(dbif, batch_size=4096):
+    """
+    Convert a json database to the binary format. The digest keys of a file have identical json values, these get a
+    single record. Can be interrupted and run again.
+    :return: Number of converted digest keys
+    """
+    store = RecordStore(dbif)
+    if store.format == FORMAT_BINARY:
+        _log.info("Database is in the binary format already")
+        return 0
+    store.format = FORMAT_BINARY
+    # The digest keys of a file are far apart in the db, so the pointer of every distinct json value is kept
+    pointers = {}
+    converted = 0
+    wb = dbif.write_batch()
+    # The iterator reads from a snapshot, so the writes do not show up in it
+    for (key, rawval) in dbif.iterator():
+        if not is_hash_key(key) or rawval[:1] != b"{":
+            continue
+        if rawval not in pointers:
+            pointers[rawval] = store.pack(json.loads(str(rawval, encoding="utf8")), wb)
+        wb.put(key, pointers[rawval])
+        converted += 1
+        if converted % batch_size == 0:
+            wb.write()
+            wb = dbif.write_batch()
+            _log.info("%d keys converted", converted)
+    wb.put(FORMAT_KEY, str(FORMAT_BINARY).encode())
+    wb.write()
+    _log.info("%d keys converted to %d records, %d sources and %d dirs", converted, len(pointers),
+              len(store.sources), len(store.dirs))
+    return converted
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a json hash database to the binary record format")
+    parser.add_argument("database", help="The leveldb hash database")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    dbif = plyvel.DB(args.database)
+    migrate(dbif)
+    dbif.compact_range()
+    dbif.close()
+
+if __name__ == "__main__":
+    main()
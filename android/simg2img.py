@@ -9,9 +9,21 @@ This code is copied and rewritten from Google code.
 """
 
 import argparse
+import sys
 import logging
 import struct
 import os
+import zlib
+import functools
+import concurrent.futures
+import threading
+import errno
+import stat
+import io
+import bisect
+import time
+
+from android import metrics
 
 _log = logging.getLogger()
 
@@ -27,6 +39,11 @@ class SparseHeader():
         sh.total_blks, sh.total_chunks, sh.image_checksum) = struct.unpack(cls.format, blob)
         return sh
 
+    def to_bytes(self):
+        return struct.pack(self.format, self.magic, self.major_version, self.minor_version,
+                           self.file_hdr_sz, self.chunk_hdr_sz, self.blk_sz,
+                           self.total_blks, self.total_chunks, self.image_checksum)
+
     def __repr__(self):
         return "<{}({})>".format(self.__class__.__name__, vars(self))
 
@@ -40,6 +57,9 @@ class ChunkHeader():
         (ch.chunk_type, ch.reserved1, ch.chunk_sz, ch.total_sz) = struct.unpack(cls.format, blob)
         return ch
 
+    def to_bytes(self):
+        return struct.pack(self.format, self.chunk_type, self.reserved1, self.chunk_sz, self.total_sz)
+
     def __repr__(self):
         return "<{}({})>".format(self.__class__.__name__, vars(self))
 
@@ -102,72 +122,322 @@ crc32_tab = [
         0xb40bbe37, 0xc30c8ea1, 0x5a05df1b, 0x2d02ef8d
     ]
 
-def sparse_crc32(crc32_in, buf):
-    size = len(buf)
-    crc32 = 0
-
+def sparse_crc32_table(crc32_in, buf):
+    """
+    Reference implementation using crc32_tab, one byte at a time. Very slow, only kept to validate other engines.
+    """
     crc32 = crc32_in ^ 0xFFFFFFFF
-    for i in range(size):
-        crc32 = crc32_tab[(crc32 ^ buf[i]) & 0xFF] ^ (crc32 >> 8)
+    for b in bytes(buf):
+        crc32 = crc32_tab[(crc32 ^ b) & 0xFF] ^ (crc32 >> 8)
     return crc32 ^ 0xFFFFFFFF
 
-def process_raw_chunk(infd, outfd, num_blocks, blk_sz, crc32):
+def sparse_crc32(crc32_in, buf):
+    """
+    zlib uses the same 802.3 polynomial and pre/post inversion as crc32_tab, so results are identical.
+    """
+    return zlib.crc32(buf, crc32_in)
+
+CRC32_POLY = 0xEDB88320
+
+def _crc32_multmodp(a, b):
+    # Multiply a and b modulo the (reflected) crc polynomial. Ported from zlib crc32.c
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ CRC32_POLY if b & 1 else b >> 1
+    return p
+
+_crc32_x2n_table = [1 << 30]
+for _i in range(1, 32):
+    _crc32_x2n_table.append(_crc32_multmodp(_crc32_x2n_table[-1], _crc32_x2n_table[-1]))
+
+def _crc32_x8nmodp(length):
+    # x^(8*length) modulo the crc polynomial
+    p = 1 << 31
+    k = 3
+    while length:
+        if length & 1:
+            p = _crc32_multmodp(_crc32_x2n_table[k & 31], p)
+        length >>= 1
+        k += 1
+    return p
+
+def crc32_combine(crc1, crc2, len2):
+    """
+    Crc of the concatenation of two buffers, given the crc of both and the length of the second one. Same as zlib's
+    crc32_combine(), which the python zlib module does not expose.
+    """
+    return _crc32_multmodp(_crc32_x8nmodp(len2), crc1) ^ crc2
+
+def crc32_zeros(crc32_in, length):
+    """
+    Same as sparse_crc32(crc32_in, bytes(length)) but in O(log(length)) time.
+    """
+    return _crc32_multmodp(_crc32_x8nmodp(length), crc32_in ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+CRC_VERIFY = "verify"
+CRC_COMPUTE = "compute"
+CRC_OFF = "off"
+CRC_MODES = (CRC_VERIFY, CRC_COMPUTE, CRC_OFF)
+
+class Crc32Engine():
+    """
+    Running crc32 of the unsparsed output. Don't care blocks count as zeroes, like in libsparse.
+    mode is one of:
+    verify: compute and raise on mismatch with CRC32 chunks or the header image_checksum
+    compute: compute and only log mismatches
+    off: do nothing
+    crcfunc can be used to plug in another implementation with the signature of sparse_crc32.
+    """
+    def __init__(self, mode=CRC_VERIFY, crcfunc=sparse_crc32):
+        if mode not in CRC_MODES:
+            raise ValueError("Unknown crc mode {}".format(mode))
+        self.mode = mode
+        self.crcfunc = crcfunc
+        self.value = 0
+
+    @property
+    def enabled(self):
+        return self.mode != CRC_OFF
+
+    def update(self, buf):
+        if self.enabled:
+            self.value = self.crcfunc(self.value, buf)
+        return self.value
+
+    def update_zeros(self, length):
+        if self.enabled:
+            self.value = crc32_zeros(self.value, length)
+        return self.value
+
+    def combine(self, crc2, len2):
+        """
+        Append a part of the output of which the crc32 (starting from 0) was computed separately.
+        """
+        if self.enabled:
+            self.value = crc32_combine(self.value, crc2, len2)
+        return self.value
+
+    def check(self, expected, what="crc32"):
+        if not self.enabled:
+            return True
+        if expected == self.value:
+            return True
+        _log.error("computed %s of 0x%8.8x, expected 0x%8.8x", what, self.value, expected)
+        if self.mode == CRC_VERIFY:
+            raise Exception("{} mismatch".format(what))
+        return False
+
+    def __repr__(self):
+        return "<{}({}, 0x{:08x})>".format(self.__class__.__name__, self.mode, self.value)
+
+OUTPUT_DENSE = "dense"
+OUTPUT_HOLES = "holes"
+OUTPUT_MODES = (OUTPUT_DENSE, OUTPUT_HOLES)
+
+class UnsparseStats():
+    """
+    What unsparse did. bytes_skipped are output bytes that were seeked over instead of written, which become holes
+    in the output file.
+    """
+    def __init__(self, crc, output_mode=OUTPUT_DENSE):
+        self.crc = crc
+        self.output_mode = output_mode
+        self.total_blocks = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, vars(self))
+
+@functools.lru_cache(maxsize=16)
+def _fill_buffer(fill_val):
+    return fill_val * (COPY_BUF_SIZE // 4)
+
+def _readinto_full(inputfd, view):
+    # readinto until view is full or end of file, non-buffered streams (pipes, sockets) may return less
+    pos = 0
+    while pos < len(view):
+        ret = inputfd.readinto(view[pos:])
+        if not ret:
+            break
+        pos += ret
+    return pos
+
+def _read_full(inputfd, size):
+    buf = bytearray(size)
+    return bytes(buf[:_readinto_full(inputfd, memoryview(buf))])
+
+def _skip_input(inputfd, length):
+    """
+    Skip length bytes of input. Non seekable input is read and discarded.
+    """
+    if length <= 0:
+        return
+    seekable = getattr(inputfd, "seekable", None)
+    if seekable and seekable():
+        inputfd.seek(length, 1)
+        return
+    copybuf = _copy_buffer()
+    while length:
+        size = COPY_BUF_SIZE if length > COPY_BUF_SIZE else length
+        ret = _readinto_full(inputfd, copybuf[:size])
+        if ret != size:
+            _log.error("read returned an error skipping input: %d %d", ret, size)
+            raise Exception()
+        length -= size
+
+_copy_state = threading.local()
+
+def _copy_buffer():
+    # One reusable copy buffer per thread
+    buf = getattr(_copy_state, "buf", None)
+    if buf is None:
+        buf = _copy_state.buf = memoryview(bytearray(COPY_BUF_SIZE))
+    return buf
+
+def _regular_fileno(fh):
+    try:
+        fd = fh.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    return fd if stat.S_ISREG(os.fstat(fd).st_mode) else None
+
+def _copy_file_range(in_fd, out_fd, in_offset, out_offset, length):
+    """
+    Copy kernel side with copy_file_range(2). Returns False if that is not supported for these files, in which case
+    nothing was copied.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    copied = 0
+    while copied < length:
+        try:
+            ret = os.copy_file_range(in_fd, out_fd, length - copied, in_offset + copied, out_offset + copied)
+        except OSError as e:
+            if copied == 0 and e.errno in _KERNEL_COPY_UNSUPPORTED:
+                return False
+            raise
+        if ret <= 0:
+            _log.error("copy_file_range returned an error copying a raw chunk: %d %d", copied, length)
+            raise Exception()
+        copied += ret
+    return True
+
+def _sendfile(in_fd, out_fd, in_offset, out_offset, length):
+    """
+    Copy kernel side with sendfile(2). Moves the file position of out_fd. Returns False if not supported.
+    """
+    if not hasattr(os, "sendfile"):
+        return False
+    os.lseek(out_fd, out_offset, os.SEEK_SET)
+    copied = 0
+    while copied < length:
+        try:
+            ret = os.sendfile(out_fd, in_fd, in_offset + copied, length - copied)
+        except OSError as e:
+            if copied == 0 and e.errno in _KERNEL_COPY_UNSUPPORTED:
+                return False
+            raise
+        if ret <= 0:
+            _log.error("sendfile returned an error copying a raw chunk: %d %d", copied, length)
+            raise Exception()
+        copied += ret
+    return True
+
+_KERNEL_COPY_UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+def _copy_kernel_side(infd, outfd, length):
+    """
+    Copy length bytes from the current position of file object infd to the current position of outfd without
+    passing the data through python. Only works when both are regular files. Returns False if not possible.
+    """
+    in_fd, out_fd = _regular_fileno(infd), _regular_fileno(outfd)
+    if in_fd is None or out_fd is None:
+        return False
+    in_offset = infd.tell()
+    outfd.flush()
+    out_offset = outfd.tell()
+    if not (_copy_file_range(in_fd, out_fd, in_offset, out_offset, length) or
+            _sendfile(in_fd, out_fd, in_offset, out_offset, length)):
+        return False
+    infd.seek(in_offset + length)
+    outfd.seek(out_offset + length)
+    return True
+
+def process_raw_chunk(infd, outfd, num_blocks, blk_sz, crc, stats):
     total_len = num_blocks * blk_sz
 
+    # The crc needs the data in user space, so the kernel side copy is only used without crc
+    if not crc.enabled and _copy_kernel_side(infd, outfd, total_len):
+        stats.bytes_written += total_len
+        return num_blocks
+
+    copybuf = _copy_buffer()
     while total_len:
         chunk_size =  COPY_BUF_SIZE if (total_len > COPY_BUF_SIZE) else total_len
-        copybuf = infd.read(chunk_size)
-        if len(copybuf) != chunk_size:
-            _log.error("read returned an error copying a raw chunk: %d %d",len(copybuf), chunk_size)
+        view = copybuf[:chunk_size]
+        ret = _readinto_full(infd, view)
+        if ret != chunk_size:
+            _log.error("read returned an error copying a raw chunk: %d %d", ret, chunk_size)
             raise Exception()
-        crc32 = sparse_crc32(crc32, copybuf)
-        ret = outfd.write(copybuf)
-        if ret != len(copybuf):
+        crc.update(view)
+        ret = outfd.write(view)
+        if ret != chunk_size:
             _log.error("write returned an error copying a raw chunk")
             raise Exception()
-        total_len -= len(copybuf)
-    return num_blocks, crc32
+        total_len -= chunk_size
+        stats.bytes_written += chunk_size
+    return num_blocks
 
-def process_fill_chunk(inputfd, outputfd, num_blocks, block_size, crc32):
+def process_fill_chunk(inputfd, outputfd, num_blocks, block_size, crc, stats):
     rest_len = num_blocks * block_size
-    ret = 0
-    fillbuf = []
 
-# 	Fill copy_buf with the fill value
-    fill_val = inputfd.read(4)
-    for i in range(COPY_BUF_SIZE / 4):
-        fillbuf.extend(fill_val)
+    fill_val = _read_full(inputfd, 4)
+    if len(fill_val) != 4:
+        _log.error("read returned an error copying a fill chunk")
+        raise Exception()
+    if stats.output_mode == OUTPUT_HOLES and fill_val == b"\x00\x00\x00\x00":
+        return process_skip_chunk(outputfd, num_blocks, block_size, crc, stats)
+    fillbuf = _fill_buffer(fill_val)
 
     while rest_len:
         chunksize = COPY_BUF_SIZE if rest_len > COPY_BUF_SIZE else rest_len
-        crc32 = sparse_crc32(crc32, fillbuf)
-        ret = outputfd.write(fillbuf)
-    if ret != len(fillbuf):
-        _log.error("write returned an error copying a raw chunk")
-        raise Exception()
-
-    rest_len -= len(fillbuf)
-    return num_blocks, crc32
+        buf = fillbuf if chunksize == COPY_BUF_SIZE else fillbuf[:chunksize]
+        crc.update(buf)
+        ret = outputfd.write(buf)
+        if ret != len(buf):
+            _log.error("write returned an error copying a fill chunk")
+            raise Exception()
+        rest_len -= len(buf)
+        stats.bytes_written += len(buf)
+    return num_blocks
 
-def process_skip_chunk(outputfd, num_blocks, block_size, crc32):
+def process_skip_chunk(outputfd, num_blocks, block_size, crc, stats):
     rest_len = num_blocks * block_size
     outputfd.seek(rest_len, 1)
-    return num_blocks, crc32
+    crc.update_zeros(rest_len)
+    stats.bytes_skipped += rest_len
+    return num_blocks
 
-def process_crc32_chunk(inputfd, crc32):
-    file_crc32 = inputfd.read(4)
+def process_crc32_chunk(inputfd, crc):
+    file_crc32 = _read_full(inputfd, 4)
     if (len(file_crc32) != 4):
         _log.error("read returned an error copying a crc32 chunk")
         raise Exception()
-    if (file_crc32 != crc32):
-        _log.error("computed crc32 of 0x%8.8x, expected 0x%8.8x", crc32, file_crc32)
-        raise Exception()
-
-def unsparse(inputfd, outputfd):
-    total_blocks = 0
-    crc32 = 0
-
-    sparse_header = SparseHeader.from_bytes(inputfd.read(SPARSE_HEADER_LEN))
+    (file_crc32,) = struct.unpack("<I", file_crc32)
+    crc.check(file_crc32, "crc32 chunk")
+
+def read_sparse_header(inputfd):
+    """
+    Read and validate the sparse header. The file position is left at the first chunk header.
+    """
+    sparse_header = SparseHeader.from_bytes(_read_full(inputfd, SPARSE_HEADER_LEN))
     _log.info("Read sparse_header:\n%s", repr(sparse_header))
 
     if sparse_header.magic != SPARSE_HEADER_MAGIC:
@@ -179,42 +449,76 @@ def unsparse(inputfd, outputfd):
         raise Exception("Unknown major version number")
 
     if sparse_header.file_hdr_sz > SPARSE_HEADER_LEN:
-        inputfd.seek(sparse_header.file_hdr_sz - SPARSE_HEADER_LEN, 1)
+        _skip_input(inputfd, sparse_header.file_hdr_sz - SPARSE_HEADER_LEN)
+    return sparse_header
+
+def read_chunk_header(inputfd, sparse_header, i):
+    """
+    Read and validate chunk header number i. The file position is left at the chunk data.
+    """
+    chunk_header = ChunkHeader.from_bytes(_read_full(inputfd, CHUNK_HEADER_LEN))
+    _log.debug("Read chunk_header:\n%s", repr(chunk_header))
+    if sparse_header.chunk_hdr_sz > CHUNK_HEADER_LEN:
+        _skip_input(inputfd, sparse_header.chunk_hdr_sz - CHUNK_HEADER_LEN)
+
+    if chunk_header.chunk_type == CHUNK_TYPE_RAW:
+        if (chunk_header.total_sz != (sparse_header.chunk_hdr_sz +
+                                          (chunk_header.chunk_sz * sparse_header.blk_sz))):
+            _log.error("Bogus chunk size for chunk %d, type Raw", i)
+            raise Exception()
+    elif chunk_header.chunk_type == CHUNK_TYPE_FILL:
+        if (chunk_header.total_sz != (sparse_header.chunk_hdr_sz + 4)):
+            _log.error("Bogus chunk size for chunk %d, type Fill", i)
+            raise Exception()
+    elif chunk_header.chunk_type == CHUNK_TYPE_DONT_CARE:
+        if (chunk_header.total_sz != sparse_header.chunk_hdr_sz):
+            _log.error("Bogus chunk size for chunk %d, type Dont Care", i)
+            raise Exception()
+    return chunk_header
+
+def _record_metrics(stats, seconds):
+    metrics.add_time("unsparse", seconds)
+    metrics.count("unsparse_bytes_written", stats.bytes_written)
+    metrics.count("unsparse_bytes_skipped", stats.bytes_skipped)
+
+def unsparse(inputfd, outputfd, crc_mode=CRC_VERIFY, output_mode=OUTPUT_DENSE):
+    """
+    Unsparse inputfd to outputfd. inputfd does not need to be seekable, outputfd has to be a real file.
+    :param crc_mode: One of CRC_MODES or a Crc32Engine instance
+    :param output_mode: OUTPUT_DENSE writes all fill chunks. OUTPUT_HOLES seeks over zero fill chunks too, so they
+    become holes like the don't care chunks. outputfd should be a new or truncated file for OUTPUT_HOLES.
+    :return: UnsparseStats. Its crc is the Crc32Engine used, with the crc32 of the output as value (if not off)
+    """
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError("Unknown output mode {}".format(output_mode))
+    started = time.perf_counter()
+    total_blocks = 0
+    crc = crc_mode if isinstance(crc_mode, Crc32Engine) else Crc32Engine(crc_mode)
+    stats = UnsparseStats(crc, output_mode)
+
+    sparse_header = read_sparse_header(inputfd)
 
     for i in range(sparse_header.total_chunks):
-        chunk_header = ChunkHeader.from_bytes(inputfd.read(CHUNK_HEADER_LEN))
-        _log.debug("Read chunk_header:\n%s", repr(chunk_header))
-        if sparse_header.chunk_hdr_sz > CHUNK_HEADER_LEN:
-            inputfd.seek(sparse_header.chunk_hdr_sz - CHUNK_HEADER_LEN, 1)
+        chunk_header = read_chunk_header(inputfd, sparse_header, i)
 
         if chunk_header.chunk_type == CHUNK_TYPE_RAW:
-            if (chunk_header.total_sz != (sparse_header.chunk_hdr_sz +
-                                              (chunk_header.chunk_sz * sparse_header.blk_sz))):
-                _log.error("Bogus chunk size for chunk %d, type Raw", i)
-                raise Exception()
-            (numblocks, crc32) = process_raw_chunk(inputfd, outputfd, chunk_header.chunk_sz, sparse_header.blk_sz, crc32)
+            numblocks = process_raw_chunk(inputfd, outputfd, chunk_header.chunk_sz, sparse_header.blk_sz, crc, stats)
             total_blocks += numblocks
 
         elif chunk_header.chunk_type == CHUNK_TYPE_FILL:
-            if (chunk_header.total_sz != (sparse_header.chunk_hdr_sz + 4)):
-                _log.error("Bogus chunk size for chunk %d, type Fill", i)
-                raise Exception()
-
-            numblocks, crc32 = process_fill_chunk(inputfd, outputfd, chunk_header.chunk_sz, sparse_header.blk_sz, crc32)
+            numblocks = process_fill_chunk(inputfd, outputfd, chunk_header.chunk_sz, sparse_header.blk_sz, crc, stats)
             total_blocks += numblocks
 
         elif chunk_header.chunk_type == CHUNK_TYPE_DONT_CARE:
-            if (chunk_header.total_sz != sparse_header.chunk_hdr_sz):
-                _log.error("Bogus chunk size for chunk %d, type Dont Care", i)
-                raise Exception()
-            numblocks, crc32 = process_skip_chunk(outputfd, chunk_header.chunk_sz, sparse_header.blk_sz, crc32)
+            numblocks = process_skip_chunk(outputfd, chunk_header.chunk_sz, sparse_header.blk_sz, crc, stats)
             total_blocks += numblocks
 
         elif chunk_header.chunk_type == CHUNK_TYPE_CRC32:
-            process_crc32_chunk(inputfd, crc32)
+            process_crc32_chunk(inputfd, crc)
 
         else:
             _log.error("Unknown chunk type 0x%4.4x", chunk_header.chunk_type)
+            _skip_input(inputfd, chunk_header.total_sz - sparse_header.chunk_hdr_sz)
 
     os.ftruncate(outputfd.fileno(), total_blocks * sparse_header.blk_sz)
 
@@ -222,16 +526,394 @@ def unsparse(inputfd, outputfd):
         _log.error("Wrote %d blocks, expected to write %d blocks", total_blocks, sparse_header.total_blks)
         raise Exception()
 
+    # image_checksum is optional, most images leave it 0
+    if sparse_header.image_checksum:
+        crc.check(sparse_header.image_checksum, "image checksum")
+    stats.total_blocks = total_blocks
+    _log.info("Output crc32: %s", repr(crc))
+    _log.info("%d bytes written, %d bytes skipped", stats.bytes_written, stats.bytes_skipped)
+    _record_metrics(stats, time.perf_counter() - started)
+    return stats
+
+def iter_unsparse(inputfd, crc_mode=CRC_VERIFY, output_mode=OUTPUT_DENSE):
+    """
+    Streaming unsparse. inputfd only needs read and readinto, so it can be a pipe, a tar member or a http response.
+    Yields (output_offset, buffer) in output order instead of writing to a file. Raw chunk data is yielded as a
+    memoryview of a reused buffer, which is only valid until the next iteration.
+    With OUTPUT_DENSE the buffers form one contiguous stream, don't care chunks are yielded as zeroes.
+    With OUTPUT_HOLES don't care and zero fill chunks are not yielded, the gaps are zeroes.
+    :return: UnsparseStats, as value of the StopIteration (use "stats = yield from iter_unsparse(...)")
+    """
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError("Unknown output mode {}".format(output_mode))
+    crc = crc_mode if isinstance(crc_mode, Crc32Engine) else Crc32Engine(crc_mode)
+    stats = UnsparseStats(crc, output_mode)
+    sparse_header = read_sparse_header(inputfd)
+    offset = 0
+    copybuf = _copy_buffer()
+
+    for i in range(sparse_header.total_chunks):
+        chunk_header = read_chunk_header(inputfd, sparse_header, i)
+        length = chunk_header.chunk_sz * sparse_header.blk_sz
+
+        if chunk_header.chunk_type == CHUNK_TYPE_RAW:
+            for pos in range(0, length, COPY_BUF_SIZE):
+                size = min(COPY_BUF_SIZE, length - pos)
+                view = copybuf[:size]
+                ret = _readinto_full(inputfd, view)
+                if ret != size:
+                    _log.error("read returned an error copying a raw chunk: %d %d", ret, size)
+                    raise Exception()
+                crc.update(view)
+                stats.bytes_written += size
+                yield offset + pos, view
+            offset += length
+
+        elif chunk_header.chunk_type in (CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE):
+            if chunk_header.chunk_type == CHUNK_TYPE_FILL:
+                fill_val = _read_full(inputfd, 4)
+                if len(fill_val) != 4:
+                    _log.error("read returned an error copying a fill chunk")
+                    raise Exception()
+            else:
+                fill_val = b"\x00\x00\x00\x00"
+            zero = fill_val == b"\x00\x00\x00\x00"
+            if zero:
+                crc.update_zeros(length)
+            if zero and output_mode == OUTPUT_HOLES:
+                stats.bytes_skipped += length
+            else:
+                fillbuf = _fill_buffer(fill_val)
+                for pos in range(0, length, COPY_BUF_SIZE):
+                    size = min(COPY_BUF_SIZE, length - pos)
+                    buf = fillbuf if size == COPY_BUF_SIZE else fillbuf[:size]
+                    if not zero:
+                        crc.update(buf)
+                    yield offset + pos, buf
+                stats.bytes_written += length
+            offset += length
+
+        elif chunk_header.chunk_type == CHUNK_TYPE_CRC32:
+            process_crc32_chunk(inputfd, crc)
+
+        else:
+            _log.error("Unknown chunk type 0x%4.4x", chunk_header.chunk_type)
+            _skip_input(inputfd, chunk_header.total_sz - sparse_header.chunk_hdr_sz)
+
+    total_blocks = offset // sparse_header.blk_sz
+    if (sparse_header.total_blks != total_blocks):
+        _log.error("Read %d blocks, expected %d blocks", total_blocks, sparse_header.total_blks)
+        raise Exception()
+    if sparse_header.image_checksum:
+        crc.check(sparse_header.image_checksum, "image checksum")
+    stats.total_blocks = total_blocks
+    return stats
+
+class ChunkIndexEntry():
+    """
+    Location of a chunk. in_offset is the offset of the chunk data in the sparse image. out_offset and length are the
+    region in the unsparsed output, length is 0 for CRC32 chunks. value is the 4 byte fill value of a FILL chunk or
+    the expected crc32 of a CRC32 chunk.
+    """
+    def __init__(self, chunk_type, in_offset, out_offset, length, value=None):
+        self.chunk_type = chunk_type
+        self.in_offset = in_offset
+        self.out_offset = out_offset
+        self.length = length
+        self.value = value
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, vars(self))
+
+def build_chunk_index(inputfd):
+    """
+    Walk all chunk headers, seeking over the chunk data. inputfd has to be seekable.
+    :return: (sparse_header, list of ChunkIndexEntry)
+    """
+    sparse_header = read_sparse_header(inputfd)
+    index = []
+    out_offset = 0
+    for i in range(sparse_header.total_chunks):
+        chunk_header = read_chunk_header(inputfd, sparse_header, i)
+        in_offset = inputfd.tell()
+        data_len = chunk_header.total_sz - sparse_header.chunk_hdr_sz
+        length = chunk_header.chunk_sz * sparse_header.blk_sz
+        value = None
+        if chunk_header.chunk_type in (CHUNK_TYPE_FILL, CHUNK_TYPE_CRC32):
+            value = inputfd.read(4)
+            if len(value) != 4:
+                _log.error("read returned an error reading chunk %d", i)
+                raise Exception()
+            data_len -= 4
+        if chunk_header.chunk_type == CHUNK_TYPE_CRC32:
+            (value,) = struct.unpack("<I", value)
+            length = 0
+        elif chunk_header.chunk_type not in (CHUNK_TYPE_RAW, CHUNK_TYPE_FILL, CHUNK_TYPE_DONT_CARE):
+            _log.error("Unknown chunk type 0x%4.4x", chunk_header.chunk_type)
+            inputfd.seek(data_len, 1)
+            continue
+        index.append(ChunkIndexEntry(chunk_header.chunk_type, in_offset, out_offset, length, value))
+        out_offset += length
+        inputfd.seek(data_len, 1)
+    _log.debug("Indexed %d chunks", len(index))
+    return sparse_header, index
+
+PARALLEL_UNIT_SIZE = 8 * COPY_BUF_SIZE
+
+def _pwrite_all(fd, buf, offset):
+    view = memoryview(buf)
+    while len(view):
+        ret = os.pwrite(fd, view, offset)
+        if ret <= 0:
+            _log.error("write returned an error at offset %d", offset)
+            raise Exception()
+        view = view[ret:]
+        offset += ret
+
+def _write_raw_unit(infd, outfd, in_offset, out_offset, length, crc):
+    if not crc.enabled and _copy_file_range(infd, outfd, in_offset, out_offset, length):
+        return 0
+    copybuf = _copy_buffer()
+    unit_crc = 0
+    while length:
+        chunk_size = COPY_BUF_SIZE if (length > COPY_BUF_SIZE) else length
+        view = copybuf[:chunk_size]
+        ret = os.preadv(infd, [view], in_offset)
+        if ret != chunk_size:
+            _log.error("read returned an error copying a raw chunk: %d %d", ret, chunk_size)
+            raise Exception()
+        if crc.enabled:
+            unit_crc = crc.crcfunc(unit_crc, view)
+        _pwrite_all(outfd, view, out_offset)
+        in_offset += chunk_size
+        out_offset += chunk_size
+        length -= chunk_size
+    return unit_crc
+
+def _write_fill_unit(outfd, fill_val, out_offset, length, crc):
+    fillbuf = _fill_buffer(fill_val)
+    unit_crc = 0
+    while length:
+        buf = fillbuf if length >= len(fillbuf) else fillbuf[:length]
+        _pwrite_all(outfd, buf, out_offset)
+        if crc.enabled:
+            unit_crc = crc.crcfunc(unit_crc, buf)
+        out_offset += len(buf)
+        length -= len(buf)
+    return unit_crc
+
+def unsparse_parallel(inputfd, outputfd, workers=None, crc_mode=CRC_VERIFY, output_mode=OUTPUT_DENSE):
+    """
+    Unsparse in two phases: first index all chunks, then let a thread pool copy raw and fill chunks with positional
+    reads and writes. Large raw chunks are split in units of PARALLEL_UNIT_SIZE. pread, pwrite and zlib release the
+    GIL, so this scales with the number of workers. The crc32 of every unit is computed in the worker and combined
+    in chunk order afterwards.
+    Both inputfd and outputfd need to be real files. With crc off, raw chunks are copied with copy_file_range.
+    :param workers: Number of worker threads, default is the ThreadPoolExecutor default
+    :return: UnsparseStats, like unsparse()
+    """
+    if output_mode not in OUTPUT_MODES:
+        raise ValueError("Unknown output mode {}".format(output_mode))
+    started = time.perf_counter()
+    crc = crc_mode if isinstance(crc_mode, Crc32Engine) else Crc32Engine(crc_mode)
+    stats = UnsparseStats(crc, output_mode)
+
+    sparse_header, index = build_chunk_index(inputfd)
+    total_len = sum(entry.length for entry in index)
+    total_blocks = total_len // sparse_header.blk_sz
+    if (sparse_header.total_blks != total_blocks):
+        _log.error("Chunks contain %d blocks, expected %d blocks", total_blocks, sparse_header.total_blks)
+        raise Exception()
+    outfd = outputfd.fileno()
+    os.ftruncate(outfd, total_len)
+
+    infd = inputfd.fileno()
+    # (future or crc32 of the unit, length of the unit) in output order, or a CRC32 index entry
+    units = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry in index:
+            if entry.chunk_type == CHUNK_TYPE_CRC32:
+                units.append(entry)
+            elif entry.chunk_type == CHUNK_TYPE_DONT_CARE or \
+                    (entry.chunk_type == CHUNK_TYPE_FILL and output_mode == OUTPUT_HOLES and
+                     entry.value == b"\x00\x00\x00\x00"):
+                units.append((crc32_zeros(0, entry.length) if crc.enabled else 0, entry.length))
+                stats.bytes_skipped += entry.length
+            else:
+                for start in range(0, entry.length, PARALLEL_UNIT_SIZE):
+                    length = min(PARALLEL_UNIT_SIZE, entry.length - start)
+                    if entry.chunk_type == CHUNK_TYPE_RAW:
+                        future = executor.submit(_write_raw_unit, infd, outfd, entry.in_offset + start,
+                                                 entry.out_offset + start, length, crc)
+                    else:
+                        future = executor.submit(_write_fill_unit, outfd, entry.value, entry.out_offset + start,
+                                                 length, crc)
+                    units.append((future, length))
+                    stats.bytes_written += length
+
+        for unit in units:
+            if isinstance(unit, ChunkIndexEntry):
+                crc.check(unit.value, "crc32 chunk")
+                continue
+            (unit_crc, length) = unit
+            if isinstance(unit_crc, concurrent.futures.Future):
+                unit_crc = unit_crc.result()
+            crc.combine(unit_crc, length)
+
+    if sparse_header.image_checksum:
+        crc.check(sparse_header.image_checksum, "image checksum")
+    stats.total_blocks = total_blocks
+    _log.info("Output crc32: %s", repr(crc))
+    _log.info("%d bytes written, %d bytes skipped", stats.bytes_written, stats.bytes_skipped)
+    _record_metrics(stats, time.perf_counter() - started)
+    return stats
+
+def _fill_view(view, fill_val):
+    # Fill a memoryview with a repeated 4 byte pattern, starting at the start of the pattern
+    fillbuf = _fill_buffer(fill_val)
+    pos = 0
+    while pos < len(view):
+        size = min(len(fillbuf), len(view) - pos)
+        view[pos:pos + size] = fillbuf[:size]
+        pos += size
+
+class SparseImageReader(io.RawIOBase):
+    """
+    Read only file object with the unsparsed contents of a sparse image, without unsparsing it to disk.
+    Reads are served from the sparse image using a chunk index: raw chunks are read from the image, fill and don't
+    care chunks are generated. Besides the normal file interface it supports pread() and mmap style slicing,
+    reader[start:stop].
+    Not thread safe, since all reads go through the file position of the underlying sparse image file.
+    """
+    def __init__(self, image):
+        """
+        :param image: Path to the sparse image or a seekable binary file object
+        """
+        super().__init__()
+        if isinstance(image, str):
+            self._fh = open(image, "rb")
+            self._ownfh = True
+        else:
+            self._fh = image
+            self._ownfh = False
+        self._fh.seek(0)
+        self.sparse_header, index = build_chunk_index(self._fh)
+        self._chunks = [entry for entry in index if entry.length]
+        self._starts = [entry.out_offset for entry in self._chunks]
+        self.size = sum(entry.length for entry in self._chunks)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        n = self.preadinto(b, self._pos)
+        self._pos += n
+        return n
+
+    def preadinto(self, b, offset):
+        """
+        readinto() at offset, without using or moving the file position.
+        """
+        view = memoryview(b).cast("B")
+        length = max(0, min(len(view), self.size - offset))
+        pos = 0
+        while pos < length:
+            i = bisect.bisect_right(self._starts, offset + pos) - 1
+            entry = self._chunks[i]
+            within = offset + pos - entry.out_offset
+            size = min(entry.length - within, length - pos)
+            part = view[pos:pos + size]
+            if entry.chunk_type == CHUNK_TYPE_RAW:
+                self._fh.seek(entry.in_offset + within)
+                ret = self._fh.readinto(part)
+                if ret != size:
+                    _log.error("read returned an error reading a raw chunk: %d %d", ret or 0, size)
+                    raise Exception()
+            elif entry.chunk_type == CHUNK_TYPE_FILL:
+                phase = within % 4
+                _fill_view(part, (entry.value * 2)[phase:phase + 4])
+            else:
+                _fill_view(part, b"\x00\x00\x00\x00")
+            pos += size
+        return length
+
+    def pread(self, size, offset):
+        """
+        Read size bytes at offset, without using or moving the file position.
+        """
+        buf = bytearray(max(0, min(size, self.size - offset)))
+        self.preadinto(buf, offset)
+        return bytes(buf)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(self.size)
+            if step != 1:
+                raise ValueError("Only slices with step 1 are supported")
+            return self.pread(stop - start, start)
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError("index out of range")
+        return self.pread(1, key)[0]
+
+    def close(self):
+        if self._ownfh and not self.closed:
+            self._fh.close()
+        super().close()
+
+    def __repr__(self):
+        return "<{}({}, {} bytes, {} chunks)>".format(self.__class__.__name__, getattr(self._fh, "name", None),
+                                                      self.size, len(self._chunks))
 
 def main():
     parser = argparse.ArgumentParser(description="Convert Android sparse ext4 image to regular ext4 image")
-    parser.add_argument("input_image", help="The sparse input image")
+    parser.add_argument("input_image", help="The sparse input image, - for stdin")
     parser.add_argument("output_image", help="The output image")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    parser.add_argument("-s", "--holes", action="store_true", help="Write zero fill chunks as holes, like don't care chunks")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker threads. 0 means a default based on the number of cores. Default: 1")
+    parser.add_argument("-c", "--crc", choices=CRC_MODES, default=CRC_VERIFY, help="Crc32 checking. Default: verify")
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
-    with open(args.input_image, "rb") as inputfd, open(args.output_image, "wb") as outputfd:
-        unsparse(inputfd, outputfd)
+    if args.input_image == "-":
+        inputfd = sys.stdin.buffer
+    else:
+        inputfd = open(args.input_image, "rb")
+    with inputfd, open(args.output_image, "wb") as outputfd:
+        output_mode = OUTPUT_HOLES if args.holes else OUTPUT_DENSE
+        # unsparse_parallel seeks to the chunks, a pipe is read front to back
+        if args.jobs != 1 and not inputfd.seekable():
+            _log.info("Input is not seekable, unsparsing with a single thread")
+        if args.jobs == 1 or not inputfd.seekable():
+            unsparse(inputfd, outputfd, crc_mode=args.crc, output_mode=output_mode)
+        else:
+            unsparse_parallel(inputfd, outputfd, workers=args.jobs or None, crc_mode=args.crc,
+                              output_mode=output_mode)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,106 @@
+__author__ = 'ivo'
+
+"""
+SQLite backend for the hash whitelist, the "-f sql" format of build_whitelist.
+
+One row per file, with an index per digest type:
+    files(id INTEGER PRIMARY KEY, md5 BLOB, sha1 BLOB, sha256 BLOB UNIQUE, filepath TEXT, source_id TEXT,
+          threat INTEGER, trust INTEGER)
+A file is identified by its sha256, a file that is written again is resolved with INSERT ... ON CONFLICT.
+The database runs in WAL mode, a batch is written with executemany in one transaction.
+"""
+
+import logging
+import sqlite3
+
+from android import records
+
+_log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    md5 BLOB NOT NULL,
+    sha1 BLOB NOT NULL,
+    sha256 BLOB NOT NULL,
+    filepath TEXT,
+    source_id TEXT,
+    threat INTEGER,
+    trust INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1);
+CREATE INDEX IF NOT EXISTS files_md5 ON files (md5);
+"""
+
+INSERT = ("INSERT INTO files (md5, sha1, sha256, filepath, source_id, threat, trust) VALUES (?, ?, ?, ?, ?, ?, ?) "
+          "ON CONFLICT (sha256) DO NOTHING")
+UPSERT = ("INSERT INTO files (md5, sha1, sha256, filepath, source_id, threat, trust) VALUES (?, ?, ?, ?, ?, ?, ?) "
+          "ON CONFLICT (sha256) DO UPDATE SET filepath = excluded.filepath, source_id = excluded.source_id, "
+          "threat = excluded.threat, trust = excluded.trust "
+          "WHERE (filepath, source_id, threat, trust) IS NOT (excluded.filepath, excluded.source_id, "
+          "excluded.threat, excluded.trust)")
+# Digest column per digest size
+DIGEST_COLUMNS = {16: "md5", 20: "sha1", 32: "sha256"}
+# Max number of parameters in one lookup query
+LOOKUP_CHUNK = 500
+
+class SqlHashDb():
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        _log.debug("Opened sqlite database %s", path)
+
+    def _max_id(self):
+        return self._conn.execute("SELECT coalesce(max(id), 0) FROM files").fetchone()[0]
+
+    def batch_write(self, items, replace=True):
+        """
+        Same interface as build_whitelist.batch_write, the counts are in digests like there.
+        New rows get ids above the highest id, so the number of inserted rows follows from max(id).
+        :param items: list of ((md5, sha1, sha256), value)
+        :return: (number of digests written, number of digests processed, number of duplicate digests)
+        """
+        # A file that is in the batch more than once is a duplicate, the last one is written if replace is True
+        rows = {}
+        for ((md5, sha1, sha256), value) in items:
+            if replace or sha256 not in rows:
+                rows[sha256] = (md5, sha1, sha256, value["filepath"],
+                                None if value["source_id"] is None else str(value["source_id"]),
+                                value["threat"], value["trust"])
+        with self._conn:
+            before_id, before_changes = self._max_id(), self._conn.total_changes
+            self._conn.executemany(UPSERT if replace else INSERT, rows.values())
+            inserted = self._max_id() - before_id
+            changed = self._conn.total_changes - before_changes
+        digests = len(records.HASH_KEY_SIZES)
+        return changed * digests, len(items) * digests, (len(items) - inserted) * digests
+
+    def get_many(self, keys):
+        """
+        :param keys: md5, sha1 or sha256 digests
+        :return: dict of digest -> value dict, for the digests that are in the db
+        """
+        found = {}
+        bycolumn = {}
+        for key in set(keys):
+            if len(key) in DIGEST_COLUMNS:
+                bycolumn.setdefault(DIGEST_COLUMNS[len(key)], []).append(key)
+        for (column, columnkeys) in bycolumn.items():
+            columnkeys.sort()
+            for i in range(0, len(columnkeys), LOOKUP_CHUNK):
+                chunk = columnkeys[i:i + LOOKUP_CHUNK]
+                query = "SELECT {0}, filepath, source_id, threat, trust FROM files WHERE {0} IN ({1})".format(
+                    column, ", ".join("?" * len(chunk)))
+                for (key, filepath, source_id, threat, trust) in self._conn.execute(query, chunk):
+                    found[key] = {"filepath": filepath, "source_id": source_id, "threat": threat, "trust": trust}
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def close(self):
+        self._conn.close()
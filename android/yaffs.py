@@ -0,0 +1,291 @@
+__author__ = 'ivo'
+
+"""
+Reader for yaffs2 images, as made by mkyaffs2image, so they can be walked and hashed without unyaffs.
+
+An image is a sequence of chunks, each a page of chunk_size bytes followed by spare_size bytes of spare (OOB) data.
+The spare starts with the packed tags:
+    struct yaffs_packed_tags2_tags_only {
+        unsigned seq_number;
+        unsigned obj_id;
+        unsigned chunk_id;
+        unsigned n_bytes;
+    };
+chunk_id 0 is the object header (n_bytes 0xffff), the data of a file is in chunks 1..n. When the object header
+carries extra info, bit 31 of chunk_id is set and the top 4 bits of obj_id hold the object type.
+When an object or chunk was rewritten, the one with the highest seq_number counts.
+
+The object header (page data of chunk 0), from yaffs_guts.h:
+    struct yaffs_obj_hdr {
+        enum yaffs_obj_type type;
+        int parent_obj_id;
+        u16 sum_no_longer_used;
+        YCHAR name[YAFFS_MAX_NAME_LENGTH + 1];
+        u32 yst_mode;
+        u32 yst_uid, yst_gid, yst_atime, yst_mtime, yst_ctime;
+        int file_size_low;
+        int equiv_id;
+        YCHAR alias[YAFFS_MAX_ALIAS_LENGTH + 1];
+        ...
+        u32 file_size_high;
+    };
+"""
+
+import io
+import logging
+import os
+import stat
+import struct
+
+_log = logging.getLogger(__name__)
+
+OBJECT_TYPE_UNKNOWN = 0
+OBJECT_TYPE_FILE = 1
+OBJECT_TYPE_SYMLINK = 2
+OBJECT_TYPE_DIRECTORY = 3
+OBJECT_TYPE_HARDLINK = 4
+OBJECT_TYPE_SPECIAL = 5
+
+OBJECTID_ROOT = 1
+OBJECTID_LOSTNFOUND = 2
+OBJECTID_UNLINKED = 3
+OBJECTID_DELETED = 4
+
+EXTRA_HEADER_INFO_FLAG = 0x80000000
+EXTRA_OBJECT_TYPE_SHIFT = 28
+EXTRA_OBJECT_TYPE_MASK = 0x0F << EXTRA_OBJECT_TYPE_SHIFT
+
+# (chunk_size, spare_size) combinations tried when not given, most common first
+GEOMETRIES = ((2048, 64), (4096, 128), (4096, 224), (8192, 448), (16384, 1280), (1024, 32))
+
+class PackedTags2():
+    format = "<IIII"
+    structlen = struct.calcsize(format)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        pt = cls()
+        (pt.seq_number, pt.obj_id, pt.chunk_id, pt.n_bytes) = struct.unpack_from(cls.format, blob)
+        if pt.chunk_id & EXTRA_HEADER_INFO_FLAG:
+            pt.obj_id &= ~EXTRA_OBJECT_TYPE_MASK
+            pt.chunk_id = 0
+        return pt
+
+    def is_erased(self):
+        return self.seq_number == 0xFFFFFFFF or self.obj_id in (0, 0xFFFFFFFF)
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, vars(self))
+
+class ObjectHeader():
+    format = "<Ii2x256s2xIIIIIIiI160s"
+    structlen = struct.calcsize(format)
+    file_size_high_offset = 496
+
+    @classmethod
+    def from_bytes(cls, blob):
+        oh = cls()
+        (oh.type, oh.parent_obj_id, name, oh.mode, oh.uid, oh.gid, oh.atime, oh.mtime, oh.ctime,
+         oh.file_size_low, oh.equiv_id, alias) = struct.unpack_from(cls.format, blob)
+        oh.name = str(name.split(b"\x00", 1)[0], encoding="utf8", errors="surrogateescape")
+        oh.alias = alias.split(b"\x00", 1)[0]
+        (file_size_high,) = struct.unpack_from("<I", blob, cls.file_size_high_offset)
+        oh.file_size = oh.file_size_low & 0xFFFFFFFF
+        if file_size_high != 0xFFFFFFFF:
+            oh.file_size |= file_size_high << 32
+        return oh
+
+    def __repr__(self):
+        return "<{}({})>".format(self.__class__.__name__, vars(self))
+
+class YaffsObject():
+    def __init__(self, obj_id, header, chunk_index):
+        self.obj_id = obj_id
+        self.header = header
+        self.chunk_index = chunk_index
+        self.children = []
+        # chunk_id -> (seq_number, chunk index, n_bytes)
+        self.chunks = {}
+
+    def __repr__(self):
+        return "<{}({}, {})>".format(self.__class__.__name__, self.obj_id, repr(self.header))
+
+class YaffsFile(io.RawIOBase):
+    """
+    File object for the data of a yaffs file object. Missing chunks read as zeroes.
+    """
+    def __init__(self, image, obj):
+        super().__init__()
+        self.image = image
+        self.obj = obj
+        self.size = obj.header.file_size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+        return self._pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        length = max(0, min(len(view), self.size - self._pos))
+        chunk_size = self.image.chunk_size
+        done = 0
+        while done < length:
+            (chunk_id, within) = divmod(self._pos + done, chunk_size)
+            size = min(chunk_size - within, length - done)
+            chunk = self.obj.chunks.get(chunk_id + 1)
+            if chunk:
+                blob = self.image.read_chunk_data(chunk[1])[within:within + size]
+                view[done:done + len(blob)] = blob
+                view[done + len(blob):done + size] = bytes(size - len(blob))
+            else:
+                view[done:done + size] = bytes(size)
+            done += size
+        self._pos += length
+        return length
+
+class Yaffs2Image():
+    """
+    A yaffs2 image. The tags of all chunks are read once to build the object tree, file data is read on demand.
+    """
+    def __init__(self, image, chunk_size=None, spare_size=None, tags_offset=0):
+        """
+        :param image: Path or seekable binary file object
+        :param chunk_size: Page size, detected from GEOMETRIES if not given
+        :param spare_size: Spare size, detected with chunk_size
+        :param tags_offset: Offset of the packed tags in the spare
+        """
+        self._fh = open(image, "rb") if isinstance(image, str) else image
+        self._ownfh = isinstance(image, str)
+        self.tags_offset = tags_offset
+        self._fh.seek(0, io.SEEK_END)
+        self.image_size = self._fh.tell()
+        if chunk_size is None:
+            (chunk_size, spare_size) = self._detect_geometry()
+        self.chunk_size = chunk_size
+        self.spare_size = spare_size
+        self.objects = {}
+        self._scan()
+
+    def _pread(self, offset, size):
+        self._fh.seek(offset)
+        return self._fh.read(size)
+
+    def _tags(self, index, chunk_size, spare_size):
+        offset = index * (chunk_size + spare_size) + chunk_size + self.tags_offset
+        return PackedTags2.from_bytes(self._pread(offset, PackedTags2.structlen))
+
+    def _detect_geometry(self):
+        for (chunk_size, spare_size) in GEOMETRIES:
+            if self.image_size % (chunk_size + spare_size):
+                continue
+            tags = self._tags(0, chunk_size, spare_size)
+            if tags.chunk_id == 0 and tags.n_bytes == 0xFFFF and not tags.is_erased():
+                _log.debug("Detected yaffs2 geometry %d+%d", chunk_size, spare_size)
+                return chunk_size, spare_size
+        raise Exception("Could not detect yaffs2 chunk and spare size")
+
+    def read_chunk_data(self, index):
+        return self._pread(index * (self.chunk_size + self.spare_size), self.chunk_size)
+
+    def _scan(self):
+        num_chunks = self.image_size // (self.chunk_size + self.spare_size)
+        headers = {}
+        data = {}
+        for index in range(num_chunks):
+            tags = self._tags(index, self.chunk_size, self.spare_size)
+            if tags.is_erased():
+                continue
+            if tags.chunk_id == 0:
+                if tags.obj_id not in headers or headers[tags.obj_id][0] <= tags.seq_number:
+                    headers[tags.obj_id] = (tags.seq_number, index)
+            else:
+                chunks = data.setdefault(tags.obj_id, {})
+                if tags.chunk_id not in chunks or chunks[tags.chunk_id][0] <= tags.seq_number:
+                    chunks[tags.chunk_id] = (tags.seq_number, index, tags.n_bytes)
+        for obj_id, (seq_number, index) in headers.items():
+            header = ObjectHeader.from_bytes(self.read_chunk_data(index))
+            obj = YaffsObject(obj_id, header, index)
+            obj.chunks = data.get(obj_id, {})
+            self.objects[obj_id] = obj
+        for obj in self.objects.values():
+            parent = self.objects.get(obj.header.parent_obj_id)
+            if parent and parent is not obj:
+                parent.children.append(obj)
+        _log.debug("Scanned %d chunks, %d objects", num_chunks, len(self.objects))
+
+    def open(self, obj):
+        """
+        :return: File object with the data of a file object, or the target of a symlink
+        """
+        if obj.header.type == OBJECT_TYPE_HARDLINK:
+            if obj.header.equiv_id not in self.objects:
+                _log.warning("Hard link %s points to missing object %d", obj.header.name, obj.header.equiv_id)
+                return io.BytesIO(b"")
+            obj = self.objects[obj.header.equiv_id]
+        if obj.header.type == OBJECT_TYPE_SYMLINK:
+            return io.BytesIO(obj.header.alias)
+        if obj.header.type == OBJECT_TYPE_FILE:
+            return YaffsFile(self, obj)
+        return io.BytesIO(b"")
+
+    def mode(self, obj):
+        if obj.header.type == OBJECT_TYPE_HARDLINK and obj.header.equiv_id in self.objects:
+            obj = self.objects[obj.header.equiv_id]
+        mode = obj.header.mode
+        # Some images leave the type bits out of yst_mode
+        if not stat.S_IFMT(mode):
+            mode |= {OBJECT_TYPE_FILE: stat.S_IFREG,
+                     OBJECT_TYPE_SYMLINK: stat.S_IFLNK,
+                     OBJECT_TYPE_DIRECTORY: stat.S_IFDIR}.get(obj.header.type, 0)
+        return mode
+
+    def walk(self):
+        """
+        Walk the object tree from the root. Yields (path, mode, size, data stream) for every object, like
+        cpio.iter_cpio. Hard links yield the data of the linked file. Deleted and unlinked objects are skipped.
+        """
+        root = self.objects.get(OBJECTID_ROOT)
+        if root is None:
+            # mkyaffs2image does not write a header for the root, all top level objects have it as parent
+            root = YaffsObject(OBJECTID_ROOT, None, None)
+            root.children = [obj for obj in self.objects.values() if obj.header.parent_obj_id == OBJECTID_ROOT]
+        stack = [("", root)]
+        while stack:
+            (dirpath, parent) = stack.pop()
+            for obj in sorted(parent.children, key=lambda obj: obj.header.name):
+                if obj.obj_id in (OBJECTID_UNLINKED, OBJECTID_DELETED) or not obj.header.name:
+                    continue
+                path = os.path.join(dirpath, obj.header.name)
+                fh = self.open(obj)
+                size = fh.seek(0, io.SEEK_END)
+                fh.seek(0)
+                yield path, self.mode(obj), size, fh
+                if obj.header.type == OBJECT_TYPE_DIRECTORY:
+                    stack.append((path, obj))
+
+    def close(self):
+        if self._ownfh:
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()